@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+#
+# Benchmark of ubsl image loading: a 116 KB MSP430X image
+# (0x3100..0x1ffff, with a gap every 256 bytes) in IHEX, TI-TXT and ELF
+# format is loaded and read back in 512-byte flash segments, as
+# differential programming does.
+# The previous string based loader is timed on the IHEX file for comparison.
+#
+
+from __future__ import print_function
+import os, sys, time, random, struct, tempfile, shutil
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import ubsl
+
+FLASH_START = 0x3100
+FLASH_END = 0x20000
+GAP = bytearray([0xff]) * 16
+
+# -------------------------------------
+# the old code, for comparison
+
+def oldLoadIHex(file):
+    segments = []
+    segmentdata = []
+    currentAddr = 0
+    startAddr   = 0
+    for l in file.readlines():
+        l = l.strip()
+        length  = int(l[1:3],16)
+        address = int(l[3:7],16)
+        type    = int(l[7:9],16)
+        if type == 0x00:
+            if currentAddr != address:
+                if segmentdata:
+                    segments.append(ubsl.Segment(startAddr, "".join(segmentdata)))
+                startAddr = currentAddr = address
+                segmentdata = []
+            for i in range(length):
+                segmentdata.append(chr(int(l[9+2*i:11+2*i],16)))
+            currentAddr = length + currentAddr
+    if segmentdata:
+        segments.append(ubsl.Segment(startAddr, "".join(segmentdata)))
+    return segments
+
+def oldGetMemrange(segments, fromadr, toadr):
+    res = ''
+    toadr = toadr + 1
+    while fromadr < toadr:
+        for seg in segments:
+            segend = seg.startaddress + len(seg.data)
+            if seg.startaddress <= fromadr and fromadr < segend:
+                if toadr > segend:
+                    catchlength = segend-fromadr
+                else:
+                    catchlength = toadr-fromadr
+                res = res + str(seg.data[fromadr-seg.startaddress : fromadr-seg.startaddress+catchlength])
+                fromadr = fromadr + catchlength
+                if len(res) >= toadr-fromadr:
+                    break
+        else:
+            res = res + chr(255)
+            fromadr = fromadr + 1
+    return res
+
+# -------------------------------------
+
+def writeIHex(filename, data):
+    with open(filename, "w") as f:
+        upper = None
+        for i in range(0, len(data), 16):
+            addr = FLASH_START + i
+            if addr >> 16 != upper:
+                upper = addr >> 16
+                rec = bytearray([2, 0, 0, 4, 0, upper])
+                f.write(":" + "".join(["%02X" % b for b in rec]) + "%02X\n" % (-sum(rec) & 0xff))
+            chunk = data[i:i + 16]
+            if chunk == GAP:
+                continue
+            rec = bytearray([len(chunk), (addr >> 8) & 0xff, addr & 0xff, 0]) + chunk
+            f.write(":" + "".join(["%02X" % b for b in rec]) + "%02X\n" % (-sum(rec) & 0xff))
+        f.write(":00000001FF\n")
+
+def writeTIText(filename, data):
+    with open(filename, "w") as f:
+        gap = True
+        for i in range(0, len(data), 16):
+            chunk = data[i:i + 16]
+            if chunk == GAP:
+                gap = True
+                continue
+            if gap:
+                f.write("@%04x\n" % (FLASH_START + i))
+                gap = False
+            f.write(" ".join(["%02X" % b for b in chunk]) + "\n")
+        f.write("q\n")
+
+def writeELF(filename, data):
+    # ELF header and one PT_LOAD program header
+    header = b"\x7fELF" + bytes(bytearray([1, 1, 1])) + b"\0" * 9
+    header += struct.pack("<HHIIIIIHHHHHH", 2, 105, 1, FLASH_START, 52, 0, 0, 52, 32, 1, 40, 0, 0)
+    phdr = struct.pack("<8I", 1, 84, FLASH_START, FLASH_START, len(data), len(data), 5, 2)
+    with open(filename, "wb") as f:
+        f.write(header + phdr + bytes(data))
+
+def bench(name, function, repeat = 5):
+    start = time.time()
+    for i in range(repeat):
+        result = function()
+    print("{:>28}: {:8.1f} ms".format(name, (time.time() - start) * 1000 / repeat))
+    return result
+
+def readSegments(memory):
+    return [memory.getMemrange(a, a + 511) for a in range(FLASH_START, FLASH_END, 512)]
+
+def main():
+    random.seed(1)
+    data = bytearray([random.randint(0, 255) for i in range(FLASH_END - FLASH_START)])
+    for i in range(0, len(data), 256):
+        data[i:i + 16] = GAP
+    print("image size: {} bytes".format(len(data)))
+    tmpdir = tempfile.mkdtemp()
+    try:
+        names = dict([(ext, os.path.join(tmpdir, "image" + ext)) for ext in (".ihex", ".txt", ".elf")])
+        writeIHex(names[".ihex"], data)
+        writeTIText(names[".txt"], data)
+        writeELF(names[".elf"], data)
+
+        for ext in (".ihex", ".txt", ".elf"):
+            memory = bench("load " + ext, lambda: ubsl.Memory(names[ext]))
+            assert memory.getMemrange(FLASH_START, FLASH_END - 1) == data
+        memory = ubsl.Memory(names[".ihex"])
+        print("{} segments".format(len(memory)))
+        bench("read 512-byte segments", lambda: readSegments(memory))
+
+        if sys.version_info[0] < 3:
+            segments = bench("old load .ihex", lambda: oldLoadIHex(open(names[".ihex"], "rb")), 1)
+            bench("old read 512-byte segments",
+                  lambda: [oldGetMemrange(segments, a, a + 511) for a in range(FLASH_START, 0x10000, 512)], 1)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -4,7 +4,7 @@
 # Remote access proxy: client-side BSL loader script
 #
 
-import os, sys, time
+import os, sys, time, hashlib
 import urllib2
 import ubsl
 
@@ -41,10 +41,6 @@ def main():
     joinedCommandLine = " ".join(argv)
     joinedCommandLine = urllib2.quote(joinedCommandLine)
 
-    url += "args=" + joinedCommandLine + "&"
-    url += "filename=" + urllib2.quote(filename) + "&"
-    url += "port=" + urllib2.quote(port)
-
     contents = None
     with open(filename, "rb") as infile:
         contents = infile.read()
@@ -53,14 +49,41 @@ def main():
         sys.stderr.write("Input file not present, not readable or empty!\n")
         sys.exit(1)
 
-    req = urllib2.urlopen(url, contents)
-    if req.getcode() == 200:
-        sys.stdout.write(req.read())
-        sys.exit(0)
-    else:
-        sys.stderr.write("Request failed with HTTP return code " + str(req.getcode()) + "\n")
-        sys.stderr.write(req.read())
+    # do not send the image again if the server has it
+    digest = hashlib.sha1(contents).hexdigest()
+    try:
+        urllib2.urlopen(host + "/image?hash=" + digest + "&filename=" + urllib2.quote(filename)).read()
+        isOnServer = True
+        sys.stdout.write("Image already on the server\n")
+    except urllib2.URLError:
+        isOnServer = False
+
+    url += "args=" + joinedCommandLine + "&"
+    url += "filename=" + urllib2.quote(filename) + "&"
+    url += "port=" + urllib2.quote(port) + "&"
+    url += "hash=" + digest
+
+    try:
+        try:
+            req = urllib2.urlopen(url, "" if isOnServer else contents)
+        except urllib2.HTTPError:
+            if not isOnServer: raise
+            # removed from the server meanwhile
+            req = urllib2.urlopen(url, contents)
+    except urllib2.HTTPError as e:
+        sys.stderr.write("Request failed with HTTP return code " + str(e.code) + "\n")
+        sys.stderr.write(e.read())
         sys.exit(1)
 
+    # the output comes as the mote is programmed; the last line is the exit code
+    retcode = 0
+    for line in iter(req.readline, ""):
+        if line.startswith("exit code: "):
+            retcode = int(line[len("exit code: "):])
+        else:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+    sys.exit(retcode)
+
 if __name__ == '__main__':
     main()
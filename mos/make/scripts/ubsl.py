@@ -12,7 +12,8 @@
 # 
 
 from __future__ import print_function
-import sys, time, string, io, struct, os
+import sys, time, struct, os, re, json, hashlib, binascii, operator, collections, bisect, threading
+from functools import reduce
 import serial
 
 #
@@ -22,8 +23,6 @@ import serial
 #   * Zolertia Z1 (--z1 switch)
 #   * AdvanticSYS XM1000 (--tmote2618 switch)
 #
-# Note: ELF file direct loading functionality has been removed!
-#
 # Tested with Python versions 2.7.3 and 3.2.3.
 #
 VERSION = "1.39-universal-1"
@@ -218,18 +217,20 @@ class BSLException(Exception):
 # -------------- added for python 2/3 compatibility
 def asBinary(s):
     if not s: return s
-    r = bytearray([])
-    for c in s:
-        if type(c) is str: r.append(ord(c))
-        else: r.append(c)
-    return r
+    if isinstance(s, bytearray): return s
+    if isPython3() and isinstance(s, str): return bytearray(s, "latin-1")
+    return bytearray(s)
 
 def isPython3():
     return sys.version_info[0] >= 3
 
 def version3FixFrameFormat(rxFrame):
-    if isPython3(): return asBinary(rxFrame)
-    return rxFrame
+    if isPython3(): return bytearray(rxFrame)
+    return bytes(rxFrame)
+
+def asBytes(s):
+    if isinstance(s, bytes): return s
+    return bytes(asBinary(s))
 # --------------
 
 class LowLevel:
@@ -283,12 +284,12 @@ class LowLevel:
     ERR_FRAME_NUMBER        = "Frame sequence number error."
 
     def calcChecksum(self, data, length):
-        """Calculates a checksum of "data"."""
-        checksum = 0
-
-        for i in range(int(length/2)):
-            checksum = checksum ^ (ord(data[i*2]) | (ord(data[i*2+1]) << 8))    #xor-ing
-        return 0xffff & (checksum ^ 0xffff)         #inverting
+        """Calculates a checksum of "data" (a bytearray)."""
+        length -= length % 2
+        #xor of the 16-bit little endian words: low and high bytes separately
+        low = reduce(operator.xor, data[0:length:2], 0)
+        high = reduce(operator.xor, data[1:length:2], 0)
+        return 0xffff & ((low | (high << 8)) ^ 0xffff) #inverting
 
     def __init__(self, aTimeout = None, aProlongFactor = None):
         """init bsl object, don't connect yet"""
@@ -314,6 +315,7 @@ class LowLevel:
         self.protocolMode = self.MODE_BSL
         self.BSLMemAccessWarning = 0                #Default: no warning.
         self.slowmode = 0
+        self.log = sys.stderr                       #where the messages go
 
     def comInit(self, port):
         """Tries to open the serial port given and
@@ -322,7 +324,7 @@ class LowLevel:
         'aProlongFactor' after transmission of a command to give
         plenty of time to the micro controller to finish the command.
         Returns zero if the function is successful."""
-        if DEBUG > 1: sys.stderr.write("* comInit()\n")
+        if DEBUG > 1: self.log.write("* comInit()\n")
         self.seqNo = 0
         self.reqNo = 0
         self.rxPtr = 0
@@ -334,7 +336,7 @@ class LowLevel:
             parity = serial.PARITY_EVEN,
             timeout = self.timeout
         )
-        if DEBUG: sys.stderr.write("using serial port %r\n" % self.serialport.portstr)
+        if DEBUG: self.log.write("using serial port %r\n" % self.serialport.portstr)
         if not self.z1:
             self.SetRSTpin()                        #enable power
             self.SetTESTpin()                       #enable power
@@ -347,14 +349,14 @@ class LowLevel:
         otherwise the serial port might not be released and can not be
         used in other programs.
         Returns zero if the function is successful."""
-        if DEBUG > 1: sys.stderr.write("* comDone()")
+        if DEBUG > 1: self.log.write("* comDone()")
         self.SetRSTpin(1)                       #disable power
         self.SetTESTpin(0)                      #disable power
         self.serialport.close()
 
     def comRxHeader(self):
         """receive header and split data"""
-        if DEBUG > 1: sys.stderr.write("* comRxHeader()\n")
+        if DEBUG > 1: self.log.write("* comRxHeader()\n")
 
         hdr = self.serialport.read(1)
         if not hdr: raise BSLException("Timeout")
@@ -365,48 +367,46 @@ class LowLevel:
             self.reqNo = 0
             self.seqNo = 0
             rxNum = 0
-        if DEBUG > 1: sys.stderr.write("* comRxHeader() OK\n")
+        if DEBUG > 1: self.log.write("* comRxHeader() OK\n")
         return rxHeader, rxNum
 
     def comRxFrame(self, rxNum):
-        if DEBUG > 1: sys.stderr.write("* comRxFrame()\n")
-        rxFrame = chr(self.DATA_FRAME | rxNum)
+        """receive the rest of a data frame, return it as bytearray"""
+        if DEBUG > 1: self.log.write("* comRxFrame()\n")
+        rxFrame = bytearray([self.DATA_FRAME | rxNum])
 
-        if DEBUG > 2: sys.stderr.write("  comRxFrame() header...\n")
+        if DEBUG > 2: self.log.write("  comRxFrame() header...\n")
         rxFramedata = self.serialport.read(3)
         if len(rxFramedata) != 3: raise BSLException("Timeout")
-        for d in rxFramedata:
-            if type(d) is int: rxFrame += chr(d)
-            else: rxFrame += d
+        rxFrame += rxFramedata
 
-        if DEBUG > 3: sys.stderr.write("  comRxFrame() check header...\n")
-        if rxFrame[1] == chr(0) and rxFrame[2] == rxFrame[3]:   #Add. header info. correct?
-            rxLengthCRC = ord(rxFrame[2]) + 2       #Add CRC-Bytes to length
-            if DEBUG > 2: sys.stderr.write("  comRxFrame() receiving data, size: %s\n" % rxLengthCRC)
+        if DEBUG > 3: self.log.write("  comRxFrame() check header...\n")
+        if rxFrame[1] == 0 and rxFrame[2] == rxFrame[3]:   #Add. header info. correct?
+            rxLength = rxFrame[2]
+            rxLengthCRC = rxLength + 2              #Add CRC-Bytes to length
+            if DEBUG > 2: self.log.write("  comRxFrame() receiving data, size: %s\n" % rxLengthCRC)
 
             rxFramedata = self.serialport.read(rxLengthCRC)
             if len(rxFramedata) != rxLengthCRC: raise BSLException("Timeout")
-            for d in rxFramedata:
-                if type(d) is int: rxFrame += chr(d)
-                else: rxFrame += d
+            rxFrame += rxFramedata
             #Check received frame:
-            if DEBUG > 3: sys.stderr.write("  comRxFrame() crc check\n")
+            if DEBUG > 3: self.log.write("  comRxFrame() crc check\n")
             #rxLength+4: Length with header but w/o CRC:
-            checksum = self.calcChecksum(rxFrame, ord(rxFrame[2]) + 4)
-            if rxFrame[ord(rxFrame[2])+4] == chr(0xff & checksum) and \
-               rxFrame[ord(rxFrame[2])+5] == chr(0xff & (checksum >> 8)): #Checksum correct?
+            checksum = self.calcChecksum(rxFrame, rxLength + 4)
+            if rxFrame[rxLength+4] == 0xff & checksum and \
+               rxFrame[rxLength+5] == 0xff & (checksum >> 8): #Checksum correct?
                 #Frame received correctly (=> send next frame)
-                if DEBUG > 2: sys.stderr.write("* comRxFrame() OK\n")
+                if DEBUG > 2: self.log.write("* comRxFrame() OK\n")
                 return rxFrame
             else:
-                if DEBUG: sys.stderr.write("  comRxFrame() Checksum wrong\n")
+                if DEBUG: self.log.write("  comRxFrame() Checksum wrong\n")
         else:
-            if DEBUG: sys.stderr.write("  comRxFrame() Header corrupt %r" % rxFrame)
+            if DEBUG: self.log.write("  comRxFrame() Header corrupt %r" % rxFrame)
         raise BSLException(self.ERR_COM)            #Frame has errors!
 
     def comTxHeader(self, txHeader):
         """send header"""
-        if DEBUG > 1: sys.stderr.write("* txHeader()\n")
+        if DEBUG > 1: self.log.write("* txHeader()\n")
         self.serialport.write(txHeader)
 
     def comTxRx(self, cmd, dataOut, length):
@@ -416,71 +416,63 @@ class LowLevel:
         in dataIn (if not a NULL pointer is passed).
         In this routine all the necessary protocol stuff is handled.
         Returns zero if the function was successful."""
-        if DEBUG > 1: sys.stderr.write("* comTxRx()\n")
-        txFrame     = []
+        if DEBUG > 1: self.log.write("* comTxRx()\n")
         rxHeader    = 0
         rxNum       = 0
 
-        dataOut = list(dataOut)     #convert to a list for simpler data fill in
         #Transmitting part ----------------------------------------
-        #Prepare data for transmit
+        #Prepare data for transmit: the whole frame in one buffer
+        dataLength = len(dataOut) + (length % 2)
+        txFrame = bytearray([self.DATA_FRAME | self.seqNo, cmd, dataLength, dataLength])
+        txFrame += asBinary(dataOut) or b""
         if (length % 2) != 0:
             #/* Fill with one byte to have even number of bytes to send */
             if self.protocolMode == self.MODE_BSL:
-                dataOut.append(0xFF)  #fill with 0xFF
+                txFrame.append(0xFF)  #fill with 0xFF
             else:
-                dataOut.append(0)     #fill with zero
-
-        txFrame = "%c%c%c%c" % (self.DATA_FRAME | self.seqNo, cmd, len(dataOut), len(dataOut))
+                txFrame.append(0)     #fill with zero
 
         self.reqNo = (self.seqNo + 1) % self.MAX_FRAME_COUNT
 
-        for d in dataOut:
-            if type(d) == int: txFrame += chr(d)
-            else: txFrame += d
         checksum = self.calcChecksum(txFrame, length + 4)
-        txFrame = txFrame + chr(checksum & 0xff)
-        txFrame = txFrame + chr((checksum >> 8) & 0xff)
+        txFrame.append(checksum & 0xff)
+        txFrame.append((checksum >> 8) & 0xff)
 
         accessAddr = (0x0212 + (checksum^0xffff)) & 0xfffe  #0x0212: Address of wCHKSUM
         if self.BSLMemAccessWarning and accessAddr < self.BSL_CRITICAL_ADDR:
-            sys.stderr.write("WARNING: This command might change data at address %04x or %04x!\n" % (accessAddr, accessAddr + 1))
+            self.log.write("WARNING: This command might change data at address %04x or %04x!\n" % (accessAddr, accessAddr + 1))
 
         self.serialport.flushInput()                #clear receiving queue
-        #TODO: Check after each transmitted character,
-        #TODO: if microcontroller did send a character (probably a NAK!).
-        for c in txFrame:
-            self.serialport.write(bytearray([ord(c)]))
-            if DEBUG > 3: sys.stderr.write("\ttx %02x" % ord(c))
-            #if self.serialport.inWaiting(): break  #abort when BSL replies, probably NAK
-        else:
-            if DEBUG > 1: sys.stderr.write( "  comTxRx() transmit OK\n")
+        #the whole frame at once; the serial driver paces it at the baudrate
+        self.serialport.write(txFrame)
+        if DEBUG > 3: self.log.write("\ttx %s\n" % binascii.hexlify(bytes(txFrame)))
+        if DEBUG > 1: self.log.write( "  comTxRx() transmit OK\n")
 
         #Receiving part -------------------------------------------
         rxHeader, rxNum = self.comRxHeader()        #receive header
-        if DEBUG > 1: sys.stderr.write("  comTxRx() rxHeader=0x%02x, rxNum=%d, seqNo=%d, reqNo=%s\n" % (rxHeader, rxNum, self.seqNo, self.reqNo))
+        if DEBUG > 1: self.log.write("  comTxRx() rxHeader=0x%02x, rxNum=%d, seqNo=%d, reqNo=%s\n" % (rxHeader, rxNum, self.seqNo, self.reqNo))
         if rxHeader == self.DATA_ACK:               #acknowledge/OK
-            if DEBUG > 2: sys.stderr.write("  comTxRx() DATA_ACK\n")
+            if DEBUG > 2: self.log.write("  comTxRx() DATA_ACK\n")
             if rxNum == self.reqNo:
                 self.seqNo = self.reqNo
-                if DEBUG > 2: sys.stderr.write("* comTxRx() DATA_ACK OK\n")
+                if DEBUG > 2: self.log.write("* comTxRx() DATA_ACK OK\n")
                 return          #Acknowledge received correctly => next frame
             raise BSLException(self.ERR_FRAME_NUMBER)
         elif rxHeader == self.DATA_NAK:             #not acknowledge/error
-            if DEBUG > 2: sys.stderr.write("* comTxRx() DATA_NAK\n")
+            if DEBUG > 2: self.log.write("* comTxRx() DATA_NAK\n")
             raise BSLException(self.ERR_RX_NAK)
         elif rxHeader == self.DATA_FRAME:           #receive data
-            if DEBUG > 2: sys.stderr.write("* comTxRx() DATA_FRAME\n")
+            if DEBUG > 2: self.log.write("* comTxRx() DATA_FRAME\n")
             if rxNum == self.reqNo:
                 rxFrame = self.comRxFrame(rxNum)
                 return rxFrame
             raise BSLException(self.ERR_FRAME_NUMBER)
         elif rxHeader == self.CMD_FAILED:           #Frame ok, but command failed.
-            if DEBUG > 2: sys.stderr.write("*  comTxRx() CMD_FAILED\n")
+            if DEBUG > 2: self.log.write("*  comTxRx() CMD_FAILED\n")
             raise BSLException(self.ERR_CMD_FAILED)
 
         elif (rxHeader == 0) and (cmd == self.BSL_MEMOFFSET):
-            if DEBUG: sys.stderr.write("* 0x00 header for memoffset\n")
+            if DEBUG: self.log.write("* 0x00 header for memoffset\n")
             return
         raise BSLException("Unknown header 0x%02x for 0x%02x\nAre you downloading to RAM into an old device that requires the patch? Try option -U" % (rxHeader, cmd))
 
@@ -581,19 +573,19 @@ class LowLevel:
         By now only BSL mode is accessed
         '''
         
-        if DEBUG > 1: sys.stderr.write("* bslReset(invokeBSL=%s)\n" % invokeBSL)
+        if DEBUG > 1: self.log.write("* bslReset(invokeBSL=%s)\n" % invokeBSL)
         if invokeBSL:
-            #sys.stderr.write("in Z1 bsl reset...\n")
+            #self.log.write("in Z1 bsl reset...\n")
             time.sleep(0.1)
             self.writepicROM(0xFF, 0xFF)
             time.sleep(0.1)
-            #sys.stderr.write("z1 bsl reset done...\n")
+            #self.log.write("z1 bsl reset done...\n")
         else:
-            #sys.stderr.write("in Z1 reset...\n")
+            #self.log.write("in Z1 reset...\n")
             time.sleep(0.1)
             self.writepicROM(0xFF, 0xFE)
             time.sleep(0.1)
-            #sys.stderr.write("z1 reset done...\n")
+            #self.log.write("z1 reset done...\n")
 
     def telosSetSCL(self, level):
         self.serialport.setRTS(not level)
@@ -676,11 +668,11 @@ class LowLevel:
           return
 
         if self.z1:
-          if DEBUG > 1: sys.stderr.write("* entering bsl with z1\n")
+          if DEBUG > 1: self.log.write("* entering bsl with z1\n")
           self.bslResetZ1(invokeBSL)
           return
 
-        if DEBUG > 1: sys.stderr.write("* bslReset(invokeBSL=%s)\n" % invokeBSL)
+        if DEBUG > 1: self.log.write("* bslReset(invokeBSL=%s)\n" % invokeBSL)
         self.SetRSTpin(1)       #power suply
         self.SetTESTpin(1)      #power suply
         time.sleep(0.250)       #charge capacitor on boot loader hardware
@@ -711,33 +703,32 @@ class LowLevel:
         """
         loopcnt = 5                                 #Max. tries to get synchronization
 
-        if DEBUG > 1: sys.stderr.write("* bslSync(wait=%d)\n" % wait)
+        if DEBUG > 1: self.log.write("* bslSync(wait=%d)\n" % wait)
         while wait or loopcnt:
             loopcnt = loopcnt - 1                   #count down tries
             self.serialport.flushInput()            #clear input, in case a prog is running
 
             self.serialport.write(bytearray([self.BSL_SYNC]))   #Send synchronization byte
-            c = self.serialport.read(1)             #read answer
-            if type(c) != str: c = chr(c[0])        #for version 3
-            if c == chr(self.DATA_ACK):             #ACk
-                if DEBUG > 1: sys.stderr.write("  bslSync() OK\n")
+            c = bytearray(self.serialport.read(1))  #read answer
+            if c == bytearray([self.DATA_ACK]):     #ACk
+                if DEBUG > 1: self.log.write("  bslSync() OK\n")
                 return                              #Sync. successful
             elif not c:                             #timeout
                     if loopcnt > 4:
                         if DEBUG > 1:
-                            sys.stderr.write("  bslSync() timeout, retry ...\n")
+                            self.log.write("  bslSync() timeout, retry ...\n")
                     elif loopcnt == 4:
                         #nmi may have caused the first reset to be ignored, try again
                         self.bslReset(0) 
                         self.bslReset(1)
                     elif loopcnt > 0:
                         if DEBUG > 1:
-                            sys.stderr.write("  bslSync() timeout, retry ...\n")
+                            self.log.write("  bslSync() timeout, retry ...\n")
                     else :
                         if DEBUG > 1:
-                            sys.stderr.write("  bslSync() timeout\n")
+                            self.log.write("  bslSync() timeout\n")
             else:                                   #garbage
-                if DEBUG > 1: sys.stderr.write("  bslSync() failed (0x%02x), retry ...\n" % ord(c))
+                if DEBUG > 1: self.log.write("  bslSync() failed (0x%02x), retry ...\n" % c[0])
                 
                 raise BSLException(self.ERR_BSL_SYNC)       #Sync. failed
 
@@ -749,17 +740,18 @@ class LowLevel:
         repeated, forever
         Parameters return by boot loader are passed via blkin.
         """
-        if DEBUG > 1: sys.stderr.write("* bslTxRx()\n")
+        if DEBUG > 1: self.log.write("* bslTxRx()\n")
 
         if cmd == self.BSL_TXBLK:
+            blkout = bytearray(asBinary(blkout))    #a copy, padded below
             #Align to even start address
             if (addr % 2) != 0:
                 addr = addr - 1                     #Decrement address and
-                blkout = chr(0xFF) + blkOut         #fill first byte of blkout with 0xFF
+                blkout.insert(0, 0xFF)              #fill first byte of blkout with 0xFF
                 length = length + 1
             #Make sure that len is even
             if (length % 2) != 0:
-                blkout = blkout + chr(0xFF)         #Inc. len and fill last byte of blkout with 0xFF
+                blkout.append(0xFF)                 #Inc. len and fill last byte of blkout with 0xFF
                 length = length + 1
 
         elif cmd == self.BSL_RXBLK:
@@ -775,7 +767,7 @@ class LowLevel:
         #    length = len + 4
 
         #Add necessary information data to frame
-        dataOut = struct.pack("<HH", addr, length)
+        dataOut = bytearray(struct.pack("<HH", addr, length))
 
         if blkout: #Copy data out of blkout into frame
             dataOut += asBinary(blkout)
@@ -789,12 +781,12 @@ class LowLevel:
 
 
 class Segment:
-    """store a string with memory contents along with its startaddress"""
+    """store a bytearray with memory contents along with its startaddress"""
     def __init__(self, startaddress = 0, data=None):
         if data is None:
-            self.data = ''
+            self.data = bytearray()
         else:
-            self.data = data
+            self.data = bytearray(asBinary(data))
         self.startaddress = startaddress
 
     def __getitem__(self, index):
@@ -806,16 +798,29 @@ class Segment:
     def __repr__(self):
         return "Segment(startaddress = 0x%04x, data=%r)" % (self.startaddress, self.data)
 
+def readText(file):
+    """whole contents of a (opened) text file, as str"""
+    text = file.read()
+    if not isinstance(text, str):
+        text = text.decode("latin-1")
+    return text
+
 class Memory:
-    """represent memory contents. with functions to load files"""
+    """represent memory contents. with functions to load files.
+    The segments are kept sorted by start address and must not overlap."""
     def __init__(self, filename=None):
         self.segments = []
+        self.starts = []                            #start addresses, for bisect
         if filename:
             self.filename = filename
             self.loadFile(filename)
 
     def append(self, seg):
-        self.segments.append(seg)
+        if not len(seg):
+            return
+        i = bisect.bisect_right(self.starts, seg.startaddress)
+        self.segments.insert(i, seg)
+        self.starts.insert(i, seg.startaddress)
 
     def __getitem__(self, index):
         return self.segments[index]
@@ -825,95 +830,108 @@ class Memory:
 
     def loadIHex(self, file):
         """load data from a (opened) file in Intel-HEX format"""
-        segmentdata = []
+        segmentdata = None
         currentAddr = 0
         startAddr   = 0
-        lines = file.readlines()
-        for l in lines:
-            if l.decode("utf-8")[0] != ':': raise BSLException("File Format Error\n")
+        baseAddr    = 0                             #from extended address records
+        for l in readText(file).splitlines():
             l = l.strip()       #fix CR-LF issues...
-            length  = int(l[1:3],16)
-            address = int(l[3:7],16)
-            type    = int(l[7:9],16)
-            check   = int(l[-2:],16)
+            if not l: continue
+            if l[0] != ':': raise BSLException("File Format Error\n")
+            try:
+                record = bytearray(binascii.unhexlify(l[1:]))
+            except (TypeError, ValueError, binascii.Error):
+                raise BSLException("File Format Error\n")
+            if len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xff:
+                raise BSLException("File Format Error (checksum)\n")
+            length  = record[0]
+            address = baseAddr + ((record[1] << 8) | record[2])
+            type    = record[3]
             if type == 0x00:
-                if currentAddr != address:
+                if segmentdata is None or currentAddr != address:
                     if segmentdata:
-                        self.segments.append( Segment(startAddr, "".join(segmentdata)) )
+                        self.append(Segment(startAddr, segmentdata))
                     startAddr = currentAddr = address
-                    segmentdata = []
-                for i in range(length):
-                    segmentdata.append( chr(int(l[9+2*i:11+2*i],16)) )
+                    segmentdata = bytearray()
+                segmentdata += record[4:4 + length]
                 currentAddr = length + currentAddr
-            elif type in (0x01, 0x02, 0x03, 0x04, 0x05):
+            elif type == 0x01:
+                break
+            elif type == 0x02:                      #extended segment address
+                baseAddr = ((record[4] << 8) | record[5]) << 4
+            elif type == 0x04:                      #extended linear address
+                baseAddr = ((record[4] << 8) | record[5]) << 16
+            elif type in (0x03, 0x05):
                 pass
             else:
                 sys.stderr.write("Ignored unknown field (type 0x%02x) in ihex file.\n" % type)
         if segmentdata:
-            self.segments.append( Segment(startAddr, "".join(segmentdata)) )
+            self.append(Segment(startAddr, segmentdata))
 
     def loadTIText(self, file):
         """load data from a (opened) file in TI-Text format"""
-        next        = 1
+        self.loadTITextString(readText(file))
+
+    def loadTITextString(self, text):
+        """load data in TI-Text format from a string"""
         startAddr   = 0
-        segmentdata = []
-        #Convert data for MSP430, TXT-File is parsed line by line
-        while next >= 1:
-            #Read one line
-            l = file.readline()
-            if not l: break #EOF
+        segmentdata = bytearray()
+        for l in text.splitlines():
             l = l.strip()
+            if not l: continue
             if l[0] == 'q': break
-            elif l[0] == '@':        #if @ => new address => send frame and set new addr.
-                #create a new segment
+            elif l[0] == '@':        #if @ => new address => create a new segment
                 if segmentdata:
-                    self.segments.append( Segment(startAddr, "".join(segmentdata)) )
+                    self.append(Segment(startAddr, segmentdata))
                 startAddr = int(l[1:],16)
-                segmentdata = []
+                segmentdata = bytearray()
             else:
-                for i in string.split(l):
-                    segmentdata.append(chr(int(i,16)))
+                try:
+                    segmentdata += binascii.unhexlify("".join(l.split()))
+                except (TypeError, ValueError, binascii.Error):
+                    raise BSLException("File Format Error\n")
         if segmentdata:
-            self.segments.append( Segment(startAddr, "".join(segmentdata)) )
+            self.append(Segment(startAddr, segmentdata))
+
+    def loadELF(self, file):
+        """load the loadable segments of a (opened) 32-bit little endian ELF file"""
+        data = file.read()
+        if data[:4] != b"\x7fELF" or bytearray(data[4:6]) != bytearray([1, 1]):
+            raise BSLException("Not a 32-bit little endian ELF file\n")
+        phoff, = struct.unpack_from("<I", data, 28)
+        phentsize, phnum = struct.unpack_from("<HH", data, 42)
+        for i in range(phnum):
+            (ptype, offset, vaddr, paddr, filesz, memsz, flags, align) = \
+                struct.unpack_from("<8I", data, phoff + i * phentsize)
+            if ptype == 1 and filesz:               #PT_LOAD; placed at the load address
+                self.append(Segment(paddr, data[offset:offset + filesz]))
 
     def loadFile(self, filename):
         """fill memory with the contents of a file. file type is determined from extension"""
-        #TODO: do a contents based detection
-        if filename[-4:].lower() == '.txt':
-            self.loadTIText(open(filename, "rb"))
-        elif filename[-4:].lower() in ('.a43', '.hex', 'ihex'):
-            self.loadIHex(open(filename, "rb"))
-        else:
-            raise Exception("Only IHEX and TI text file formats supported!")
+        with open(filename, "rb") as f:
+            if filename[-4:].lower() == '.txt':
+                self.loadTIText(f)
+            elif filename[-4:].lower() in ('.a43', '.hex', 'ihex'):
+                self.loadIHex(f)
+            elif f.read(4) == b"\x7fELF":
+                f.seek(0)
+                self.loadELF(f)
+            else:
+                raise Exception("Only IHEX, TI text and ELF file formats supported!")
 
     def getMemrange(self, fromadr, toadr):
-        """get a range of bytes from the memory. unavailable values are filled with 0xff."""
-        res = ''
+        """get a range of bytes from the memory, as a bytearray.
+        unavailable values are filled with 0xff."""
         toadr = toadr + 1   #python indxes are excluding end, so include it
-        while fromadr < toadr:
-            #print "fromto: %04x %04x" % (fromadr, toadr)
-            for seg in self.segments:
-                #print seg
-                segend = seg.startaddress + len(seg.data)
-                if seg.startaddress <= fromadr and fromadr < segend:
-                    #print "startok 0x%04x %d" % (seg.startaddress, len(seg.data))
-                    #print ("0x%04x "*3) % (segend, fromadr, toadr)
-                    if toadr > segend:   #not all data in segment
-                        #print "out of segment"
-                        catchlength = segend-fromadr
-                    else:
-                        catchlength = toadr-fromadr
-                    #print toadr-fromadr
-                    #print catchlength
-                    res = res + seg.data[fromadr-seg.startaddress : fromadr-seg.startaddress+catchlength]
-                    fromadr = fromadr + catchlength    #adjust start
-                    if len(res) >= toadr-fromadr:
-                        break#return res
-            else:
-                    res = res + chr(255)
-                    fromadr = fromadr + 1 #adjust start
-                    #print "fill FF"
-        #print "res: %r" % res
+        res = bytearray([0xff]) * (toadr - fromadr)
+        i = max(bisect.bisect_right(self.starts, fromadr) - 1, 0)
+        while i < len(self.segments) and self.starts[i] < toadr:
+            seg = self.segments[i]
+            first = max(fromadr, seg.startaddress)
+            last = min(toadr, seg.startaddress + len(seg.data))
+            if first < last:
+                res[first - fromadr : last - fromadr] = seg.data[first - seg.startaddress : last - seg.startaddress]
+            i += 1
         return res
 
 
@@ -931,10 +949,16 @@ class BootStrapLoader(LowLevel):
     #( >= 16 and == n*16 and <= MAX_DATA_BYTES!)
     MAXDATA                 = 240-16
 
+    #Differential programming: flash is erased and compared in segments
+    FLASH_START             = 0x1100 #below is RAM and information memory
+    FLASH_SEGMENT_SIZE      = 512
+    ERASE_SEGMENT           = 0xa502 #Required setting for segment erase
+
 
     def __init__(self, *args, **kargs):
         LowLevel.__init__(self, *args, **kargs)
         self.byteCtr        = 0
+        self.programCtr     = 0     # bytes sent for programming
         self.meraseCycles   = 1
         self.patchRequired  = 0
         self.patchLoaded    = 0
@@ -945,14 +969,42 @@ class BootStrapLoader(LowLevel):
         self.cpu            = None
 
         self.pwdsent        = False # password sent?
+        self.keepPasswd     = False # flash not erased, always send self.passwd
+
+        self.diffState      = None  # flash contents recorded after the last programming
+        self.diffChanged    = None  # flash segments programmed by actionProgramDiff
+
+        self.timing         = collections.OrderedDict() # phase -> seconds
+        self.phase          = None
+        self.phaseStart     = 0
+        self.progress       = None  # function(phase, done, total), bytes done of the phase
 
         self.mofs           = 0     # memory offset
         self.X              = False # MSP430X arch?
         self.nUpper         = 0     # number of "upper" segments in flash memory
 
+    def startPhase(self, phase):
+        """account the time since the previous call to the previous phase"""
+        now = time.time()
+        if self.phase is not None:
+            self.timing[self.phase] = self.timing.get(self.phase, 0) + now - self.phaseStart
+        self.phase = phase
+        self.phaseStart = now
+        if phase is not None and self.progress:
+            self.progress(phase, 0, 0)
+
+    def getTimingReport(self):
+        self.startPhase(None)
+        report = ", ".join(["%s %.2f s" % (p, t) for (p, t) in self.timing.items()])
+        report += "; total %.2f s" % sum(self.timing.values())
+        if self.timing.get("program") and self.programCtr:
+            report += "; %d bytes programmed, %.0f bytes/s" % (
+                    self.programCtr, self.programCtr / self.timing["program"])
+        return "Timing: " + report + "\n"
+
     def preparePatch(self):
         """prepare to download patch"""
-        if DEBUG > 1: sys.stderr.write("* preparePatch()\n")
+        if DEBUG > 1: self.log.write("* preparePatch()\n")
 
         if self.patchLoaded:
             #Load PC with 0x0220.
@@ -964,37 +1016,40 @@ class BootStrapLoader(LowLevel):
 
     def postPatch(self):
         """setup after the patch is loaded"""
-        if DEBUG > 1: sys.stderr.write("* postPatch()\n")
+        if DEBUG > 1: self.log.write("* postPatch()\n")
         if self.patchLoaded:
             self.BSLMemAccessWarning = 1                #Turn warning back on.
 
 
     def verifyBlk(self, addr, blkout, action):
         """verify memory against data or 0xff"""
-        if DEBUG > 1: sys.stderr.write("* verifyBlk()\n")
+        if DEBUG > 1: self.log.write("* verifyBlk()\n")
 
         if action & self.ACTION_VERIFY or action & self.ACTION_ERASE_CHECK:
-            if DEBUG: sys.stderr.write("  Check starting at 0x%04x, %d bytes ... \n" % (addr, len(blkout)))
+            if DEBUG: self.log.write("  Check starting at 0x%04x, %d bytes ... \n" % (addr, len(blkout)))
 
             self.preparePatch()
             blkin = self.bslTxRx(self.BSL_RXBLK, addr, len(blkout))
             self.postPatch()
 
-            for i in range(len(blkout)):
-                if action & self.ACTION_VERIFY:
-                    #Compare data in blkout and blkin
-                    if blkin[i] != blkout[i]:
-                        sys.stderr.write("Verification failed at 0x%04x (0x%02x, 0x%02x)\n" % (addr+i, ord(blkin[i]), ord(blkout[i])))
-                        sys.stderr.flush()
-                        raise BSLException(self.ERR_VERIFY_FAILED)      #Verify failed!
-                    continue
-                elif action & self.ACTION_ERASE_CHECK:
-                    #Compare data in blkin with erase pattern
-                    if blkin[i] != chr(0xff):
-                        sys.stderr.write("Erase Check failed at 0x%04x (0x%02x)\n" % (addr+i, ord(blkin[i])))
-                        sys.stderr.flush()
-                        raise BSLException(self.ERR_ERASE_CHECK_FAILED) #Erase Check failed!
-                    continue
+            blkin = bytearray(blkin[:len(blkout)])
+            if action & self.ACTION_VERIFY:
+                #Compare data in blkout and blkin
+                if blkin != asBinary(blkout):
+                    blkout = asBinary(blkout)
+                    i = [j for j in range(len(blkout)) if j >= len(blkin) or blkin[j] != blkout[j]][0]
+                    self.log.write("Verification failed at 0x%04x (0x%02x, 0x%02x)\n" % (
+                            addr+i, blkin[i] if i < len(blkin) else 0, blkout[i]))
+                    self.log.flush()
+                    raise BSLException(self.ERR_VERIFY_FAILED)      #Verify failed!
+            elif action & self.ACTION_ERASE_CHECK:
+                #Compare data in blkin with erase pattern
+                if blkin != bytearray([0xff]) * len(blkout):
+                    i = [j for j in range(len(blkout)) if j >= len(blkin) or blkin[j] != 0xff][0]
+                    self.log.write("Erase Check failed at 0x%04x (0x%02x)\n" % (
+                            addr+i, blkin[i] if i < len(blkin) else 0))
+                    self.log.flush()
+                    raise BSLException(self.ERR_ERASE_CHECK_FAILED) #Erase Check failed!
 
     def readBlk(self,adr,len):
         """Read a block of memory."""
@@ -1006,7 +1061,7 @@ class BootStrapLoader(LowLevel):
         """
         mofs = (addr >> 16) & 0x0f
         if mofs != self.mofs:
-            if DEBUG: sys.stderr.write("> Set mem offset to %x\n" % mofs)
+            if DEBUG: self.log.write("> Set mem offset to %x\n" % mofs)
             self.mofs = mofs
             ### the BSL documentation is wrong. in reality,
             ### the PROM does a "MOVA &addr, r15" where
@@ -1016,12 +1071,12 @@ class BootStrapLoader(LowLevel):
             ### of slaa089d should be corrected, as should
             ### the discussion on page 11.
             self.bslTxRx(self.BSL_MEMOFFSET, 0x0000, mofs)
-            if DEBUG: sys.stderr.write("> Set mem offset done\n")
+            if DEBUG: self.log.write("> Set mem offset done\n")
         return addr & 0xffff
 
     def programBlk(self, addr, blkout, action):
         """program a memory block"""
-        if DEBUG > 1: sys.stderr.write("* programBlk()\n")
+        if DEBUG > 1: self.log.write("* programBlk()\n")
 
         data = []
 
@@ -1031,9 +1086,9 @@ class BootStrapLoader(LowLevel):
         if action & self.ACTION_PROGRAM:
             if DEBUG:
                 if addr <= 0xffff:
-                    sys.stderr.write("  Program starting at 0x%04x, %i bytes ...\n" % (addr, len(blkout)))
+                    self.log.write("  Program starting at 0x%04x, %i bytes ...\n" % (addr, len(blkout)))
                 else:
-                    sys.stderr.write("  Program starting at 0x%05x, %i bytes ...\n" % (addr, len(blkout)))
+                    self.log.write("  Program starting at 0x%05x, %i bytes ...\n" % (addr, len(blkout)))
             self.preparePatch()
             # handle TOS address
             if self.amAddr and \
@@ -1041,13 +1096,13 @@ class BootStrapLoader(LowLevel):
                (self.amAddr  < addr + len(blkout)):
                 if (self.amAddr == addr + len(blkout) - 1) or \
                    (addr & 1) or (len(blkout) & 1):
-                    sys.stderr.write("ERROR amAddr straddles (goofy) block!")
+                    self.log.write("ERROR amAddr straddles (goofy) block!")
                     raise SystemExit
                 self.bslTxRx(self.BSL_AMADDRHACK, self.amAddr - addr)
             # Handle MSP430X
             naddr = self.memOffset(addr)
             if naddr != addr:
-                if DEBUG: sys.stderr.write("> Swizzle %05x -> %04x\n" % (addr, naddr))
+                if DEBUG: self.log.write("> Swizzle %05x -> %04x\n" % (addr, naddr))
                 addr = naddr
             #Program block
             self.bslTxRx(self.BSL_TXBLK, addr, len(blkout), blkout)
@@ -1061,7 +1116,9 @@ class BootStrapLoader(LowLevel):
     #segements = [ (addr1, [d0,d1,d2,...]), (addr2, [e0,e1,e2,...])]
     def programData(self, segments, action):
         """programm or verify data"""
-        if DEBUG > 1: sys.stderr.write("* programData()\n")
+        if DEBUG > 1: self.log.write("* programData()\n")
+        total = sum([len(seg.data) for seg in segments])
+        done = 0
         for seg in segments:
             currentAddr = seg.startaddress
             pstart = 0
@@ -1073,38 +1130,43 @@ class BootStrapLoader(LowLevel):
                 pstart = pstart + length
                 currentAddr = currentAddr + length
                 self.byteCtr = self.byteCtr + length #total sum
+                if action & self.ACTION_PROGRAM:
+                    self.programCtr += length
+                done += length
+                if self.progress:
+                    self.progress(self.phase, done, total)
 
     def uploadData(self, startaddress, size, wait=0):
         """upload a datablock"""
-        if DEBUG > 1: sys.stderr.write("* uploadData()\n")
-        data = ''
+        if DEBUG > 1: self.log.write("* uploadData()\n")
+        data = bytearray()
         pstart = 0
         while pstart<size:
             length = self.maxData
             if pstart+length > size:
                 length = size - pstart
-            data = data + self.bslTxRx(self.BSL_RXBLK,
-                                       pstart+startaddress,
-                                       length,
-                                       wait=wait)[:-2] #cut away checksum
+            data += self.bslTxRx(self.BSL_RXBLK,
+                                 pstart+startaddress,
+                                 length,
+                                 wait=wait)[:-2] #cut away checksum
             pstart = pstart + length
         return data
 
     def txPasswd(self, passwd=None, wait=0):
         """transmit password, default if None is given."""
-        if DEBUG > 1: sys.stderr.write("* txPassword(%r)\n" % passwd)
-        if passwd is None or self.pwdsent:
+        if DEBUG > 1: self.log.write("* txPassword(%r)\n" % passwd)
+        if passwd is None or (self.pwdsent and not self.keepPasswd):
             #Send "standard" password to get access to protected functions.
-            sys.stderr.write("Transmit default password ...\n")
-            sys.stderr.flush()
+            self.log.write("Transmit default password ...\n")
+            self.log.flush()
             #Flash is completely erased, the contents of all Flash cells is 0xff
             passwd = chr(0xff)*32
         else:
             #sanity check of password
             if len(passwd) != 32:
                 raise ValueError("password has wrong length (%d)\n" % len(passwd))
-            sys.stderr.write('Transmit password ...\n')
-            sys.stderr.flush()
+            self.log.write('Transmit password ...\n')
+            self.log.flush()
         #send the password
         self.bslTxRx(self.BSL_TXPWORD,      #Command: Transmit Password
                        0xffe0,              #Address of interupt vectors
@@ -1117,11 +1179,12 @@ class BootStrapLoader(LowLevel):
 
     def actionMassErase(self):
         """Erase the flash memory completely (with mass erase command)"""
-        sys.stderr.write("Mass Erase...\n")
-        sys.stderr.flush()
+        self.startPhase("erase")
+        self.log.write("Mass Erase...\n")
+        self.log.flush()
         self.bslReset(1)                            #Invoke the boot loader.
         for i in range(self.meraseCycles):
-            if i == 1: sys.stderr.write("Additional Mass Erase Cycles...\n")
+            if i == 1: self.log.write("Additional Mass Erase Cycles...\n")
             self.bslTxRx(self.BSL_MERAS,            #Command: Mass Erase
                                 0xff00,             #Any address within flash memory.
                                 0xa506)             #Required setting for mass erase!
@@ -1147,8 +1210,9 @@ class BootStrapLoader(LowLevel):
 
     def actionMainErase(self):
         """Erase the main flash memory only"""
-        sys.stderr.write("Main Erase...\n")
-        sys.stderr.flush()
+        self.startPhase("erase")
+        self.log.write("Main Erase...\n")
+        self.log.flush()
         self.bslTxRx(self.BSL_ERASE,                #Command: Segment Erase
                             0xfffe,                 #Any address within flash memory.
                             0xa504)                 #Required setting for main erase!
@@ -1157,14 +1221,15 @@ class BootStrapLoader(LowLevel):
 
     def actionStartBSL(self, usepatch=1, adjsp=1, replacementBSL=None, forceBSL=0, mayuseBSL=0, speed=None, bslreset=1):
         """start BSL, download patch if desired and needed, adjust SP if desired"""
-        sys.stderr.write("Invoking BSL...\n")
-        sys.stderr.flush()
+        self.startPhase("sync")
+        self.log.write("Invoking BSL...\n")
+        self.log.flush()
         if bslreset:
             self.bslReset(1)                        #Invoke the boot loader.
         self.txPasswd(self.passwd)                  #transmit password
 
         #Read actual bootstrap loader version.
-        #sys.stderr.write("Reading BSL version ...\n")
+        #self.log.write("Reading BSL version ...\n")
         blkin = self.bslTxRx(self.BSL_RXBLK,        #Command: Read/Receive Block
                           0x0ff0,                   #Start address
                           16)                       #No. of bytes to read
@@ -1174,13 +1239,13 @@ class BootStrapLoader(LowLevel):
             if dev_id in deviceids:
                 self.cpu = deviceids[dev_id]        #try to autodectect CPU type
                 if DEBUG:
-                    sys.stderr.write("Autodetect successful: %04x -> %s\n" % (dev_id, self.cpu))
+                    self.log.write("Autodetect successful: %04x -> %s\n" % (dev_id, self.cpu))
             else:
-                sys.stderr.write("Autodetect failed! Unkown ID: %04x. Trying to continue anyway.\n" % dev_id)
+                self.log.write("Autodetect failed! Unkown ID: %04x. Trying to continue anyway.\n" % dev_id)
                 self.cpu = F1x                      #assume something and try anyway..
 
-        sys.stderr.write("Current bootstrap loader version: %x.%x (Device ID: %04x)\n" % (bslVerHi, bslVerLo, dev_id))
-        sys.stderr.flush()
+        self.log.write("Current bootstrap loader version: %x.%x (Device ID: %04x)\n" % (bslVerHi, bslVerLo, dev_id))
+        self.log.flush()
         self.bslVer = (bslVerHi << 8) | bslVerLo
 
         if self.bslVer <= 0x0110:                   #check if patch is needed
@@ -1195,7 +1260,7 @@ class BootStrapLoader(LowLevel):
             #Execute function within bootstrap loader
             #to prepare stack pointer for the following patch.
             #This function will lock the protected functions again.
-            sys.stderr.write("Adjust SP. Load PC with 0x0C22 ...\n")
+            self.log.write("Adjust SP. Load PC with 0x0C22 ...\n")
             self.bslTxRx(self.BSL_LOADPC,           #Command: Load PC
                                 0x0C22)             #Address to load into PC
             #Re-send password to re-gain access to protected functions.
@@ -1208,14 +1273,14 @@ class BootStrapLoader(LowLevel):
             replacementBSL = Memory() #File to program
             if self.cpu == F4x:
                 if DEBUG:
-                    sys.stderr.write("Using built in BSL replacement for F4x devices\n")
-                    sys.stderr.flush()
-                replacementBSL.loadTIText(io.StringIO(F4X_BSL))  #parse embedded BSL
+                    self.log.write("Using built in BSL replacement for F4x devices\n")
+                    self.log.flush()
+                replacementBSL.loadTITextString(F4X_BSL)  #parse embedded BSL
             else:
                 if DEBUG:
-                    sys.stderr.write("Using built in BSL replacement for F1x devices\n")
-                    sys.stderr.flush()
-                replacementBSL.loadTIText(io.StringIO(F1X_BSL))  #parse embedded BSL
+                    self.log.write("Using built in BSL replacement for F1x devices\n")
+                    self.log.flush()
+                replacementBSL.loadTITextString(F1X_BSL)  #parse embedded BSL
     
         #now download the new BSL, if allowed and needed (version lower than the
         #the replacement) or forced
@@ -1224,38 +1289,38 @@ class BootStrapLoader(LowLevel):
 
         #debug message with the real BSL version in use (may have changed after replacement BSL)
         if DEBUG:
-            sys.stderr.write("Current bootstrap loader version: 0x%04x\n" % (self.bslVer,))
-            sys.stderr.flush()
+            self.log.write("Current bootstrap loader version: 0x%04x\n" % (self.bslVer,))
+            self.log.flush()
 
         #now apply workarounds or patches if BSL in use requires that
         if self.bslVer <= 0x0110:                   #check if patch is needed
             if usepatch:                            #test if patch is desired
-                sys.stderr.write("Patch for flash programming required!\n")
+                self.log.write("Patch for flash programming required!\n")
                 self.patchRequired = 1
 
-                sys.stderr.write("Load and verify patch ...\n")
-                sys.stderr.flush()
+                self.log.write("Load and verify patch ...\n")
+                self.log.flush()
                 #Programming and verification is done in one pass.
                 #The patch file is only read and parsed once.
                 segments = Memory()                     #data to program
-                segments.loadTIText(io.StringIO(PATCH))  #parse embedded patch
+                segments.loadTITextString(PATCH)  #parse embedded patch
                 #program patch
                 self.programData(segments, self.ACTION_PROGRAM | self.ACTION_VERIFY)
                 self.patchLoaded = 1
             else:
                 if DEBUG:
-                    sys.stderr.write("Device needs patch, but not applied (usepatch is false).\n")    #message if not patched
+                    self.log.write("Device needs patch, but not applied (usepatch is false).\n")    #message if not patched
 
         #should the baudrate be changed?
         if speed is not None:
             self.actionChangeBaudrate(speed)            #change baudrate
 
     def actionDownloadBSL(self, bslsegments):
-        sys.stderr.write("Load new BSL into RAM...\n")
-        sys.stderr.flush()
+        self.log.write("Load new BSL into RAM...\n")
+        self.log.flush()
         self.programData(bslsegments, self.ACTION_PROGRAM)
-        sys.stderr.write("Verify new BSL...\n")
-        sys.stderr.flush()
+        self.log.write("Verify new BSL...\n")
+        self.log.flush()
         self.programData(bslsegments, self.ACTION_VERIFY) #File to verify
 
         #Read startvector of bootstrap loader
@@ -1264,8 +1329,8 @@ class BootStrapLoader(LowLevel):
         blkin = self.bslTxRx(self.BSL_RXBLK, bslsegments[0].startaddress, 2)
         startaddr = struct.unpack("<H", blkin[:2])[0]
 
-        sys.stderr.write("Starting new BSL at 0x%04x...\n" % startaddr)
-        sys.stderr.flush()
+        self.log.write("Starting new BSL at 0x%04x...\n" % startaddr)
+        self.log.flush()
         self.bslTxRx(self.BSL_LOADPC,  #Command: Load PC
                      startaddr)        #Address to load into PC
 
@@ -1284,8 +1349,9 @@ class BootStrapLoader(LowLevel):
 
     def actionEraseCheck(self):
         """check the erasure of required flash cells."""
-        sys.stderr.write("Erase Check by file ...\n")
-        sys.stderr.flush()
+        self.startPhase("erase check")
+        self.log.write("Erase Check by file ...\n")
+        self.log.flush()
         if self.data is not None:
             self.programData(self.data, self.ACTION_ERASE_CHECK)
         else:
@@ -1293,37 +1359,156 @@ class BootStrapLoader(LowLevel):
 
     def actionProgram(self):
         """program data into flash memory."""
+        self.startPhase("program")
         if self.data is not None:
-            sys.stderr.write("Program ...\n")
-            sys.stderr.flush()
+            self.log.write("Program ...\n")
+            self.log.flush()
             self.programData(self.data, self.ACTION_PROGRAM)
-            sys.stderr.write("%i bytes programmed.\n" % self.byteCtr)
-            sys.stderr.flush()
+            self.log.write("%i bytes programmed.\n" % self.byteCtr)
+            self.log.flush()
         else:
             raise BSLException("programming without data not possible")
 
     def actionVerify(self):
         """Verify programmed data"""
+        self.startPhase("verify")
         if self.data is not None:
-            sys.stderr.write("Verify ...\n")
-            sys.stderr.flush()
+            self.log.write("Verify ...\n")
+            self.log.flush()
             self.programData(self.data, self.ACTION_VERIFY)
         else:
             raise BSLException("verify without data not possible")
 
     def actionReset(self):
         """perform a reset, start user programm"""
-        sys.stderr.write("Reset device ...\n")
-        sys.stderr.flush()
+        self.startPhase("reset")
+        self.log.write("Reset device ...\n")
+        self.log.flush()
         self.bslReset(0) #only reset
 
     def actionRun(self, address=0x220):
         """start program at specified address"""
-        sys.stderr.write("Load PC with 0x%04x ...\n" % address)
-        sys.stderr.flush()
+        self.log.write("Load PC with 0x%04x ...\n" % address)
+        self.log.flush()
         self.bslTxRx(self.BSL_LOADPC, #Command: Load PC
                             address)  #Address to load into PC
 
+    #-----------------------------------------------------------------
+    # Differential programming: the digest of every flash segment written is
+    # recorded after programming; next time only the segments whose digest
+    # differs are erased and programmed. The recorded interrupt vectors are
+    # the password, as the flash is not mass erased. The programmed segments
+    # are verified afterwards, the whole image only if asked (--verify).
+
+    def getFlashSegments(self, memory):
+        """start address -> digest of each flash segment holding data of memory.
+        None if memory has data outside the flash."""
+        size = self.FLASH_SEGMENT_SIZE
+        starts = set()
+        for seg in memory:
+            if not len(seg):
+                continue
+            if seg.startaddress < self.FLASH_START:
+                return None
+            addr = seg.startaddress - seg.startaddress % size
+            end = seg.startaddress + len(seg)
+            while addr < end:
+                #the first segment may start in the middle (0x1100 on F1x)
+                starts.add(max(addr, self.FLASH_START))
+                addr += size
+        segments = {}
+        for start in starts:
+            end = start - start % size + size - 1
+            segments[start] = hashlib.md5(asBytes(memory.getMemrange(start, end))).hexdigest()
+        return segments
+
+    def getSegmentData(self, starts):
+        """data of self.data in the given flash segments, as a list of Segment"""
+        size = self.FLASH_SEGMENT_SIZE
+        result = []
+        for start in sorted(starts):
+            end = start - start % size + size
+            for seg in self.data:
+                first = max(start, seg.startaddress)
+                last = min(end, seg.startaddress + len(seg))
+                if first >= last:
+                    continue
+                data = seg.data[first - seg.startaddress : last - seg.startaddress]
+                if result and result[-1].startaddress + len(result[-1]) == first:
+                    #continuous with the previous one, send in the same frames
+                    result[-1].data += data
+                else:
+                    result.append(Segment(first, data))
+        return result
+
+    def loadFlashState(self, filename):
+        """read the state saved by saveFlashState(), None if not usable"""
+        try:
+            with open(filename, "r") as f:
+                state = json.load(f)
+            segments = dict([(int(k, 16), v) for (k, v) in state["segments"].items()])
+            passwd = binascii.unhexlify(state["vectors"])
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+        if len(passwd) != 32:
+            return None
+        return {"segments": segments, "vectors": passwd}
+
+    def saveFlashState(self, filename):
+        """record what was programmed from self.data"""
+        segments = self.getFlashSegments(self.data)
+        if segments is None:
+            return
+        state = {
+            "segments": dict([("%x" % k, v) for (k, v) in segments.items()]),
+            "vectors": binascii.hexlify(asBytes(self.data.getMemrange(0xffe0, 0xffff))).decode("ascii"),
+        }
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmpname = filename + ".tmp"
+        with open(tmpname, "w") as f:
+            json.dump(state, f)
+        if os.name == "nt" and os.path.exists(filename):
+            os.remove(filename)
+        os.rename(tmpname, filename)
+
+    def eraseSegment(self, addr):
+        """erase one flash segment"""
+        if DEBUG: self.log.write("  Erase segment at 0x%05x\n" % addr)
+        naddr = self.memOffset(addr)
+        self.bslTxRx(self.BSL_ERASE,                #Command: Segment Erase
+                     naddr,                         #Any address within the segment
+                     self.ERASE_SEGMENT)
+
+    def actionProgramDiff(self):
+        """erase and program only the flash segments that differ from the last programming"""
+        if self.data is None:
+            raise BSLException("programming without data not possible")
+        old = self.diffState["segments"]
+        new = self.getFlashSegments(self.data)
+        changed = sorted([a for a in set(old) | set(new) if old.get(a) != new.get(a)])
+        self.log.write("Program %d of %d flash segments (unchanged ones skipped) ...\n" % (
+                len(changed), len(new)))
+        self.log.flush()
+        self.startPhase("erase")
+        for addr in changed:
+            self.eraseSegment(addr)
+        self.startPhase("program")
+        self.programData(self.getSegmentData(changed), self.ACTION_PROGRAM)
+        self.memOffset(0x00000)
+        self.diffChanged = changed
+        self.log.write("%i bytes programmed.\n" % self.byteCtr)
+        self.log.flush()
+
+    def actionVerifyDiff(self):
+        """verify the segments programmed by actionProgramDiff"""
+        self.startPhase("verify")
+        self.log.write("Verify programmed segments ...\n")
+        self.log.flush()
+        self.programData(self.getSegmentData(self.diffChanged), self.ACTION_VERIFY)
+        self.memOffset(0x00000)
+
     #table with values from slaa089a.pdf
     bauratetable = {
         F1x: {
@@ -1356,8 +1541,8 @@ class BootStrapLoader(LowLevel):
         except KeyError:
             raise ValueError("baudrate not valid. valid values are %r" % list(baudconfigs.keys()))
         
-        sys.stderr.write("Changing baudrate to %d ...\n" % baudrate)
-        sys.stderr.flush()
+        self.log.write("Changing baudrate to %d ...\n" % baudrate)
+        self.log.flush()
         self.bslTxRx(self.BSL_CHANGEBAUD,   #Command: change baudrate
                     a, l)                   #args are coded in adr and len
         time.sleep(0.010)                   #recomended delay
@@ -1444,6 +1629,16 @@ General options:
                         in the device would have the required features)
   --slow                Add delays when operating the conrol pins. Useful if
                         the pins/circuit has high capacitance.
+  --diff                Differential programming: erase and program only
+                        the flash segments that changed since the last
+                        programming of the device (by USB serial number,
+                        else port) with --diff, and verify them (with -v,
+                        the whole image). Falls back to mass erase when
+                        that is not known or the verification fails.
+  --diff-state=dir      Where --diff keeps the record of the programmed
+                        data (default ~/.mansos/bsl-state)
+  --timing              Print the time spent in each phase (sync, erase,
+                        program, verify) at the end.
 
 Program Flow Specifiers:
   -e, --masserase       Mass Erase (clear all flash memory)
@@ -1485,7 +1680,9 @@ def hexify(line, bytes, width=16):
         ('%c'*len(bytes)) % tuple([(x>=32 and x<127) and x or ord('.') for x in bytes])
         )
 
-def parseCommandLine():
+def parseCommandLine(argv = None):
+    """parse the command line options (default: sys.argv[1:]);
+    calls sys.exit() if they are not valid"""
     global DEBUG
     import getopt
     filetype    = None
@@ -1508,9 +1705,13 @@ def parseCommandLine():
     forceBSL    = 0
     dumpivt     = 0
     dumpinfo    = 0
+    diff        = 0
+    timing      = 0
+    stateDir    = os.path.join(os.path.expanduser("~"), ".mansos", "bsl-state")
  
     try:
-        opts, args = getopt.getopt(sys.argv[1:],
+        if argv is None: argv = sys.argv[1:]
+        opts, args = getopt.getopt(argv,
             "hc:P:wf:m:eEpvrg:UDudsxbITNB:S:V14",
             ["help", "comport=", "password=", "wait", "framesize=",
              "erasecycles=", "masserase", "erasecheck", "program",
@@ -1520,7 +1721,7 @@ def parseCommandLine():
              "bslversion", "f1x", "f4x", "invert-reset", "invert-test",
              "swap-reset-test", "telos-latch", "telos-i2c", "telos", "telosb",
              "tmote", "tmote2618", "no-BSL-download", "force-BSL-download", "slow",
-             "z1", "mainerase", "local-addr="]
+             "z1", "mainerase", "local-addr=", "diff", "diff-state=", "timing"]
         )
     except getopt.GetoptError:
         # print help information and exit:
@@ -1695,6 +1896,12 @@ def parseCommandLine():
             forceBSL = 1
         elif o in ("--slow", ):
             bsl.slowmode = 1
+        elif o in ("--diff", ):
+            diff = 1
+        elif o in ("--diff-state", ):
+            stateDir = a
+        elif o in ("--timing", ):
+            timing = 1
 
     if len(args) == 0:
         sys.stderr.write("Use -h for help\n")
@@ -1728,12 +1935,65 @@ def parseCommandLine():
             mayuseBSL,
             forceBSL,
             dumpivt,
-            dumpinfo)
-
-#Main:
-def main():
-    sys.stderr.write("MSP430 Bootstrap Loader Version: %s\n" % VERSION)
-
+            dumpinfo,
+            diff,
+            stateDir,
+            timing)
+
+def getUsbSerialNumber(comPort):
+    """serial number of the USB device on comPort (Linux sysfs), None if not known"""
+    name = os.path.basename(os.path.realpath(str(comPort)))
+    path = os.path.realpath(os.path.join("/sys/class/tty", name, "device"))
+    #up from the USB interface to the device it belongs to
+    while path.startswith("/sys/devices/"):
+        if os.path.exists(os.path.join(path, "idVendor")):
+            try:
+                with open(os.path.join(path, "serial"), "r") as f:
+                    return f.read().strip() or None
+            except (IOError, OSError):
+                return None
+        path = os.path.dirname(path)
+    return None
+
+def getStateFilename(stateDir, comPort):
+    """file with the --diff record of the device on comPort.
+    Port names are reused for other devices, so the USB serial number is used if known."""
+    serialNumber = getUsbSerialNumber(comPort)
+    if serialNumber:
+        name = "usb-" + serialNumber
+    else:
+        name = str(comPort)
+    return os.path.join(stateDir, re.sub(r"[^\w.-]", "_", name) + ".json")
+
+#images loaded by loadImage, by file name
+imageCache = collections.OrderedDict()
+imageCacheLock = threading.Lock()
+IMAGE_CACHE_SIZE = 8
+
+def loadImage(filename):
+    """return the Memory with the contents of the file; the file is parsed
+    only once, while it does not change. The Memory must not be modified."""
+    st = os.stat(filename)
+    key = os.path.abspath(filename)
+    with imageCacheLock:
+        entry = imageCache.pop(key, None)
+        if entry is not None and entry[0] == (st.st_mtime, st.st_size):
+            imageCache[key] = entry
+            return entry[1]
+    memory = Memory(filename)
+    with imageCacheLock:
+        imageCache[key] = ((st.st_mtime, st.st_size), memory)
+        while len(imageCache) > IMAGE_CACHE_SIZE:
+            imageCache.popitem(last = False)
+    return memory
+
+def execute(cmdLine, data = None, log = None, progress = None):
+    """do what the command line (as returned by parseCommandLine) says.
+    data: Memory to use instead of loading the file given on the command line;
+    log: file-like object for the messages (default sys.stderr);
+    progress: function(phase, done, total) called as the work goes on.
+    Returns the uploaded data if --upload is given, else None.
+    Raises BSLException (or serial port errors) on failure."""
     (filename,
      filetype,
      comPort,
@@ -1753,66 +2013,103 @@ def main():
      mayuseBSL,
      forceBSL,
      dumpivt,
-     dumpinfo) = parseCommandLine()
- 
+     dumpinfo,
+     diff,
+     stateDir,
+     timing) = cmdLine
+
+    if log is None: log = sys.stderr
+    bsl.log = log
+    bsl.progress = progress
+
     if DEBUG:   #debug infos
-        sys.stderr.write("Debug level set to %d\n" % DEBUG)
-        sys.stderr.write("Python version: %s\n" % sys.version)
+        log.write("Debug level set to %d\n" % DEBUG)
+        log.write("Python version: %s\n" % sys.version)
 
     #sanity check of options
     if notimeout and goaddr is not None and startaddr is not None:
-        sys.stderr.write("Option --notimeout can not be used together with both --upload and --go\n")
-        sys.exit(1)
+        raise BSLException("Option --notimeout can not be used together with both --upload and --go")
 
     if notimeout:
-        sys.stderr.write("Warning: option --notimeout can cause improper function in some cases!\n")
+        log.write("Warning: option --notimeout can cause improper function in some cases!\n")
         bsl.timeout = 0
 
     if goaddr and reset:
-        sys.stderr.write("Warning: option --reset ignored as --go is specified!\n")
+        log.write("Warning: option --reset ignored as --go is specified!\n")
         reset = 0
 
     if startaddr and reset:
-        sys.stderr.write("Warning: option --reset ignored as --upload is specified!\n")
+        log.write("Warning: option --reset ignored as --upload is specified!\n")
         reset = 0
 
-    sys.stderr.flush()
+    log.flush()
     
     #prepare data to download
-    bsl.data = Memory()                             #prepare downloaded data
-    if filetype is not None:                        #if the filetype is given...
-        if filename is None:
-            raise ValueError("no filename but filetype specified")
-        if filename == '-':                         #get data from stdin
-            file = sys.stdin
+    if data is not None:                            #already loaded by the caller
+        bsl.data = data
+    else:
+        bsl.data = Memory()                         #prepare downloaded data
+        if filetype is not None:                    #if the filetype is given...
+            if filename is None:
+                raise ValueError("no filename but filetype specified")
+            if filename == '-':                     #get data from stdin
+                file = sys.stdin
+            else:
+                file = open(filename, "rb")         #or from a file
+            if filetype == 0:                       #select load function
+                bsl.data.loadIHex(file)             #intel hex
+            elif filetype == 1:
+                bsl.data.loadTIText(file)           #TI's format
+            else:
+                raise ValueError("illegal filetype specified")
+        else:                                       #no filetype given...
+            if filename == '-':                     #for stdin:
+                bsl.data.loadIHex(sys.stdin)        #assume intel hex
+            elif filename:
+                bsl.data.loadFile(filename)         #autodetect otherwise
+
+    if DEBUG > 3: log.write("File: %r" % filename)
+
+    #differential programming: replace mass erase and programming
+    #of the whole image if what is in the flash is known
+    fullToinit = list(toinit)
+    fullTodo = list(todo)
+    stateFilename = None
+    if diff and filename and bsl.actionProgram in todo:
+        stateFilename = getStateFilename(stateDir, comPort)
+        if bsl.getFlashSegments(bsl.data) is None:
+            log.write("Image has data outside the flash, differential programming not possible\n")
         else:
-            file = open(filename, "rb")             #or from a file
-        if filetype == 0:                           #select load function
-            bsl.data.loadIHex(file)                 #intel hex
-        elif filetype == 1:
-            bsl.data.loadTIText(file)               #TI's format
+            bsl.diffState = bsl.loadFlashState(stateFilename)
+        if bsl.actionMassErase not in fullToinit:
+            fullToinit.insert(0, bsl.actionMassErase)
+        if bsl.diffState is None:
+            toinit, todo = fullToinit, fullTodo
         else:
-            raise ValueError("illegal filetype specified")
-    else:                                           #no filetype given...
-        if filename == '-':                         #for stdin:
-            bsl.data.loadIHex(sys.stdin)            #assume intel hex
-        elif filename:
-            bsl.data.loadFile(filename)             #autodetect otherwise
-
-    if DEBUG > 3: sys.stderr.write("File: %r" % filename)
-
-    bsl.comInit(comPort)                            #init port
-
-    #initialization list
-    if toinit:  #erase and erase check
-        if DEBUG: sys.stderr.write("Preparing device ...\n")
-        #bsl.actionStartBSL(usepatch=0, adjsp=0)     #no workarounds needed
-        #if speed: bsl.actionChangeBaudrate(speed)   #change baud rate as fast as possible
-        for f in toinit: f()
-
-    if todo or goaddr or startaddr:
-        if DEBUG: sys.stderr.write("Actions ...\n")
-        #connect to the BSL
+            bsl.passwd = bsl.diffState["vectors"]
+            bsl.keepPasswd = True
+            toinit = [f for f in toinit if f != bsl.actionMassErase and f != bsl.actionEraseCheck]
+            #the programmed segments are always verified, the whole image if asked
+            i = todo.index(bsl.actionProgram)
+            if bsl.actionVerify in todo:
+                todo[i] = bsl.actionProgramDiff
+            else:
+                todo[i:i + 1] = [bsl.actionProgramDiff, bsl.actionVerifyDiff]
+    #the record is not valid while the flash is being changed, with or without --diff
+    if stateFilename or bsl.actionProgram in todo or bsl.actionMainErase in todo \
+            or bsl.actionMassErase in toinit:
+        oldStateFilename = stateFilename or getStateFilename(stateDir, comPort)
+        if os.path.exists(oldStateFilename):
+            os.remove(oldStateFilename)
+
+    def startFull():
+        """give up differential programming: mass erase and connect again"""
+        bsl.diffState = None
+        bsl.keepPasswd = False
+        bsl.pwdsent = False
+        bsl.passwd = None
+        bsl.serialport.setBaudrate(9600)
+        for f in fullToinit: f()
         bsl.actionStartBSL(
             usepatch=not unpatched,
             replacementBSL=bslrepl,
@@ -1821,49 +2118,118 @@ def main():
             speed=speed,
         )
 
-    #work list
-    if todo:
-        if DEBUG > 0:       #debug
-            #show a nice list of sheduled actions
-            sys.stderr.write("TODO list:\n")
-            for f in todo:
-                try:
-                    sys.stderr.write("   %s\n" % f.__name__)
-                except AttributeError:
-                    sys.stderr.write("   %r\n" % f)
-        for f in todo: f()                          #work through todo list
-
-    if reset:                                       #reset device first if desired
-        bsl.actionReset()
-
-    if goaddr is not None:                          #start user programm at specified address
-        bsl.actionRun(goaddr)                       #load PC and execute
-
-    #upload datablock and output
-    if startaddr is not None:
-        if goaddr:                                  #if a program was started...
-            #don't restart BSL but wait for the device to enter it itself
-            sys.stderr.write("Waiting for device to reconnect for upload: ")
-            sys.stderr.flush()
-            bsl.txPasswd(bsl.passwd, wait=1)        #synchronize, try forever...
-            data = bsl.uploadData(startaddr, size)  #upload data
-        else:
-            data = bsl.uploadData(startaddr, size)  #upload data
+    bsl.startPhase("open")
+    bsl.comInit(comPort)                            #init port
+    try:
+        uploaded = None
+
+        #initialization list
+        if toinit:  #erase and erase check
+            if DEBUG: log.write("Preparing device ...\n")
+            #bsl.actionStartBSL(usepatch=0, adjsp=0)     #no workarounds needed
+            #if speed: bsl.actionChangeBaudrate(speed)   #change baud rate as fast as possible
+            for f in toinit: f()
+
+        if todo or goaddr or startaddr:
+            if DEBUG: log.write("Actions ...\n")
+            #connect to the BSL
+            try:
+                bsl.actionStartBSL(
+                    usepatch=not unpatched,
+                    replacementBSL=bslrepl,
+                    forceBSL=forceBSL,
+                    mayuseBSL=mayuseBSL,
+                    speed=speed,
+                )
+            except BSLException as e:
+                if bsl.diffState is None or str(e) != bsl.ERR_RX_NAK: raise
+                #the recorded vectors are not the password: not the same device or flash
+                log.write("Password not accepted, falling back to mass erase\n")
+                startFull()
+                toinit, todo = fullToinit, fullTodo
+
+        #work list
+        if todo:
+            if DEBUG > 0:       #debug
+                #show a nice list of sheduled actions
+                log.write("TODO list:\n")
+                for f in todo:
+                    try:
+                        log.write("   %s\n" % f.__name__)
+                    except AttributeError:
+                        log.write("   %r\n" % f)
+            try:
+                for f in todo: f()                  #work through todo list
+            except BSLException as e:
+                if bsl.diffState is None: raise
+                #the flash did not hold what was recorded
+                log.write("Differential programming failed (%s), falling back to mass erase\n" % e)
+                startFull()
+                toinit, todo = fullToinit, fullTodo
+                for f in todo: f()
+            if stateFilename:
+                bsl.saveFlashState(stateFilename)   #for the next --diff
+
+        if reset:                                   #reset device first if desired
+            bsl.actionReset()
+
+        if goaddr is not None:                      #start user programm at specified address
+            bsl.actionRun(goaddr)                   #load PC and execute
+
+        #upload datablock
+        if startaddr is not None:
+            if goaddr:                              #if a program was started...
+                #don't restart BSL but wait for the device to enter it itself
+                log.write("Waiting for device to reconnect for upload: ")
+                log.flush()
+                bsl.txPasswd(bsl.passwd, wait=1)    #synchronize, try forever...
+            uploaded = bsl.uploadData(startaddr, size) #upload data
+            wait = 0    #wait makes no sense as after the upload the device is still in BSL
+
+        if wait:                                    #wait at the end if desired
+            log.write("Press <ENTER> ...\n")       #display a prompt
+            log.flush()
+            input()                                 #wait for newline
+    finally:
+        bsl.comDone()       #Release serial communication port
+
+    if timing:
+        log.write(bsl.getTimingReport())
+    return uploaded
+
+def flash(port, image, options = (), progress = None, log = None):
+    """program an image into the device on the serial port, in-process.
+    image: file name (parsed once while it does not change) or a Memory;
+    options: command line options other than the port and the file name,
+    e.g. ["--tmote2618", "-e", "-r", "-I"];
+    progress, log: see execute(). Raises BSLException on failure."""
+    try:
+        cmdLine = parseCommandLine(list(options) + ["-c", str(port), "image"])
+    except SystemExit:
+        raise BSLException("invalid options: %s" % " ".join(options))
+    if not isinstance(image, Memory):
+        image = loadImage(image)
+    execute(cmdLine, image, log, progress)
+
+#Main:
+def main():
+    sys.stderr.write("MSP430 Bootstrap Loader Version: %s\n" % VERSION)
+
+    cmdLine = parseCommandLine()
+    startaddr = cmdLine[11]
+    hexoutput = cmdLine[13]
+
+    data = execute(cmdLine)
+
+    #output the uploaded data
+    if data is not None:
         if hexoutput:                               #depending on output format
             m = 0
             while m < len(data):                    #print a hex display
-                print(hexify(startaddr+m, list(map(ord,data[m:m+16]))))
+                print(hexify(startaddr+m, list(data[m:m+16])))
                 m = m + 16
         else:
-            sys.stdout.write(data)                  #binary output w/o newline!
-        wait = 0    #wait makes no sense as after the upload the device is still in BSL
-
-    if wait:                                        #wait at the end if desired
-        sys.stderr.write("Press <ENTER> ...\n")     #display a prompt
-        sys.stderr.flush()
-        input()                                 #wait for newline
-
-    bsl.comDone()           #Release serial communication port
+            getattr(sys.stdout, "buffer", sys.stdout).write(bytes(data)) #binary output w/o newline!
 
 
 if __name__ == '__main__':
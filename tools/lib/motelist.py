@@ -3,8 +3,11 @@
 import os, sys, threading, time, serial, itertools, urllib2
 import configfile
 
+HotplugWatcher = None
+
 if os.name == 'posix':
     from motelist_src.get_ports_linux import comports  # @UnusedImport
+    from motelist_src.hotplug_linux import HotplugWatcher
 elif os.name == "cygwin":
     from motelist_src.get_ports_cygwin import comports  # @Reimport @UnusedImport
 elif os.name == "nt":
@@ -15,6 +18,16 @@ else:
     print ("Your OS ('{}') is not supported!".format(os.name))
     exit()
 
+# how often to look for motes if plug in events are not available,
+# and how often remote servers are asked for their motes
+POLL_INTERVAL = 1
+# how often to rescan anyway if they are
+RESCAN_INTERVAL = 30
+# seconds to wait for a remote server to answer
+REMOTE_TIMEOUT = 2
+# motes of a remote server that does not answer are kept this many seconds
+REMOTE_MAX_AGE = 30
+
 # Unified way of accessing motes
 class Mote(object):
     def __init__(self, mote, manualyAdded = False):
@@ -94,19 +107,22 @@ class Mote(object):
     def getReference(self):
         return self.__reference
 
+    # (host, port) identifies the mote; "Local" and the URL scheme do not matter,
+    # and on Windows neither does the case of the port name
+    def getKey(self):
+        host = self.getHost()
+        if host == "Local": host = ""
+        if host.find("://") != -1: host = host[host.find("://") + 3:]
+        return (host, os.path.normcase(self.getPort() or ""))
+
     def cmp(self, other):
-        host1 = self.getHost()
-        host2 = other.getHost()
-        if host1 == "Local": host1 = ""
-        if host2 == "Local": host2 = ""
-        if host1.find("://") != -1: host1 = host1[host1.find("://") + 3:]
-        if host2.find("://") != -1: host2 = host2[host2.find("://") + 3:]
-        if host1 == host2:
-            if self.getPort() == other.getPort(): return 0
-            if self.getPort() < other.getPort(): return -1
-            return 1
-        if host1 < host2: return -1
+        key1 = self.getKey()
+        key2 = other.getKey()
+        if key1 == key2: return 0
+        if key1 < key2: return -1
         return 1
+    def __hash__(self):
+        return hash(self.getKey())
     def __lt__(self, other):
          return self.cmp(other) < 0
     def __gt__(self, other):
@@ -143,11 +159,21 @@ def getRemoteServers():
     return retVal
     
 class Motelist(object):
-    motes = list()
+    # key -> Mote, see Mote.getKey()
+    motes = dict()
+    sortedMotes = list()
     lock = threading.Lock()
     updateCallbacks = list()
+    # called with lists of added and removed motes
+    changeCallbacks = list()
     remoteServerList = getRemoteServers()
     infinite = False
+    # last motes received from each remote server, with the time and ETag
+    remoteMotes = dict()
+    remoteLock = threading.Lock()
+    remoteFetching = set() # hosts being asked
+    remoteFailing = set()  # hosts that did not answer the last time
+    rescanLock = threading.RLock()
 
     @staticmethod
     def initialize(updateCallbacks, startPeriodicUpdate = False, onlyLocalMotes = False):
@@ -167,91 +193,176 @@ class Motelist(object):
     
     @staticmethod
     def addMote(port, name, reference):
-        Motelist.lock.acquire()
+        newMote = Mote([port, name, reference], True)
 
-        portFound = not Motelist.portExists(port)
+        Motelist.lock.acquire()
 
-        for mote in Motelist.motes:
-            if mote.getPort().lower() == port.lower():
-                portFound = True
-                break
+        portFound = newMote.getKey() in Motelist.motes or not Motelist.portExists(port)
 
         if not portFound:
-            Motelist.motes.append(Mote([port, name, reference], True))
+            Motelist.motes[newMote.getKey()] = newMote
+            Motelist.sortedMotes = sorted(Motelist.motes.values())
 
         Motelist.lock.release()
         if not portFound:
-            Motelist.__activateCallbacks(True)
+            Motelist.__activateCallbacks(True, [newMote])
 
         return not portFound
 
+    # Forget all motes, including the ones added by the user
     @staticmethod
-    def recreateMoteList(iterator):
+    def clear():
         Motelist.lock.acquire()
+        Motelist.motes = dict()
+        Motelist.sortedMotes = list()
+        Motelist.lock.release()
 
-        newMotes = list()
-        haveNewMote = False
-       
-        for host in Motelist.remoteServerList:
-            iterator = itertools.chain(iterator, Motelist.getRemoteMotelist(host))
+    # Replace the motes with those from the iterator, keeping the ones added by the user;
+    # return lists of added and removed motes
+    @staticmethod
+    def recreateMoteList(iterator):
+        newMotes = dict()
 
         for mote in iterator:
             # this filters out fake motes on linux, i hope!
             if mote[2] == "n/a":
                 continue
-                
+
             newMote = Mote(mote)
-    
-            for m in newMotes:
-                if newMote == m:
-                    newMote = None
-                    break;
-            
-            if newMote is None:
-                continue
-                
-            # Add if no such mote exists, point to it otherwise
-            if newMote not in Motelist.motes:
-                newMotes.insert(0, newMote)
-                haveNewMote = True
+            key = newMote.getKey()
+            # the first one of duplicates wins
+            if key not in newMotes:
+                newMotes[key] = newMote
+
+        Motelist.lock.acquire()
+
+        oldMotes = Motelist.motes
+        added = list()
+        for key in newMotes:
+            if key in oldMotes:
+                # point to the existing mote, it may have user data
+                newMotes[key] = oldMotes[key]
             else:
-                newMotes.insert(0, Motelist.motes[Motelist.motes.index(newMote)])
+                added.append(newMotes[key])
 
-        for mote in Motelist.motes:
-            if mote.isUserMote() and mote not in newMotes:
-                newMotes.append(mote)
-        
-        haveNewMote = haveNewMote or not len(Motelist.motes) == len(newMotes)
+        removed = list()
+        for key, mote in oldMotes.items():
+            if key in newMotes:
+                continue
+            if mote.isUserMote():
+                newMotes[key] = mote
+            else:
+                removed.append(mote)
 
-        Motelist.motes = sorted(newMotes)
+        Motelist.motes = newMotes
+        if added or removed:
+            Motelist.sortedMotes = sorted(newMotes.values())
 
         Motelist.lock.release()
 
-        return haveNewMote
+        return (sorted(added), sorted(removed))
 
+    @staticmethod
+    def getCachedRemoteMotelist(host):
+        with Motelist.remoteLock:
+            cached = Motelist.remoteMotes.get(host)
+            if cached is None or time.time() - cached[1] > REMOTE_MAX_AGE:
+                return list()
+            return list(cached[0])
+
+    # Ask the remote server for its motes; the cached list is used
+    # if it has not changed or the server does not answer
     @staticmethod
     def getRemoteMotelist(host):
-        retVal = list()
+        retVal = None
 
         if host.find("://") == -1:
             # assume http by defualt
             url = "http://" + host
         else:
             url = host
-        
+
+        with Motelist.remoteLock:
+            cached = Motelist.remoteMotes.get(host)
+        request = urllib2.Request(url + "/ports")
+        if cached is not None and cached[2]:
+            request.add_header("If-None-Match", cached[2])
+
         try:
-            req = urllib2.urlopen(url + "/ports")
+            req = urllib2.urlopen(request, timeout = REMOTE_TIMEOUT)
+            retVal = list()
             motes = req.read().split("\n")
             for mote in motes:
                 info = mote.split(",")
                 if len(info) < 3:
                     continue
                 retVal.append([info[1], info[2], info[0], host])
+            etag = req.info().getheader("ETag")
+        except urllib2.HTTPError as e:
+            if e.code == 304 and cached is not None:
+                # not changed
+                retVal = cached[0]
+                etag = cached[2]
+            else:
+                print ("Exception while getting remote motelist: ", e)
         except Exception as e:
-            print ("Exception while getting remote motelist: ", e)
-
+            # report only when it stops answering
+            if host not in Motelist.remoteFailing:
+                print ("Exception while getting remote motelist: ", e)
+
+        if retVal is None:
+            Motelist.remoteFailing.add(host)
+            return Motelist.getCachedRemoteMotelist(host)
+        Motelist.remoteFailing.discard(host)
+        with Motelist.remoteLock:
+            Motelist.remoteMotes[host] = (retVal, time.time(), etag)
+        return list(retVal)
+
+    # Ask all remote servers at once, without waiting for the answers; when a
+    # server answers with changed motes, the motelist is rescanned. Only servers
+    # not asked before are waited for (up to REMOTE_TIMEOUT), so that the first
+    # motelist has their motes.
+    @staticmethod
+    def getRemoteMotelists():
+        def fetch(host):
+            try:
+                before = Motelist.getCachedRemoteMotelist(host)
+                after = Motelist.getRemoteMotelist(host)
+            finally:
+                with Motelist.remoteLock:
+                    Motelist.remoteFetching.discard(host)
+            if after != before:
+                Motelist.rescanMotes()
+
+        threads = list()
+        for host in Motelist.remoteServerList:
+            with Motelist.remoteLock:
+                if host in Motelist.remoteFetching:
+                    # still waiting for the previous answer
+                    continue
+                Motelist.remoteFetching.add(host)
+                firstTime = host not in Motelist.remoteMotes \
+                    and host not in Motelist.remoteFailing
+            thread = threading.Thread(target = fetch, args = (host,),
+                                      name = "Motelist " + host)
+            thread.daemon = True
+            thread.start()
+            if firstTime:
+                threads.append(thread)
+
+        # the timeout does not cover everything (e.g. name lookup), do not wait forever
+        deadline = time.time() + REMOTE_TIMEOUT + 1
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+    # Return list of the motes last received from the remote servers
+    @staticmethod
+    def getCachedRemoteMotelists():
+        retVal = list()
+        for host in Motelist.remoteServerList:
+            retVal += Motelist.getCachedRemoteMotelist(host)
         return retVal
-    
+
     @staticmethod
     def getMotelist(update):
         if update:
@@ -260,7 +371,7 @@ class Motelist(object):
         Motelist.lock.acquire()
 
         # return a copy of connected list
-        retVal = list(Motelist.motes)
+        retVal = list(Motelist.sortedMotes)
 
         Motelist.lock.release()
 
@@ -272,7 +383,7 @@ class Motelist(object):
 
         result = list()
 
-        for mote in Motelist.motes:
+        for mote in Motelist.sortedMotes:
             if mote.getUserData() == userData:
                 result.append(mote)
 
@@ -291,15 +402,41 @@ class Motelist(object):
         except:
             pass
 
+    @staticmethod
+    def addChangeCallback(callback):
+        Motelist.changeCallbacks.append(callback)
+
+    @staticmethod
+    def removeChangeCallback(callback):
+        try:
+            Motelist.changeCallbacks.remove(callback)
+        except:
+            pass
+
     @staticmethod
     def updateMotelist(infinite):
         Motelist.infinite = infinite
         Motelist.__activateCallbacks()
 
+        watcher = None
+        if infinite and HotplugWatcher is not None:
+            watcher = HotplugWatcher()
+            if not watcher.isAvailable():
+                watcher = None
+
         while Motelist.infinite:
-            time.sleep(1)
+            if watcher is None:
+                time.sleep(POLL_INTERVAL)
+            elif Motelist.remoteServerList:
+                watcher.waitForChange(POLL_INTERVAL)
+            else:
+                # wake up when a mote is plugged in or out
+                watcher.waitForChange(RESCAN_INTERVAL)
             Motelist.__activateCallbacks()
 
+        if watcher is not None:
+            watcher.close()
+
     @staticmethod
     def startPeriodicUpdate():
         # Call new Thread
@@ -316,14 +453,35 @@ class Motelist(object):
         Motelist.infinite = False
 
     @staticmethod
-    def __activateCallbacks(force = False):
+    def __activateCallbacks(force = False, added = None):
+        Motelist.getRemoteMotelists()
+        Motelist.rescanMotes(force, added)
+
+    # Recreate the motelist from the local ports and the remote motes received
+    # so far, and call the callbacks if it changed
+    @staticmethod
+    def rescanMotes(force = False, added = None):
+        # remote servers answer from their own threads; one rescan at a time
+        with Motelist.rescanLock:
+            Motelist.__rescanMotes(force, added)
+
+    @staticmethod
+    def __rescanMotes(force, added):
+        iterator = itertools.chain(comports(), Motelist.getCachedRemoteMotelists())
+        (newAdded, removed) = Motelist.recreateMoteList(iterator)
+        if added is None:
+            added = newAdded
+        else:
+            added = added + newAdded
+
         # If no new motes added, no need to call callbacks
-        if not Motelist.recreateMoteList(comports()) and not force:
+        if not added and not removed and not force:
             return
 
         Motelist.lock.acquire()
 
         updateCallbackTempList = list(Motelist.updateCallbacks)
+        changeCallbackTempList = list(Motelist.changeCallbacks)
 
         Motelist.lock.release()
 
@@ -333,8 +491,19 @@ class Motelist(object):
             except Exception as e:
                 print ("Exception while calling callback: ", e)
 
+        if not added and not removed:
+            return
+        for x in changeCallbackTempList:
+            try:
+                x(added, removed)
+            except Exception as e:
+                print ("Exception while calling callback: ", e)
+
     @staticmethod
     def portExists(port):
+        # opening the port is slow and may reset the mote; on posix the device file tells enough
+        if os.name == 'posix' and port.startswith("/dev/"):
+            return os.path.exists(port)
         try:
             ser = serial.Serial(port, 38400, timeout = 0, parity = serial.PARITY_NONE, rtscts = 1)
             while True:
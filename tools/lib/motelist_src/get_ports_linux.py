@@ -121,6 +121,25 @@ def hwinfo(device):
                 return usb_sysfs_hw_string(sys_dev_path + '/..')
     return 'n/a'  # XXX directly remove these from the list?
 
+# (device, description, hw info) by device name, with the device number and
+# change time of the device file: the file is created anew when a device is
+# plugged in, so sysfs is read only for new devices
+cache = {}
+
 def comports():
     devices = glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*')
-    return [(d, describe(d), hwinfo(d)) for d in devices]
+    result = []
+    for d in devices:
+        try:
+            st = os.stat(d)
+        except OSError:
+            continue # removed meanwhile
+        key = (st.st_rdev, st.st_ctime)
+        entry = cache.get(d)
+        if entry is None or entry[0] != key:
+            entry = (key, (d, describe(d), hwinfo(d)))
+            cache[d] = entry
+        result.append(entry[1])
+    for d in set(cache.keys()) - set(devices):
+        del cache[d]
+    return result
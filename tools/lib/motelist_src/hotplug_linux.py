@@ -0,0 +1,59 @@
+#
+# Hotplug events of serial ports on Linux
+#
+# The kernel sends a uevent to a netlink socket when a device is added or
+# removed. waitForChange() waits for those of tty devices, so the motelist
+# can be updated as soon as a mote is plugged in or out, instead of
+# rescanning every second. If netlink is not available (not Linux, or not
+# permitted), isAvailable() is False and the caller has to poll.
+#
+
+import socket, select, time
+
+NETLINK_KOBJECT_UEVENT = 15
+KERNEL_EVENTS = 1 # multicast group
+
+# one plug in causes several events; wait this long for the rest of them
+SETTLE_TIME = 0.2
+
+def isTtyEvent(message):
+    fields = message.split(b"\0")
+    return b"SUBSYSTEM=tty" in fields \
+        and (b"ACTION=add" in fields or b"ACTION=remove" in fields)
+
+class HotplugWatcher(object):
+    def __init__(self):
+        self.sock = None
+        try:
+            s = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            s.bind((0, KERNEL_EVENTS))
+            self.sock = s
+        except (AttributeError, socket.error, OSError):
+            pass
+
+    def isAvailable(self):
+        return self.sock is not None
+
+    # Wait up to timeout seconds for a serial port to appear or disappear;
+    # return True if that happened
+    def waitForChange(self, timeout):
+        deadline = time.time() + timeout
+        changed = False
+        while True:
+            wait = deadline - time.time()
+            if wait <= 0:
+                return changed
+            try:
+                if not select.select([self.sock], [], [], wait)[0]:
+                    return changed
+                message = self.sock.recv(65536)
+            except (select.error, socket.error):
+                return changed
+            if isTtyEvent(message):
+                changed = True
+                deadline = time.time() + SETTLE_TIME
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
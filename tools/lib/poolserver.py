@@ -0,0 +1,186 @@
+#
+# HTTP server with a fixed pool of worker threads
+#
+# Accepted connections are put in a bounded queue and served by
+# workerThreads threads. When the queue is full, the connection gets
+# "503 Service Unavailable" right away instead of a new thread.
+# Idle keep-alive connections are closed after keepAliveTimeout seconds,
+# or as soon as the request is done if other connections are waiting.
+# A handler can detach() its connection to hand it over to another thread.
+# stop() wakes up the accept loop through a pipe, so the server
+# neither polls nor has to kill the process to exit.
+#
+
+from __future__ import print_function
+import os, sys, socket, select, threading, errno
+
+if sys.version_info[0] >= 3:
+    import queue as Queue
+    from http.server import HTTPServer
+else:
+    import Queue
+    from BaseHTTPServer import HTTPServer
+
+DEFAULT_WORKER_THREADS = 8
+DEFAULT_QUEUE_SIZE = 32
+DEFAULT_KEEP_ALIVE_TIMEOUT = 5
+
+BUSY_RESPONSE = b"HTTP/1.1 503 Service Unavailable\r\n" \
+    b"Content-Type: text/plain\r\n" \
+    b"Content-Length: 12\r\n" \
+    b"Retry-After: 1\r\n" \
+    b"Connection: close\r\n" \
+    b"\r\n" \
+    b"Server busy\n"
+
+# Return (read end, write end) of a pipe that select() can wait on
+def makeWakeupPair():
+    if os.name == "posix":
+        return os.pipe()
+    # on Windows select() works only with sockets
+    if hasattr(socket, "socketpair"):
+        (r, w) = socket.socketpair()
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        w = socket.create_connection(server.getsockname())
+        (r, addr) = server.accept()
+        server.close()
+    return (r, w)
+
+# -------------------------------------
+# Mix into the request handler class (before BaseHTTPRequestHandler)
+# to give up keep-alive connections when other clients are waiting.
+class KeepAliveHandlerMixin:
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+        while not self.close_connection:
+            if self.server.isBusy():
+                break
+            self.handle_one_request()
+
+# -------------------------------------
+class PooledHTTPServer(HTTPServer):
+    allow_reuse_address = True
+
+    def __init__(self, serverAddress, handlerClass,
+                 workerThreads = DEFAULT_WORKER_THREADS,
+                 requestQueueSize = DEFAULT_QUEUE_SIZE,
+                 keepAliveTimeout = DEFAULT_KEEP_ALIVE_TIMEOUT):
+        HTTPServer.__init__(self, serverAddress, handlerClass)
+        self.keepAliveTimeout = keepAliveTimeout
+        self.requests = Queue.Queue(max(1, requestQueueSize))
+        self.stopping = False
+        self.detached = {}  # request -> function that takes it over
+        (self.wakeupRead, self.wakeupWrite) = makeWakeupPair()
+        self.workers = []
+        for i in range(max(1, workerThreads)):
+            t = threading.Thread(target = self.worker, name = "http-worker-" + str(i))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    # Called by a handler that wants to keep its connection after it returns
+    # (e.g. for streaming). takeOver(request) is called instead of closing it.
+    def detach(self, request, takeOver):
+        self.detached[request] = takeOver
+
+    def isBusy(self):
+        return not self.requests.empty()
+
+    # Called from the accept loop for each new connection
+    def process_request(self, request, clientAddress):
+        try:
+            self.requests.put_nowait((request, clientAddress))
+        except Queue.Full:
+            self.rejectRequest(request)
+
+    def rejectRequest(self, request):
+        try:
+            request.sendall(BUSY_RESPONSE)
+        except socket.error:
+            pass
+        self.shutdown_request(request)
+
+    def worker(self):
+        while True:
+            item = self.requests.get()
+            if item is None:
+                break
+            (request, clientAddress) = item
+            try:
+                request.settimeout(self.keepAliveTimeout)
+                self.finish_request(request, clientAddress)
+            except socket.timeout:
+                pass
+            except Exception:
+                self.handle_error(request, clientAddress)
+            finally:
+                takeOver = self.detached.pop(request, None)
+                if takeOver is None:
+                    self.shutdown_request(request)
+                else:
+                    try:
+                        takeOver(request)
+                    except Exception:
+                        self.handle_error(request, clientAddress)
+                        self.shutdown_request(request)
+
+    def serve_forever(self, poll_interval = None):
+        try:
+            while not self.stopping:
+                try:
+                    r, w, e = select.select([self, self.wakeupRead], [], [])
+                except (select.error, OSError) as e:
+                    # interrupted by a signal
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.wakeupRead in r:
+                    break
+                if self in r:
+                    self._handle_request_noblock()
+        finally:
+            self.stopping = True
+            self.stopWorkers()
+            self.server_close()
+
+    # Ask serve_forever() to return; safe to call from signal handlers and other threads
+    def stop(self):
+        self.stopping = True
+        try:
+            if os.name == "posix":
+                os.write(self.wakeupWrite, b"x")
+            else:
+                self.wakeupWrite.send(b"x")
+        except (OSError, socket.error):
+            pass
+
+    def stopWorkers(self):
+        # drop connections that were not served yet
+        while True:
+            try:
+                item = self.requests.get_nowait()
+            except Queue.Empty:
+                break
+            if item is not None:
+                self.shutdown_request(item[0])
+        for t in self.workers:
+            try:
+                self.requests.put_nowait(None)
+            except Queue.Full:
+                break
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if os.name == "posix":
+            for fd in (self.wakeupRead, self.wakeupWrite):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        else:
+            self.wakeupRead.close()
+            self.wakeupWrite.close()
@@ -71,7 +71,7 @@ readKey()
 
 # Clear stored motelist, to automatically detect conected motes.
 print "\nClearing motelist from manually found motes."
-Motelist.motes = list()
+Motelist.clear()
 readKey()
 
 # Automatically detect and print all connected motes.
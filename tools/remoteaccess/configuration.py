@@ -19,6 +19,11 @@ c.setCfgValue("motes", [])
 c.setCfgValue("mansosDirectory", "../..")
 c.setCfgValue("slowUpload", False)
 c.setCfgValue("createDaemon", False)
+# HTTP server: worker threads, connections waiting for a worker (more get "503 busy"),
+# and seconds an idle keep-alive connection may hold a worker
+c.setCfgValue("workerThreads", 4)
+c.setCfgValue("requestQueueSize", 16)
+c.setCfgValue("keepAliveTimeout", 5)
 
 # load the config file
 try:
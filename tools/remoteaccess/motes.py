@@ -120,42 +120,56 @@ class Mote(object):
 class MoteCollection(object):
     def __init__(self):
         self.motes = dict()
+        # changed when motes are added or removed; with the start time it is the ETag of /ports
+        self.version = 0
+        self.startTime = int(time.time())
+        self.lock = threading.Lock()
 
     def addAll(self):
         cfgMotes = configuration.c.getCfgValueAsList("motes")
         for portName in cfgMotes:
             Motelist.addMote(portName, "A statically added mote", "")
-        Motelist.initialize(self.motesUpdated, False, False)
+        Motelist.addChangeCallback(self.motesChanged)
         Motelist.startPeriodicUpdate()
-        self.refreshMotes(Motelist.getMotelist(False))
-
-    @staticmethod
-    def motesUpdated():
-        motes.refreshMotes(Motelist.getMotelist(False))
+        with self.lock:
+            # taken with the lock held, so that it is not older than the changes seen
+            self.refreshMotes(Motelist.getMotelist(False))
+
+    # Called by the motelist with the motes plugged in and out
+    def motesChanged(self, added, removed):
+        with self.lock:
+            for d in removed:
+                m = self.motes.get(d.getPort())
+                # motes are kept by port; a remote mote may have the same port name
+                if m is not None and m.moteDescription == d:
+                    self.removeMote(d.getPort())
+            for d in added:
+                self.addMote(d)
+
+    def addMote(self, description):
+        if description.getPort() not in self.motes:
+            print("add " + description.getPort())
+            self.motes[description.getPort()] = Mote(description)
+            self.version += 1
+
+    def removeMote(self, port):
+        m = self.motes.pop(port, None)
+        if m is not None:
+            print("remove " + port)
+            m.ensureSerialIsClosed()
+            self.version += 1
 
     def refreshMotes(self, newMotelist):
-#        print("refresh motes")
-
-        toRemove = set()
+        newPorts = set([d.getPort() for d in newMotelist])
 
-        for m in self.motes.values():
-            found = False
-            for d in newMotelist:
-                if d.getPort() == m.getPortName():
-                    found = True
-                    break
-            if not found:
-                toRemove.add(m)
-
-        for m in toRemove:
-            print("remove " + m.getPortName())
-            m.ensureSerialIsClosed()
-            del self.motes[m.getPortName()]
+        for port in set(self.motes) - newPorts:
+            self.removeMote(port)
 
         for d in newMotelist:
-            if d.getPort() not in self.motes:
-                print("add " + d.getPort())
-                self.motes[d.getPort()] = Mote(d)
+            self.addMote(d)
+
+    def getETag(self):
+        return '"{:x}-{}"'.format(self.startTime, self.version)
 
     def getMotes(self):
         return self.motes.values()
@@ -6,15 +6,30 @@
 
 from __future__ import print_function
 import os, sys
-import threading, time, cgi, signal, select, traceback, subprocess, urllib2
+import threading, time, cgi, signal, traceback, urllib2, socket, hashlib, tempfile, re
 # add library directory to path
 sys.path.append(os.path.join(os.getcwd(), '..', "lib"))
 import daemon
 import configuration
 from motes import motes
 import mansos_version
+import poolserver
+# the BSL script, used in this process
+sys.path.append(os.path.abspath(os.path.join(configuration.c.getCfgValue("mansosDirectory"),
+                                             "mos", "make", "scripts")))
+import ubsl
 
-bslLock = threading.Lock()
+# uploaded images, named by SHA-1 hash of the contents
+IMAGE_DIRECTORY = "tmpdir"
+MAX_IMAGES = 32
+
+# one lock per serial port, motes on different ports are programmed at the same time
+portLocks = {}
+portLocksLock = threading.Lock()
+
+def getPortLock(port):
+    with portLocksLock:
+        return portLocks.setdefault(port, threading.Lock())
 
 def isPython3():
     return sys.version_info[0] >= 3
@@ -23,10 +38,12 @@ if isPython3():
     from http.server import *
     from socketserver import *
     from urllib.parse import *
+    from io import StringIO
 else:
     from BaseHTTPServer import *
     from SocketServer import *
     from urlparse import *
+    from StringIO import StringIO
 
 def listenSerial():
     while True:
@@ -51,29 +68,110 @@ def qsExtractBool(qs, name):
                 pass
     return (value, isSet)
 
-def runSubprocess2(args):
-    retcode = 0
-    output = ""
+# The file name extension tells ubsl the image format
+def getImageExtension(filename):
+    ext = os.path.splitext(filename)[1]
+    if not re.match(r"^\.\w+$", ext):
+        ext = ".ihex"
+    return ext
+
+# Return the path of the image with the hash and file name extension; None if not uploaded
+def findImage(digest, ext):
+    if not re.match(r"^[0-9a-f]{40}$", digest):
+        return None
+    path = os.path.join(IMAGE_DIRECTORY, digest + ext)
+    if not os.path.isfile(path):
+        return None
+    os.utime(path, None) # mark as recently used
+    return path
+
+# Remove the least recently used images
+def trimImages():
     try:
-#        print("runSubprocess2, args=" + args)
-        proc = subprocess.Popen(args.split(), stderr = subprocess.STDOUT,
-                                stdout = subprocess.PIPE, shell = False)
-        (stdout, stderr) = proc.communicate()
-        if stdout: output += stdout
-        if stderr: output += stderr
-        retcode = proc.returncode
+        files = [os.path.join(IMAGE_DIRECTORY, f) for f in os.listdir(IMAGE_DIRECTORY)
+                 if not f.endswith(".tmp")]
+        files.sort(key = os.path.getmtime)
+        for f in files[:max(0, len(files) - MAX_IMAGES)]:
+            os.remove(f)
     except OSError as e:
-        print("runSubprocess2 OSError:" + str(e))
-    except CalledProcessError as e:
-        print("runSubprocess2 CalledProcessError:" + str(e))
-        retcode = e.returncode
-    except Exception as e:
-        print("runSubprocess2 exception:" + str(e))
+        print("Failed to remove old images: " + str(e))
+
+# Output of a BSL run, sent to the client line by line as HTTP chunks
+class ChunkedOutput(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ""
+        self.failed = False
+        self.percent = {}
+
+    def send(self, data):
+        if self.failed or not data:
+            return
+        try:
+            self.sock.sendall("%x\r\n%s\r\n" % (len(data), data))
+        except socket.error:
+            # the client is gone; go on programming anyway
+            self.failed = True
+
+    def write(self, text):
+        lines = (self.buffer + text).split("\n")
+        self.buffer = lines.pop()
+        if lines:
+            self.send("".join([line + "\n" for line in lines]))
+
+    def flush(self):
+        pass
+
+    # Report every 10% of programming and verification
+    def progress(self, phase, done, total):
+        if not total or phase not in ("program", "verify"):
+            return
+        percent = done * 10 // total * 10
+        if percent > self.percent.get(phase, 0):
+            self.percent[phase] = percent
+            self.write("%s %d%%\n" % (phase, percent))
+
+    def close(self):
+        if self.buffer:
+            self.send(self.buffer + "\n")
+            self.buffer = ""
+        if not self.failed:
+            try:
+                self.sock.sendall("0\r\n\r\n")
+            except socket.error:
+                pass
+
+# Run the BSL script with the arguments in this process; return the exit code
+def runBsl(argv, imagePath, output):
+    try:
+        cmdLine = ubsl.parseCommandLine(argv)
+        ubsl.execute(cmdLine, ubsl.loadImage(imagePath), output, output.progress)
+        return 0
+    except (Exception, SystemExit) as e:
+        output.write("\nAn error occured:\n%s\n" % e)
+        return 1
+
+# Program the mote and send the output to the client; runs in its own thread
+def programMote(server, sock, port, argv, imagePath):
+    try:
+        sock.settimeout(None)
+        output = ChunkedOutput(sock)
+        lock = getPortLock(port)
+        if not lock.acquire(False):
+            output.write("Port " + port + " busy, waiting...\n")
+            lock.acquire()
+        try:
+            retcode = runBsl(argv, imagePath, output)
+        finally:
+            lock.release()
+        # the last line tells the client how it went
+        output.write("exit code: %d\n" % retcode)
+        output.close()
     finally:
-        return (retcode, output)
+        server.shutdown_request(sock)
 
 
-class HttpServerHandler(BaseHTTPRequestHandler):
+class HttpServerHandler(poolserver.KeepAliveHandlerMixin, BaseHTTPRequestHandler):
     server_version = 'MansOS/' + mansos_version.getMansosVersion(
         configuration.c.getCfgValue("mansosDirectory")) + ' Remote Access Server'
     protocol_version = 'HTTP/1.1'
@@ -118,12 +216,21 @@ class HttpServerHandler(BaseHTTPRequestHandler):
     # Get list of all connected motes
     def servePorts(self, qs):
 #        print("servePorts")
+        # clients ask every second; tell them when nothing has changed
+        etag = motes.getETag()
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
         content = ""
         all = motes.getMotes()
         for mote in all:
             content += mote.moteDescription.getCSVData() + "\n"
         self.send_response(200)
         self.sendDefaultHeaders(content)
+        self.send_header('ETag', etag)
         self.end_headers()
         self.wfile.write(content)
 
@@ -223,7 +330,6 @@ class HttpServerHandler(BaseHTTPRequestHandler):
 
     # Program an image
     def serveProgram(self, qs):
-        global bslLock
 #        print("serveProgram")
 
         if "filename" not in qs:
@@ -246,23 +352,78 @@ class HttpServerHandler(BaseHTTPRequestHandler):
             return self.serveError("Mote " + port + " not connected!")
         mote.ensureSerialIsClosed() # Note: will not reopen automatically!
 
-        dirname = os.path.dirname(os.path.join("tmpdir", filename))
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        with open(os.path.join("tmpdir", filename), "wb") as tmpfile:
-            tmpfile.write(self.rfile.read(length))
+        ext = getImageExtension(filename)
+        digest = qs.get("hash", [""])[0].lower()
+        if length == 0 and digest:
+            # uploaded before
+            imagePath = findImage(digest, ext)
+            if imagePath is None:
+                return self.serveError("image " + digest + " not found, send it again!")
+        else:
+            try:
+                imagePath = self.receiveImage(length, ext, digest)
+            except (IOError, OSError) as e:
+                return self.serveError("failed to receive the image: " + str(e))
 
-        bslDir = os.path.abspath(os.path.join(configuration.c.getCfgValue("mansosDirectory"),
-                                              "mos", "make", "scripts"))
+        # the arguments are the command line of ubsl.py; the image is the uploaded file
+        argv = arguments.split()[1:]
+        argv = [imagePath if a == filename else a for a in argv]
         if configuration.c.getCfgValueAsBool("slowUpload"):
-            arguments += " --slow"
-        arguments = "python " + bslDir + os.path.sep + arguments
-
-        with bslLock:
-            os.chdir("tmpdir")
-            (retcode, content) = runSubprocess2(arguments)
-            os.chdir("..")
+            argv.insert(0, "--slow")
 
+        # stream the output while programming in another thread,
+        # so that this worker thread is free for other requests
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = 1
+        server = self.server
+        def takeOver(sock):
+            t = threading.Thread(target = programMote, name = "program-" + port,
+                                 args = (server, sock, port, argv, imagePath))
+            t.daemon = True
+            t.start()
+        self.server.detach(self.request, takeOver)
+
+    # Save the request body in the image directory, computing its hash on the way;
+    # return the path of the image
+    def receiveImage(self, length, ext, expectedDigest):
+        if not os.path.exists(IMAGE_DIRECTORY):
+            os.makedirs(IMAGE_DIRECTORY)
+        h = hashlib.sha1()
+        (fd, tmpPath) = tempfile.mkstemp(suffix = ".tmp", dir = IMAGE_DIRECTORY)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                remaining = length
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 64 * 1024))
+                    if not chunk:
+                        raise IOError("connection closed, {} bytes missing".format(remaining))
+                    h.update(chunk)
+                    f.write(chunk)
+                    remaining -= len(chunk)
+            digest = h.hexdigest()
+            if expectedDigest and digest != expectedDigest:
+                raise IOError("hash does not match")
+            imagePath = findImage(digest, ext)
+            if imagePath is None:
+                imagePath = os.path.join(IMAGE_DIRECTORY, digest + ext)
+                os.rename(tmpPath, imagePath)
+                trimImages()
+        finally:
+            if os.path.exists(tmpPath):
+                os.remove(tmpPath)
+        return imagePath
+
+    # Is the image with this hash uploaded? /image?hash=<sha1>&filename=<name>
+    def serveImage(self, qs):
+        ext = getImageExtension(urllib2.unquote(qs.get("filename", [""])[0]))
+        if findImage(qs.get("hash", [""])[0].lower(), ext) is None:
+            return self.serve404Error("/image", qs)
+        content = "OK"
         self.send_response(200)
         self.sendDefaultHeaders(content)
         self.end_headers()
@@ -281,6 +442,8 @@ class HttpServerHandler(BaseHTTPRequestHandler):
             self.serveControl(qs)
         elif o.path == "/read":
             self.serveRead(qs)
+        elif o.path == "/image":
+            self.serveImage(qs)
         else:
             self.serve404Error(o.path, qs)
 
@@ -297,33 +460,6 @@ class HttpServerHandler(BaseHTTPRequestHandler):
             self.serve404Error(o.path, qs)
 
 
-class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-    # Overrides BaseServer function to get better control over interrupts
-    def serve_forever(self, poll_interval = 0.5):
-        """Handle one request at a time until shutdown.
-
-        Polls for shutdown every poll_interval seconds. Ignores
-        self.timeout. If you need to do periodic tasks, do them in
-        another thread.
-        """
-        self._BaseServer__is_shut_down.clear()
-        try:
-            while not self._BaseServer__shutdown_request:
-                # XXX: Consider using another file descriptor or
-                # connecting to the socket to wake this up instead of
-                # polling. Polling reduces our responsiveness to a
-                # shutdown request and wastes cpu at all other times.
-                r, w, e = select.select([self], [], [], poll_interval)
-                if self in r:
-                    self._handle_request_noblock()
-        finally:
-            self._BaseServer__shutdown_request = False
-            self._BaseServer__is_shut_down.set()
-            if os.name == "posix":
-                # kill the process to make sure it exits
-                os.kill(os.getpid(), signal.SIGKILL)
-
-
 def main():
     try:
         if configuration.c.getCfgValueAsBool("createDaemon"):
@@ -331,16 +467,25 @@ def main():
             daemon.createDaemon()
         # start the server
         port = configuration.c.getCfgValueAsInt("port")
-        server = ThreadingHTTPServer(('', port), HttpServerHandler)
+        server = poolserver.PooledHTTPServer(('', port), HttpServerHandler,
+            workerThreads = configuration.c.getCfgValueAsInt("workerThreads"),
+            requestQueueSize = configuration.c.getCfgValueAsInt("requestQueueSize"),
+            keepAliveTimeout = configuration.c.getCfgValueAsFloat("keepAliveTimeout"))
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
         # load motes
         motes.addAll()
         # start listening thread
         listenThread = threading.Thread(target = listenSerial)
+        listenThread.daemon = True
         listenThread.start()
         # report ok and enter the main loop
         print("<remoteaccess>: started, listening to TCP port {}, serial baudrate {}".format(
                 port, configuration.c.getCfgValueAsInt("baudrate")))
-        server.serve_forever()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        print("<remoteaccess>: stopping")
     except Exception as e:
         print("<remoteaccess>: exception occurred:")
         print(e)
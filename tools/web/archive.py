@@ -0,0 +1,221 @@
+#
+# MansOS web server - columnar on-disk archive of sensor readings
+#
+# Layout: <archiveDirectory>/<mote>/<sensor>/<segment start>.{ts,val,idx}
+# Each segment holds the readings of one time partition (archiveSegmentHours).
+# ".ts" and ".val" are columns of little-endian doubles (timestamp in ms, value),
+# ".idx" holds (timestamp, row) pairs for every INDEX_STEP-th row, so that
+# a range query can seek directly to the first interesting row.
+#
+
+from __future__ import print_function
+import os, sys, time, array, bisect, threading, atexit
+import configuration
+
+INDEX_STEP = 256
+ITEM_SIZE = 8
+READ_CHUNK = 4096 # rows
+
+def toDisk(a):
+    if sys.byteorder == 'big':
+        a = array.array('d', a)
+        a.byteswap()
+    return a
+
+def fromDisk(a):
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+def readColumn(f, row, count):
+    f.seek(row * ITEM_SIZE)
+    a = array.array('d')
+    data = f.read(count * ITEM_SIZE)
+    a.fromstring(data[:len(data) - len(data) % ITEM_SIZE])
+    return fromDisk(a)
+
+def appendColumn(path, a):
+    with open(path, "ab") as f:
+        toDisk(a).tofile(f)
+
+# -------------------------------------
+class Segment(object):
+    def __init__(self, dirname, start):
+        self.start = start
+        base = os.path.join(dirname, str(start))
+        self.tsPath = base + ".ts"
+        self.valPath = base + ".val"
+        self.idxPath = base + ".idx"
+
+    def numRows(self):
+        try:
+            return os.path.getsize(self.tsPath) // ITEM_SIZE
+        except OSError:
+            return 0
+
+    def append(self, timestamps, values):
+        rows = self.numRows()
+        index = array.array('d')
+        for i in range(len(timestamps)):
+            if (rows + i) % INDEX_STEP == 0:
+                index.append(timestamps[i])
+                index.append(rows + i)
+        appendColumn(self.tsPath, timestamps)
+        appendColumn(self.valPath, values)
+        if index:
+            appendColumn(self.idxPath, index)
+
+    def loadIndex(self):
+        try:
+            with open(self.idxPath, "rb") as f:
+                a = readColumn(f, 0, os.path.getsize(self.idxPath) // ITEM_SIZE)
+        except (IOError, OSError):
+            return ([], [])
+        return (a[0::2].tolist(), [int(r) for r in a[1::2]])
+
+    # Return (timestamps, values) with fromTs <= timestamp <= toTs.
+    # Rows within a segment are in time order.
+    def query(self, fromTs, toTs):
+        (indexTs, indexRows) = self.loadIndex()
+        i = bisect.bisect_left(indexTs, fromTs) - 1
+        row = indexRows[i] if i >= 0 else 0
+        timestamps = array.array('d')
+        values = array.array('d')
+        with open(self.tsPath, "rb") as tsFile:
+            # skip to the first row in range
+            while True:
+                chunk = readColumn(tsFile, row, READ_CHUNK)
+                if not chunk:
+                    return (timestamps, values)
+                j = bisect.bisect_left(chunk, fromTs)
+                if j < len(chunk):
+                    row += j
+                    break
+                row += len(chunk)
+            # read until the end of the range
+            first = row
+            while True:
+                chunk = readColumn(tsFile, row, READ_CHUNK)
+                if not chunk:
+                    break
+                j = bisect.bisect_right(chunk, toTs)
+                timestamps.extend(chunk[:j])
+                row += j
+                if j < len(chunk):
+                    break
+        if len(timestamps):
+            with open(self.valPath, "rb") as valFile:
+                values = readColumn(valFile, first, len(timestamps))
+        return (timestamps, values)
+
+
+# -------------------------------------
+class Archive(object):
+    def __init__(self):
+        self.pending = {}   # (mote, sensor) -> (segment start, timestamps, values)
+        self.lock = threading.Lock()
+        self.lastFlush = time.time()
+        self.numPending = 0
+        self.loadSettings()
+
+    def loadSettings(self):
+        c = configuration.c
+        self.enabled = c.getCfgValueAsBool("archiveData")
+        self.directory = os.path.abspath(c.getCfgValue("archiveDirectory"))
+        self.segmentLength = int(c.getCfgValueAsFloat("archiveSegmentHours") * 3600 * 1000)
+        self.flushInterval = c.getCfgValueAsFloat("dataFlushInterval")
+
+    def getDirname(self, mote, sensor):
+        # names come from the serial port and from URLs, do not let them escape the archive
+        mote = mote.replace(os.sep, "_").lstrip(".")
+        sensor = sensor.replace(os.sep, "_").lstrip(".")
+        return os.path.join(self.directory, mote, sensor)
+
+    def segmentStart(self, timestamp):
+        return int(timestamp) - int(timestamp) % self.segmentLength
+
+    # Called from the serial listener thread for each parsed reading
+    def append(self, mote, sensor, timestamp, value):
+        start = self.segmentStart(timestamp)
+        with self.lock:
+            key = (mote, sensor)
+            p = self.pending.get(key)
+            if p is not None and p[0] != start:
+                self.flushSeries(key, p)
+                p = None
+            if p is None:
+                p = (start, array.array('d'), array.array('d'))
+                self.pending[key] = p
+            p[1].append(timestamp)
+            p[2].append(value)
+            self.numPending += 1
+
+    def flushSeries(self, key, p):
+        (start, timestamps, values) = p
+        del self.pending[key]
+        self.numPending -= len(timestamps)
+        dirname = self.getDirname(*key)
+        try:
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            Segment(dirname, start).append(timestamps, values)
+        except (IOError, OSError) as e:
+            print("Failed to archive data in " + dirname + ": " + str(e))
+
+    def flushAll(self):
+        for (key, p) in list(self.pending.items()):
+            self.flushSeries(key, p)
+        self.lastFlush = time.time()
+
+    def flushIfDue(self):
+        if self.numPending and time.time() - self.lastFlush >= self.flushInterval:
+            with self.lock:
+                self.flushAll()
+
+    def flush(self):
+        with self.lock:
+            self.flushAll()
+
+    def getSegments(self, dirname, fromTs, toTs):
+        try:
+            names = os.listdir(dirname)
+        except OSError:
+            return []
+        starts = set()
+        for name in names:
+            if name.endswith(".ts"):
+                try:
+                    starts.add(int(name[:-3]))
+                except ValueError:
+                    pass
+        return [Segment(dirname, s) for s in sorted(starts)
+                if s <= toTs and s + self.segmentLength > fromTs]
+
+    def getMotes(self):
+        try:
+            return sorted(os.listdir(self.directory))
+        except OSError:
+            return []
+
+    def getSensors(self, mote):
+        try:
+            return sorted(os.listdir(os.path.join(self.directory, mote)))
+        except OSError:
+            return []
+
+    # Return list of (timestamp, value) pairs with fromTs <= timestamp <= toTs
+    def query(self, mote, sensor, fromTs, toTs):
+        with self.lock:
+            key = (mote, sensor)
+            if key in self.pending:
+                self.flushSeries(key, self.pending[key])
+        result = []
+        for segment in self.getSegments(self.getDirname(mote, sensor), fromTs, toTs):
+            (timestamps, values) = segment.query(fromTs, toTs)
+            result.extend(zip([int(t) for t in timestamps], values))
+        return result
+
+
+# -------------------------------------
+archive = Archive()
+atexit.register(archive.flush)
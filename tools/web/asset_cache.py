@@ -0,0 +1,142 @@
+#
+# MansOS web server - in-memory cache of static files (CSS, JS, images)
+#
+# Keeps file contents, a strong ETag and, for text files, a gzip-compressed
+# variant in memory. A cached file is reloaded when its mtime or size changes.
+# If "<file>.gz" exists and is not older than the file, it is used as
+# the compressed variant instead of compressing on the fly.
+#
+
+from __future__ import print_function
+import os, gzip, hashlib, threading, collections
+from email.utils import formatdate, parsedate_tz, mktime_tz
+try:
+    from StringIO import StringIO as BytesIO
+except ImportError:
+    from io import BytesIO
+import configuration
+
+# files smaller than this are not worth compressing
+MIN_GZIP_SIZE = 512
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg')
+
+def gzipBytes(data):
+    buf = BytesIO()
+    f = gzip.GzipFile(fileobj = buf, mode = "wb", compresslevel = 6, mtime = 0)
+    f.write(data)
+    f.close()
+    return buf.getvalue()
+
+# -------------------------------------
+class Asset(object):
+    def __init__(self, path, mimetype):
+        st = os.stat(path)
+        self.path = path
+        self.mimetype = mimetype
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        with open(path, "rb") as f:
+            self.data = f.read()
+        digest = hashlib.md5(self.data).hexdigest()
+        self.etag = '"' + digest + '"'
+        self.lastModified = formatdate(int(self.mtime), usegmt = True)
+        self.gzipData = None
+        self.gzipEtag = '"' + digest + '-gz"'
+        self.loadGzip()
+
+    def loadGzip(self):
+        gzPath = self.path + ".gz"
+        try:
+            if os.stat(gzPath).st_mtime >= self.mtime:
+                with open(gzPath, "rb") as f:
+                    self.gzipData = f.read()
+                return
+        except (IOError, OSError):
+            pass
+        if len(self.data) >= MIN_GZIP_SIZE and self.mimetype.startswith(COMPRESSIBLE):
+            data = gzipBytes(self.data)
+            if len(data) < len(self.data):
+                self.gzipData = data
+
+    def isCurrent(self, st):
+        return st.st_mtime == self.mtime and st.st_size == self.size
+
+    # Does the conditional GET in headers match this file?
+    def notModified(self, headers):
+        ifNoneMatch = headers.get("If-None-Match")
+        if ifNoneMatch is not None:
+            tags = [t.strip() for t in ifNoneMatch.split(",")]
+            return "*" in tags or self.etag in tags or self.gzipEtag in tags
+        ifModifiedSince = headers.get("If-Modified-Since")
+        if ifModifiedSince is not None:
+            t = parsedate_tz(ifModifiedSince)
+            if t is not None:
+                try:
+                    return int(self.mtime) <= mktime_tz(t)
+                except (OverflowError, ValueError):
+                    pass
+        return False
+
+    def memorySize(self):
+        return len(self.data) + (len(self.gzipData) if self.gzipData else 0)
+
+
+# -------------------------------------
+# Least recently used files are dropped when more than maxBytes are cached
+class AssetCache(object):
+    def __init__(self):
+        self.assets = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.totalBytes = 0
+        self.loadSettings()
+
+    def loadSettings(self):
+        c = configuration.c
+        self.maxBytes = c.getCfgValueAsInt("staticCacheSize")
+        self.maxAge = c.getCfgValueAsInt("staticMaxAge")
+
+    # Return the Asset for path; raises IOError/OSError if it cannot be read
+    def get(self, path, mimetype):
+        st = os.stat(path)
+        with self.lock:
+            asset = self.assets.pop(path, None)
+            if asset is not None:
+                self.totalBytes -= asset.memorySize()
+                if not asset.isCurrent(st):
+                    asset = None
+        if asset is None:
+            asset = Asset(path, mimetype)
+        with self.lock:
+            if path not in self.assets and asset.memorySize() <= self.maxBytes:
+                # most recently used files are at the end
+                self.assets[path] = asset
+                self.totalBytes += asset.memorySize()
+                while self.totalBytes > self.maxBytes:
+                    (oldPath, old) = self.assets.popitem(last = False)
+                    self.totalBytes -= old.memorySize()
+        return asset
+
+    def clear(self):
+        with self.lock:
+            self.assets.clear()
+            self.totalBytes = 0
+
+
+# Does the client accept gzip content encoding?
+def acceptsGzip(headers):
+    accept = headers.get("Accept-Encoding")
+    if not accept:
+        return False
+    for item in accept.split(","):
+        parts = item.strip().split(";")
+        if parts[0].strip().lower() in ("gzip", "x-gzip"):
+            for p in parts[1:]:
+                p = p.strip().replace(" ", "")
+                if p in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                    return False
+            return True
+    return False
+
+
+# -------------------------------------
+cache = AssetCache()
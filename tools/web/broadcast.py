@@ -0,0 +1,193 @@
+#
+# MansOS web server - push of live sensor data to browsers
+#
+# MoteData publishes each reading and each received line to the hub.
+# Every /stream client has its own bounded queue; when a client is slower
+# than the data, its oldest events are dropped. The clients' sockets are
+# taken over from the request handler and written by one thread, so
+# connected browsers do not hold HTTP worker threads.
+# Long-poll requests (/graph-data and /listen-data with "wait") are
+# woken up through the same hub.
+#
+
+from __future__ import print_function
+import os, json, time, socket, select, errno, threading, collections
+import poolserver
+
+DEFAULT_QUEUE_SIZE = 256
+# comment lines are sent this often (seconds) so that proxies keep the connection
+PING_INTERVAL = 15
+# give up on a client that has not accepted any data for this long (seconds)
+SEND_TIMEOUT = 30
+
+def formatEvent(event):
+    (name, seq, data) = event
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(
+        seq, name, json.dumps(data, separators = (',', ':')))
+
+# -------------------------------------
+class Client(object):
+    def __init__(self, sock, events, queueSize):
+        self.sock = sock
+        self.events = events      # event names this client wants
+        self.queue = collections.deque(maxlen = queueSize)
+        self.dropped = 0
+        self.output = ""
+        self.lastSent = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def push(self, event):
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped += 1
+        self.queue.append(event)
+
+
+# -------------------------------------
+class Hub(object):
+    def __init__(self, queueSize = DEFAULT_QUEUE_SIZE):
+        self.queueSize = queueSize
+        self.clients = []
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.waiters = 0
+        self.thread = None
+        self.wakeupRead = self.wakeupWrite = None
+        self.signaled = False
+
+    # Is anybody listening? Publishing is skipped when not.
+    def active(self):
+        return self.clients or self.waiters
+
+    def publish(self, name, seq, data):
+        with self.lock:
+            event = (name, seq, data)
+            for c in self.clients:
+                if name in c.events:
+                    c.push(event)
+            if self.clients and not self.signaled:
+                self.signaled = True
+                self.wakeup()
+            if self.waiters:
+                self.changed.notify_all()
+
+    # Block until check() returns true, timeout passes or maxWaiters are waiting already
+    def wait(self, check, timeout, maxWaiters):
+        end = time.time() + timeout
+        with self.lock:
+            if self.waiters >= maxWaiters:
+                return
+            self.waiters += 1
+            try:
+                while not check():
+                    left = end - time.time()
+                    if left <= 0:
+                        break
+                    self.changed.wait(left)
+            finally:
+                self.waiters -= 1
+
+    # Take over a connected socket; the HTTP headers have already been sent
+    def addClient(self, sock, events):
+        sock.setblocking(0)
+        with self.lock:
+            if self.thread is None:
+                (self.wakeupRead, self.wakeupWrite) = poolserver.makeWakeupPair()
+                self.thread = threading.Thread(target = self.run, name = "stream-writer")
+                self.thread.daemon = True
+                self.thread.start()
+            self.clients.append(Client(sock, set(events), self.queueSize))
+            self.wakeup()
+
+    def wakeup(self):
+        try:
+            if os.name == "posix":
+                os.write(self.wakeupWrite, b"x")
+            else:
+                self.wakeupWrite.send(b"x")
+        except (OSError, socket.error):
+            pass
+
+    def clearWakeup(self):
+        try:
+            if os.name == "posix":
+                os.read(self.wakeupRead, 4096)
+            else:
+                self.wakeupRead.recv(4096)
+        except (OSError, socket.error):
+            pass
+
+    def removeClient(self, client):
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        try:
+            client.sock.close()
+        except socket.error:
+            pass
+
+    def writeClient(self, client, now):
+        try:
+            sent = client.sock.send(client.output)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                sent = 0
+            else:
+                self.removeClient(client)
+                return
+        client.output = client.output[sent:]
+        if sent:
+            client.lastSent = now
+        elif now - client.lastSent > SEND_TIMEOUT:
+            self.removeClient(client)
+
+    # The writer thread
+    def run(self):
+        while True:
+            now = time.time()
+            with self.lock:
+                self.signaled = False
+                clients = list(self.clients)
+                for c in clients:
+                    # format only when the previous data has been sent, so
+                    # the queue is what absorbs (and drops) the backlog
+                    if not c.output and c.queue:
+                        c.output = "".join([formatEvent(e) for e in c.queue])
+                        c.queue.clear()
+                    elif not c.output and now - c.lastSent >= PING_INTERVAL:
+                        c.output = ": ping\n\n"
+            writers = [c for c in clients if c.output]
+            try:
+                r, w, e = select.select([self.wakeupRead] + clients, writers, [],
+                                        1 if writers else PING_INTERVAL)
+            except (select.error, OSError, ValueError) as e:
+                # a socket was closed under us
+                for c in clients:
+                    try:
+                        c.fileno()
+                    except socket.error:
+                        self.removeClient(c)
+                continue
+            if self.wakeupRead in r:
+                self.clearWakeup()
+            now = time.time()
+            for c in r:
+                if isinstance(c, Client):
+                    # browsers send nothing more; readable means closed
+                    try:
+                        data = c.sock.recv(4096)
+                    except socket.error:
+                        data = ""
+                    if not data:
+                        self.removeClient(c)
+            for c in writers:
+                if c in w or now - c.lastSent > SEND_TIMEOUT:
+                    self.writeClient(c, now)
+
+    def numClients(self):
+        return len(self.clients)
+
+
+# -------------------------------------
+hub = Hub()
@@ -0,0 +1,115 @@
+#
+# MansOS web server - cache of built images
+#
+# An image is stored under the SHA-1 hash of the code type, platform, code
+# and configuration it was built from, so uploading the same code again, or
+# to more motes of the same platform, does not run the toolchain again.
+# The hash also covers a fingerprint of the OS sources, makefiles and
+# toolchain, so that the code is built again after any of them changed.
+# The least recently used images are removed when there are more than
+# buildCacheSize of them.
+#
+
+from __future__ import print_function
+import os, shutil, hashlib, threading
+import configuration
+
+# compilers and tools whose version goes into the fingerprint
+TOOLS = ["make", "msp430-gcc", "avr-gcc", "arm-none-eabi-gcc", "msp430-objcopy"]
+
+def findProgram(name):
+    for d in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(d, name)
+        if os.path.isfile(path):
+            return path
+    return None
+
+# The newest modification time and number of files and directories
+# in the tree (a removed file changes the time of its directory)
+def getTreeState(top):
+    newest = 0
+    count = 0
+    for (dirpath, dirnames, filenames) in os.walk(top):
+        dirnames[:] = [d for d in dirnames if not d.startswith(".") and d != "build"]
+        for name in [""] + filenames:
+            try:
+                newest = max(newest, os.path.getmtime(os.path.join(dirpath, name)))
+            except OSError:
+                pass
+            count += 1
+    return "{}:{!r}:{}".format(os.path.abspath(top), newest, count)
+
+# What the build depends on besides the code: the source tree the
+# code type is built with, and the toolchain
+def getBuildInputs(codeType):
+    c = configuration.c
+    if codeType == "nesc":
+        trees = [c.getCfgValue("tinyosDirectory")]
+    elif codeType == "contiki_c":
+        trees = [c.getCfgValue("contikiDirectory")]
+    else:
+        trees = [os.path.join(c.getCfgValue("mansosDirectory"), "mos")]
+        if codeType == "seal":
+            # the SEAL compiler (SEAL in mos/make/Makefile)
+            trees.append(os.path.join(c.getCfgValue("mansosDirectory"), "tools", "parser"))
+    parts = [getTreeState(tree) for tree in trees]
+    for tool in TOOLS:
+        path = findProgram(tool)
+        if path:
+            parts.append("{}:{!r}".format(os.path.realpath(path), os.path.getmtime(path)))
+    return "\n".join(parts)
+
+def makeKey(codeType, platform, code, config, inputs = ""):
+    h = hashlib.sha1()
+    for part in (codeType, platform, code, config, inputs):
+        h.update(part or "")
+        h.update("\0")
+    return h.hexdigest()
+
+# -------------------------------------
+class BuildCache(object):
+    def __init__(self, directory, maxEntries):
+        self.directory = directory
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + ".ihex")
+
+    # Return the file name of the cached image, None if not cached
+    def get(self, key):
+        path = self.getPath(key)
+        with self.lock:
+            if not os.path.isfile(path):
+                return None
+            # mark as recently used
+            os.utime(path, None)
+        return path
+
+    # Copy the image to the cache; return the file name of the cached copy
+    def put(self, key, imageFile):
+        path = self.getPath(key)
+        with self.lock:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            tmpPath = path + ".tmp"
+            shutil.copyfile(imageFile, tmpPath)
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmpPath, path)
+            self.trim()
+        return path
+
+    def trim(self):
+        try:
+            files = [os.path.join(self.directory, f) for f in os.listdir(self.directory)
+                     if f.endswith(".ihex")]
+            files.sort(key = os.path.getmtime)
+            for f in files[:max(0, len(files) - self.maxEntries)]:
+                os.remove(f)
+        except OSError as e:
+            print("Failed to clean build cache: " + str(e))
+
+
+buildCache = BuildCache(configuration.c.getCfgValue("buildCacheDirectory"),
+                        configuration.c.getCfgValueAsInt("buildCacheSize"))
@@ -24,7 +24,28 @@ c.setCfgValue("saveToFilename", "")
 c.setCfgValue("saveToFilenameOnMote", "")
 c.setCfgValue("saveProcessedData", False)
 c.setCfgValue("slowUpload", False)
+# parallel uploads: at most this many at once, and at most this many per USB hub
+# (0: no limit per hub); failed uploads are retried this many times
+c.setCfgValue("uploadParallel", 8)
+c.setCfgValue("uploadPerHub", 4)
+c.setCfgValue("uploadRetries", 1)
+# images built before, by hash of the code, configuration and platform
+c.setCfgValue("buildCacheDirectory", "build-cache")
+c.setCfgValue("buildCacheSize", 16)
+# processed data files: max open files, flush thresholds and rotation ("none", "daily" or "size")
+c.setCfgValue("dataMaxOpenFiles", 32)
+c.setCfgValue("dataFlushInterval", 5)
+c.setCfgValue("dataFlushBytes", 65536)
+c.setCfgValue("dataRotation", "none")
+c.setCfgValue("dataRotationSize", 10 * 1024 * 1024)
+# columnar archive of all readings, queried with /data
+c.setCfgValue("archiveData", False)
+c.setCfgValue("archiveDirectory", "archive")
+c.setCfgValue("archiveSegmentHours", 24)
 c.setCfgValue("htmlDirectory", "html")
+# static files (CSS, JS, images) kept in memory, and how long browsers may cache them
+c.setCfgValue("staticCacheSize", 16 * 1024 * 1024)
+c.setCfgValue("staticMaxAge", 1000)
 c.setCfgValue("dataDirectory", "data")
 c.setCfgValue("mansosDirectory", "../..")
 c.setCfgValue("sealBlocklyDirectory", "seal-blockly")
@@ -32,10 +53,25 @@ c.setCfgValue("contikiDirectory", "/opt/contiki")
 c.setCfgValue("tinyosDirectory", "/opt/tinyos")
 c.setCfgValue("createDaemon", False)
 c.setCfgValue("serverTheme", "simple")
+c.setCfgValue("maxSessions", 100000)
+# "threads": requests are served by a pool of worker threads, serial ports read by another thread;
+# "eventloop": one thread serves the requests and reads the serial ports
+c.setCfgValue("serverMode", "threads")
+# HTTP server: worker threads, connections waiting for a worker (more get "503 busy"),
+# and seconds an idle keep-alive connection may hold a worker
+c.setCfgValue("workerThreads", 8)
+c.setCfgValue("requestQueueSize", 32)
+c.setCfgValue("keepAliveTimeout", 5)
+# at most this many long-poll requests wait for new data at the same time
+c.setCfgValue("streamMaxWaiters", 4)
 c.setCfgValue("serverWebSettings", ["serverTheme"])
 c.setCfgValue("serverSettingsType", ["[simple, green]"])
 # database config
 c.selectSection("database")
+# "sqlite" (file dbFile in dataDirectory) or "sqlalchemy" (dbUrl, MySQL from the settings below when empty)
+c.setCfgValue("dbBackend", "sqlite")
+c.setCfgValue("dbFile", "observations.db")
+c.setCfgValue("dbUrl", "")
 c.setCfgValue("dbName", "mansosdb")
 c.setCfgValue("dbUsername", "root")
 c.setCfgValue("dbPassword", "ln29Tx")
@@ -44,6 +80,11 @@ c.setCfgValue("senseApiKey", "cJ4Dm_Qb-3stWTWxCJgiFQ")
 c.setCfgValue("senseApiFeeds", "light:37012,humidity:37013,temperature:37014")
 c.setCfgValue("saveToDB", False)
 c.setCfgValue("sendToOpenSense", False)
+# background writer: queued rows, rows per insert, seconds between writes, retries before journaling
+c.setCfgValue("dbQueueSize", 10000)
+c.setCfgValue("dbBatchSize", 500)
+c.setCfgValue("dbFlushInterval", 1)
+c.setCfgValue("dbMaxRetries", 3)
 # user config
 c.selectSection("user")
 c.setCfgValue("userDirectory", "user")
@@ -60,6 +101,8 @@ c.selectSection("graph")
 c.setCfgValue("graphTitle", "Measurements_from_all_motes")
 c.setCfgValue("graphYAxis", "Measurements")
 c.setCfgValue("graphInterval", 1000)
+c.setCfgValue("graphHistorySize", 10000) # readings kept in memory per sensor
+c.setCfgValue("graphMaxPoints", 500) # readings sent to the browser per sensor (downsampled if more)
 c.setCfgValue("graphData", ["[all]"])
 c.setCfgValue("graphAttributes", ["graphTitle", "graphYAxis", "graphInterval", "graphData"])
 
@@ -5,56 +5,106 @@
 from __future__ import print_function
 import configuration
 from uuid import getnode as get_mac
-import datetime
-import json
-import urllib2
-import re
+import os
+import time
+import atexit
+import db_sink
+import storage
 
-connection = None
-engine = None
+backend = None
+backendFailed = False
+dbSink = None
+openSenseSink = None
+mac = None
 
 # Packet
 usePacketSeparator = False
 packetSeparator = "==="
 packet = None
-sampleRe = re.compile('^\w+=\d+(\.\d+)?(,[\da-fA-F]{2})?$')
-
-try:
-    from sqlalchemy import create_engine
-    from sqlalchemy import Table, Column, MetaData
-    from sqlalchemy.types import DateTime, Numeric, Integer, String
-
-    # Database
-    url = "mysql://%s:%s@%s/" + configuration.c.getCfgValue("dbName")
-    username = configuration.c.getCfgValue("dbUsername")
-    password = configuration.c.getCfgValue("dbPassword")
-    host = configuration.c.getCfgValue("dbHost")
-    engine = create_engine(url % (username, password, host))
-    metadata = MetaData()
-    observations = Table('observations', metadata,
-        Column('id', Integer, primary_key = True),
-        Column('obs_time', DateTime),
-        Column('unit_id', String),
-        Column('port', String),
-        Column('type', String),
-        Column('value', Numeric(20,6))
-    )
-except ImportError:
-    # TODO: do not print this if "silent" mode is configured in config file!
-    print("Warning: using a database for data storage is not possible, package dependencies are missing.")
-    print("To store to use a database, install: python-sqlalchemy python-mysqldb\n")
+
+def getSinkSettings():
+    return {"queueSize": configuration.c.getCfgValueAsInt("dbQueueSize"),
+            "batchSize": configuration.c.getCfgValueAsInt("dbBatchSize"),
+            "flushInterval": configuration.c.getCfgValueAsFloat("dbFlushInterval"),
+            "maxRetries": configuration.c.getCfgValueAsInt("dbMaxRetries")}
+
+def getJournalPath(name):
+    dirname = configuration.c.getCfgValue("dataDirectory")
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    return os.path.join(dirname, name + "-journal.jsonl")
+
+def getMac():
+    global mac
+    if mac is None:
+        mac = str(get_mac())
+    return mac
+
+# The configured storage backend, opened on first use and kept open
+# (HTTP threads query it); None if not available
+def getBackend():
+    global backend, backendFailed
+    if backend is None and not backendFailed:
+        backend = storage.openBackend()
+        # not tried again (nor the error printed) until the server is restarted
+        backendFailed = backend is None
+    return backend
 
 def openDBConnection():
-    global connection
-    if configuration.c.getCfgValueAsBool("saveToDB") and engine != None:
-        connection = engine.connect()
+    global dbSink
+    if configuration.c.getCfgValueAsBool("saveToDB") and getBackend() != None:
+        if dbSink is None:
+            dbSink = db_sink.DatabaseSink(backend, getJournalPath("database"), **getSinkSettings())
+            atexit.register(dbSink.stop)
+        dbSink.start()
  
 def closeDBConnection():           
-    global connection
-    if connection != None:
-        connection.close()
-        
-def maybeAddDataToDatabase(port, newString):
+    # write out what is queued
+    if dbSink != None:
+        dbSink.stop()
+    if openSenseSink != None:
+        openSenseSink.stop()
+    # the backend stays open, HTTP threads may be querying it
+
+# Stored readings of a sensor on a mote as [(timestamp in ms, value)], oldest first
+def queryDB(mote, sensorType, fromTs, toTs):
+    if getBackend() is None:
+        return []
+    # the port is saved as the serial port's name
+    ports = [mote, "/dev/" + mote] if not mote.startswith("/") else [mote]
+    return backend.query(ports, sensorType, fromTs, toTs)
+
+# Motes and their sensors stored in the database: {mote: [sensor, ...]}
+def getDBSeries():
+    result = {}
+    if getBackend() is None:
+        return result
+    for (port, sensorType) in backend.getSeries():
+        result.setdefault(os.path.basename(port), []).append(sensorType)
+    for sensors in result.values():
+        sensors.sort()
+    return result
+
+def getOpenSenseSink():
+    global openSenseSink
+    if openSenseSink is None:
+        openSenseSink = db_sink.OpenSenseSink('http://api.sen.se/events/',
+                                              configuration.c.getCfgValue("senseApiKey"),
+                                              getJournalPath("opensense"), **getSinkSettings())
+        atexit.register(openSenseSink.stop)
+    return openSenseSink
+
+# Queue length and write statistics of the sinks
+def getMetrics():
+    result = {}
+    if dbSink != None:
+        result["database"] = dbSink.getMetrics()
+    if openSenseSink != None:
+        result["opensense"] = openSenseSink.getMetrics()
+    return result
+
+# sample: newString parsed by sample_parser.parse()
+def maybeAddDataToDatabase(port, newString, sample):
     global usePacketSeparator, packet
 
     saveToDB = configuration.c.getCfgValueAsBool("saveToDB")
@@ -71,38 +121,37 @@ def maybeAddDataToDatabase(port, newString):
             packet.clear()
         else:
             packet = {}
-    else:
-        s = newString.replace (" ", "")
-        if sampleRe.match(s) != None:
-            arr = s.split("=")
-            if not usePacketSeparator:
-                if saveToDB:
-                    # Save data to DB
-                    saveDataToDB({port+":"+arr[0]: arr[1]})
-                if sendToOpenSense:
-                    #Send data to sen.se
-                    sendDataToOpenSense({port+":"+arr[0]: arr[1]})                               
-            else:
-                packet[port+":"+arr[0]] = arr[1]
+    elif sample is not None and sample.crcOk and sample.value is not None:
+        # readings relayed by a base station carry the address of the mote
+        # they are from; use it instead of the port, as MoteData does
+        key = (sample.address or port, sample.name)
+        if not usePacketSeparator:
+            if saveToDB:
+                # Save data to DB
+                saveDataToDB({key: sample.value})
+            if sendToOpenSense:
+                #Send data to sen.se
+                sendDataToOpenSense({key: sample.value})
         else:
-            print("ERROR: received incorrectly formatted sensor data via serial port!\n")
-        
+            packet[key] = sample.value
+    else:
+        print("ERROR: received incorrectly formatted sensor data via serial port!\n")
+
+# Queue the packet for the database writer
 def saveDataToDB(packet):
-    global connection
-    
-    mac = str(get_mac())
-    for key in packet.keys():
-        arr = key.split(":")
-        val = packet[key]
-        ins = observations.insert().values(obs_time = datetime.datetime.now(), unit_id = mac, port = arr[0], type = arr[1], value = val)
-        connection.execute(ins)
+    if dbSink == None:
+        return
+    now = time.time()
+    unitId = getMac()
+    rows = []
+    for ((port, sensorType), value) in packet.items():
+        rows.append({"obs_time": now, "unit_id": unitId, "port": port,
+                     "type": sensorType, "value": value})
+    dbSink.put(rows)
 
+# Queue the packet for sending to sen.se
 def sendDataToOpenSense(packet):
-    url = 'http://api.sen.se/events/'
-    header = {
-      'sense_key' : configuration.c.getCfgValue("senseApiKey"),
-    }
-    feeds = configuration.c.getCfgValue("senseApiFeeds")
+    feeds = configuration.c.getCfgValueAsList("senseApiFeeds")
     type2feedMap = {}
     for feed in feeds:
         arr = feed.split(":")
@@ -110,20 +159,13 @@ def sendDataToOpenSense(packet):
         feedId = arr[1]
         type2feedMap[sensorType] = feedId   
     data = []
-    #mac = str(get_mac())
-    for key in packet.keys():
-        arr = key.split(":")
-        #port = arr[0]
-        sensorType = arr[1]
-        value = packet[key]
+    for ((port, sensorType), value) in packet.items():
+        if sensorType not in type2feedMap:
+            continue
         measurement = {
             "feed_id": type2feedMap[sensorType],
-            "value":   value 
+            "value":   value
         }
         data.append(measurement)
-    data_json = json.dumps(data)
-    req = urllib2.Request(url, data_json, header)
-    response_stream = urllib2.urlopen(req)
-    json_response = response_stream.read()
-    #print json_response
-
+    if data:
+        getOpenSenseSink().put(data)
@@ -0,0 +1,155 @@
+#
+# MansOS web server - buffered writer for processed sensor data files
+#
+
+from __future__ import print_function
+import os, time, threading, atexit, collections
+import configuration
+
+# -------------------------------------
+# One open per-sensor CSV file with its pending rows
+class DataFile(object):
+    def __init__(self, path, dataName):
+        self.path = path
+        self.dataName = dataName
+        self.handle = open(path, "a")
+        self.size = os.path.getsize(path)
+        self.rows = []
+        self.pendingBytes = 0
+        if self.size == 0:
+            self.add("serverTimestampUnix\tserverTimestamp\t" + dataName + "\n")
+
+    def add(self, row):
+        self.rows.append(row)
+        self.pendingBytes += len(row)
+
+    def flush(self):
+        if self.rows:
+            self.handle.write("".join(self.rows))
+            self.handle.flush()
+            self.size += self.pendingBytes
+            self.rows = []
+            self.pendingBytes = 0
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.handle.close()
+
+
+# -------------------------------------
+# Keeps per-sensor files open (at most maxOpenFiles, least recently used
+# are closed first), buffers rows in memory and writes them out when
+# flushBytes are pending or flushInterval seconds have passed.
+# Files are optionally rotated daily or when they grow over rotationSize.
+class ProcessedDataWriter(object):
+    def __init__(self):
+        self.files = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.lastFlush = time.time()
+        self.pendingBytes = 0
+        self.lastSecond = None
+        self.lastSecondText = ""
+        self.loadSettings()
+
+    def loadSettings(self):
+        c = configuration.c
+        self.maxOpenFiles = max(1, c.getCfgValueAsInt("dataMaxOpenFiles"))
+        self.flushInterval = c.getCfgValueAsFloat("dataFlushInterval")
+        self.flushBytes = c.getCfgValueAsInt("dataFlushBytes")
+        self.rotation = c.getCfgValue("dataRotation").lower()
+        self.rotationSize = c.getCfgValueAsInt("dataRotationSize")
+
+    def formatTime(self, now):
+        second = int(now)
+        if second != self.lastSecond:
+            self.lastSecond = second
+            self.lastSecondText = time.strftime("%d %b %Y %H:%M:%S", time.localtime(second))
+        return self.lastSecondText
+
+    def getFilename(self, dirname, dataName, now):
+        if self.rotation == "daily":
+            return os.path.join(dirname, dataName + time.strftime("-%Y-%m-%d", time.localtime(now)) + ".csv")
+        return os.path.join(dirname, dataName + ".csv")
+
+    def getFile(self, dirname, dataName, now):
+        path = self.getFilename(dirname, dataName, now)
+        key = (dirname, dataName)
+        f = self.files.pop(key, None)
+        if f is not None and f.path != path:
+            # the day has changed
+            self.pendingBytes -= f.pendingBytes
+            f.close()
+            f = None
+        if f is None:
+            while len(self.files) >= self.maxOpenFiles:
+                (oldKey, old) = self.files.popitem(last = False)
+                self.pendingBytes -= old.pendingBytes
+                old.close()
+            f = DataFile(path, dataName)
+            self.pendingBytes += f.pendingBytes
+        # most recently used files are at the end
+        self.files[key] = f
+        return f
+
+    def rotate(self, key, f):
+        self.pendingBytes -= f.pendingBytes
+        f.close()
+        (base, ext) = os.path.splitext(f.path)
+        base += time.strftime("-%Y%m%d-%H%M%S")
+        newPath = base + ext
+        i = 1
+        while os.path.exists(newPath):
+            newPath = base + "-" + str(i) + ext
+            i += 1
+        try:
+            os.rename(f.path, newPath)
+        except OSError as e:
+            print("Failed to rotate data file " + f.path + ": " + str(e))
+        del self.files[key]
+
+    def write(self, dirname, dataName, value, now = None):
+        if now is None:
+            now = time.time()
+        row = "{}\t{}\t{}\n".format(int(round(now)), self.formatTime(now), value)
+        with self.lock:
+            f = self.getFile(dirname, dataName, now)
+            f.add(row)
+            self.pendingBytes += len(row)
+            if self.pendingBytes >= self.flushBytes:
+                self.flushAll()
+            if self.rotation == "size" \
+                    and f.size + f.pendingBytes >= self.rotationSize:
+                self.rotate((dirname, dataName), f)
+
+    def flushAll(self):
+        for f in self.files.itervalues():
+            f.flush()
+        self.pendingBytes = 0
+        self.lastFlush = time.time()
+
+    # Called periodically from the serial listener thread
+    def flushIfDue(self):
+        if self.pendingBytes and time.time() - self.lastFlush >= self.flushInterval:
+            with self.lock:
+                self.flushAll()
+
+    def flush(self):
+        with self.lock:
+            self.flushAll()
+
+    def close(self):
+        with self.lock:
+            for f in self.files.itervalues():
+                try:
+                    f.close()
+                except Exception as e:
+                    print("Failed to close data file " + f.path + ": " + str(e))
+            self.files.clear()
+            self.pendingBytes = 0
+
+
+# -------------------------------------
+writer = ProcessedDataWriter()
+atexit.register(writer.close)
@@ -0,0 +1,210 @@
+#
+# MansOS web server - background writers for database and sen.se data
+#
+# The serial listener only puts rows in a bounded queue; a writer thread
+# takes them out in batches and writes each batch at once, retrying with
+# backoff. Rows that can not be written (target down, queue full) are
+# appended to a JSON-lines journal file and written later, when the
+# target works again.
+#
+
+from __future__ import print_function
+import os, json, time, threading, urllib2
+try:
+    import Queue
+except ImportError:
+    import queue as Queue
+
+# backoff between retries, seconds
+MIN_BACKOFF = 1.0
+MAX_BACKOFF = 60.0
+
+# -------------------------------------
+class Sink(object):
+    def __init__(self, name, write, journalPath, queueSize = 10000, batchSize = 500,
+                 flushInterval = 1.0, maxRetries = 3):
+        self.name = name
+        self.write = write
+        self.journalPath = journalPath
+        self.queue = Queue.Queue(queueSize)
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxRetries = maxRetries
+        self.journalLock = threading.Lock()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = False
+        self.backoff = MIN_BACKOFF
+        self.retryAt = 0
+        # metrics
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.failures = 0
+        self.lastError = None
+
+    # Called from the serial listener; never blocks
+    def put(self, rows):
+        self.start()
+        for row in rows:
+            try:
+                self.queue.put_nowait(row)
+            except Queue.Full:
+                self.spill([row])
+
+    def start(self):
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.stopping = False
+                self.thread = threading.Thread(target = self.run, name = self.name + "-writer")
+                self.thread.daemon = True
+                self.thread.start()
+
+    # Write out what is queued and stop the writer thread;
+    # what is not written in time is journaled
+    def stop(self, timeout = 10):
+        with self.lock:
+            thread = self.thread
+            if thread is None:
+                return
+            self.stopping = True
+        thread.join(timeout)
+        with self.lock:
+            self.thread = None
+        rows = []
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        if rows:
+            self.spill(rows)
+
+    def getMetrics(self):
+        return {"queued": self.queue.qsize(),
+                "journaled": self.journalSize(),
+                "written": self.written,
+                "batches": self.batches,
+                "spilled": self.spilled,
+                "replayed": self.replayed,
+                "failures": self.failures,
+                "lastError": self.lastError}
+
+    # Called by the writer thread when it is stopped or the target failed
+    def disconnect(self):
+        pass
+
+    def getBatch(self):
+        try:
+            rows = [self.queue.get(timeout = self.flushInterval)]
+        except Queue.Empty:
+            return []
+        while len(rows) < self.batchSize:
+            try:
+                rows.append(self.queue.get_nowait())
+            except Queue.Empty:
+                break
+        return rows
+
+    def tryWrite(self, rows):
+        if time.time() < self.retryAt:
+            return False
+        for attempt in range(self.maxRetries):
+            try:
+                self.write(rows)
+                self.written += len(rows)
+                self.batches += 1
+                self.backoff = MIN_BACKOFF
+                self.retryAt = 0
+                return True
+            except Exception as e:
+                self.failures += 1
+                self.lastError = str(e)
+                print("{}: write failed: {}".format(self.name, e))
+                self.disconnect()
+                if attempt + 1 < self.maxRetries and not self.stopping:
+                    time.sleep(self.backoff)
+                    self.backoff = min(self.backoff * 2, MAX_BACKOFF)
+        # do not try again for a while, journal the data meanwhile
+        self.retryAt = time.time() + self.backoff
+        return False
+
+    def run(self):
+        while True:
+            rows = self.getBatch()
+            if rows:
+                if not self.tryWrite(rows):
+                    self.spill(rows)
+            elif self.stopping:
+                break
+            if time.time() >= self.retryAt and self.journalSize():
+                self.replay()
+        self.disconnect()
+
+    def journalSize(self):
+        try:
+            return os.path.getsize(self.journalPath)
+        except OSError:
+            return 0
+
+    def spill(self, rows):
+        with self.journalLock:
+            try:
+                with open(self.journalPath, "a") as f:
+                    f.write("".join([json.dumps(r, separators = (',', ':')) + "\n" for r in rows]))
+                self.spilled += len(rows)
+            except (IOError, OSError) as e:
+                print("{}: lost {} rows, failed to write journal: {}".format(self.name, len(rows), e))
+
+    # Write the journaled rows to the target
+    def replay(self):
+        replayPath = self.journalPath + ".replay"
+        with self.journalLock:
+            if not os.path.exists(replayPath):
+                try:
+                    os.rename(self.journalPath, replayPath)
+                except OSError:
+                    return
+        with open(replayPath, "r") as f:
+            lines = f.readlines()
+        for i in range(0, len(lines), self.batchSize):
+            rows = []
+            for line in lines[i:i + self.batchSize]:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    pass # cut short by a crash
+            if not self.tryWrite(rows):
+                # keep the rest for later
+                with self.journalLock:
+                    with open(self.journalPath, "a") as f:
+                        f.write("".join(lines[i:]))
+                break
+            self.replayed += len(rows)
+        os.remove(replayPath)
+
+
+# -------------------------------------
+# Rows: {"obs_time": <seconds since 1970>, "unit_id", "port", "type", "value"}
+class DatabaseSink(Sink):
+    def __init__(self, backend, journalPath, **kwargs):
+        Sink.__init__(self, "database", backend.insertMany, journalPath, **kwargs)
+        self.backend = backend   # see storage
+
+
+# -------------------------------------
+# Rows: {"feed_id", "value"}
+class OpenSenseSink(Sink):
+    def __init__(self, url, apiKey, journalPath, timeout = 10, **kwargs):
+        Sink.__init__(self, "sen.se", self.post, journalPath, **kwargs)
+        self.url = url
+        self.apiKey = apiKey
+        self.timeout = timeout
+
+    def post(self, rows):
+        req = urllib2.Request(self.url, json.dumps(rows), {'sense_key': self.apiKey})
+        urllib2.urlopen(req, timeout = self.timeout).read()
+
@@ -0,0 +1,100 @@
+#
+# MansOS web server - downsampling of (timestamp, value) series for graphs
+#
+
+from __future__ import print_function
+
+METHODS = ["lttb", "minmax", "decimate"]
+
+# Keep every n-th point
+def decimate(points, threshold):
+    length = len(points)
+    if threshold <= 0 or length <= threshold:
+        return list(points)
+    step = float(length) / threshold
+    return [points[int(i * step)] for i in range(threshold)]
+
+# Split the series in threshold/2 buckets and keep the smallest and the largest
+# value of each bucket (in time order). Preserves peaks, good for noisy data.
+def minmax(points, threshold):
+    length = len(points)
+    if threshold <= 0 or length <= threshold:
+        return list(points)
+    numBuckets = max(1, threshold // 2)
+    step = float(length) / numBuckets
+    result = []
+    for b in range(numBuckets):
+        start = int(b * step)
+        end = int((b + 1) * step)
+        if end <= start:
+            continue
+        lo = hi = start
+        for i in range(start + 1, end):
+            v = points[i][1]
+            if v < points[lo][1]:
+                lo = i
+            elif v > points[hi][1]:
+                hi = i
+        if lo == hi:
+            result.append(points[lo])
+        elif lo < hi:
+            result.append(points[lo])
+            result.append(points[hi])
+        else:
+            result.append(points[hi])
+            result.append(points[lo])
+    return result
+
+# Largest-Triangle-Three-Buckets (Sveinn Steinarsson, 2013).
+# Keeps the first and the last point, and from each of the (threshold - 2) buckets
+# in between the point that forms the largest triangle with the point selected
+# from the previous bucket and the average of the next bucket.
+def lttb(points, threshold):
+    length = len(points)
+    if threshold <= 0 or length <= threshold:
+        return list(points)
+    if threshold < 3:
+        return [points[0], points[-1]][:threshold]
+
+    result = [points[0]]
+    step = float(length - 2) / (threshold - 2)
+    a = 0
+    for b in range(threshold - 2):
+        # average of the next bucket
+        avgStart = int((b + 1) * step) + 1
+        avgEnd = min(int((b + 2) * step) + 1, length)
+        avgCount = avgEnd - avgStart
+        avgX = avgY = 0.0
+        for i in range(avgStart, avgEnd):
+            avgX += points[i][0]
+            avgY += points[i][1]
+        if avgCount > 0:
+            avgX /= avgCount
+            avgY /= avgCount
+        else:
+            (avgX, avgY) = points[-1]
+
+        # the point of this bucket with the largest triangle area
+        (ax, ay) = points[a]
+        rangeStart = int(b * step) + 1
+        rangeEnd = int((b + 1) * step) + 1
+        maxArea = -1.0
+        maxIndex = rangeStart
+        for i in range(rangeStart, rangeEnd):
+            (x, y) = points[i]
+            area = abs((ax - avgX) * (y - ay) - (ax - x) * (avgY - ay))
+            if area > maxArea:
+                maxArea = area
+                maxIndex = i
+        result.append(points[maxIndex])
+        a = maxIndex
+
+    result.append(points[-1])
+    return result
+
+def downsample(points, threshold, method = "lttb"):
+    if method == "minmax":
+        return minmax(points, threshold)
+    if method == "decimate":
+        return decimate(points, threshold)
+    return lttb(points, threshold)
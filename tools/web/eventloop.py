@@ -0,0 +1,284 @@
+#
+# MansOS web server - single-threaded event loop server mode
+#
+# One thread select()s on the listening socket, the client connections and
+# the serial ports being listened to. A request is read without blocking
+# until it is complete, then the usual handler class runs on a buffered copy
+# of it, and the response is written back without blocking. Serial data is
+# parsed in the same thread, so the sensor data is never accessed
+# concurrently. Handlers themselves still run to completion, so pages that
+# compile or upload code hold up the loop while they run.
+#
+
+from __future__ import print_function
+import os, re, time, socket, select, errno, traceback
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import BytesIO as StringIO
+import poolserver
+import helper_tools as ht
+import data_writer
+import archive
+
+RECV_SIZE = 65536
+# largest request (headers and body) accepted
+MAX_REQUEST_SIZE = 16 * 1024 * 1024
+# how often serial ports that can not be select()ed are polled, seconds
+SERIAL_POLL_INTERVAL = 0.01
+# how often buffered data files are checked, seconds
+FLUSH_CHECK_INTERVAL = 1.0
+
+contentLengthPattern = re.compile(r'^content-length:\s*(\d+)\s*$', re.IGNORECASE | re.MULTILINE)
+
+# -------------------------------------
+# The output side of a BufferedRequest; keeps the data after close()
+class OutputBuffer(StringIO):
+    def close(self):
+        pass
+
+# Looks enough like a socket for StreamRequestHandler
+class BufferedRequest(object):
+    def __init__(self, data, connection):
+        self.connection = connection
+        self.input = StringIO(data)
+        self.output = OutputBuffer()
+
+    def makefile(self, mode, bufsize = -1):
+        return self.input if 'r' in mode else self.output
+
+    def settimeout(self, timeout):
+        pass
+
+    def setsockopt(self, *args):
+        pass
+
+# Serve only one request per handler; the connection is kept by the loop
+class SingleRequestHandlerMixin:
+    def handle(self):
+        self.close_connection = 1
+        self.handle_one_request()
+
+def makeHandlerClass(handlerClass):
+    class EventLoopHandler(SingleRequestHandlerMixin, handlerClass):
+        pass
+    return EventLoopHandler
+
+# Return length of the first complete request in data, or 0
+def requestLength(data):
+    end = data.find(b"\r\n\r\n")
+    if end == -1:
+        return 0
+    end += 4
+    m = contentLengthPattern.search(data, 0, end)
+    if m:
+        end += int(m.group(1))
+    return end if len(data) >= end else 0
+
+# -------------------------------------
+class Connection(object):
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.input = b""
+        self.output = b""
+        self.keepAlive = True
+        self.lastActive = time.time()
+        self.takeOver = None
+
+    def fileno(self):
+        return self.sock.fileno()
+
+
+# -------------------------------------
+class EventLoopServer(object):
+    def __init__(self, serverAddress, handlerClass,
+                 keepAliveTimeout = poolserver.DEFAULT_KEEP_ALIVE_TIMEOUT):
+        self.RequestHandlerClass = makeHandlerClass(handlerClass)
+        self.keepAliveTimeout = keepAliveTimeout
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(serverAddress)
+        self.socket.listen(64)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        (host, self.server_port) = self.server_address[:2]
+        self.server_name = socket.getfqdn(host)
+        self.connections = {}
+        self.stopping = False
+        (self.wakeupRead, self.wakeupWrite) = poolserver.makeWakeupPair()
+        self.lastFlushCheck = time.time()
+        # in this mode the loop reads the serial ports
+        ht.useListenThread = False
+
+    def fileno(self):
+        return self.socket.fileno()
+
+    # Handlers must not block this thread
+    blockingAllowed = False
+
+    # Hand the connection over to takeOver(socket) once the response so far is sent
+    def detach(self, request, takeOver):
+        request.connection.takeOver = takeOver
+
+    def stop(self):
+        self.stopping = True
+        try:
+            if os.name == "posix":
+                os.write(self.wakeupWrite, b"x")
+            else:
+                self.wakeupWrite.send(b"x")
+        except (OSError, socket.error):
+            pass
+
+    def acceptConnections(self):
+        while True:
+            try:
+                (sock, address) = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            sock.setblocking(0)
+            self.connections[sock.fileno()] = Connection(sock, address)
+
+    def closeConnection(self, conn):
+        self.connections.pop(conn.fileno(), None)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+
+    def runHandler(self, conn, data):
+        request = BufferedRequest(data, conn)
+        try:
+            handler = self.RequestHandlerClass(request, conn.address, self)
+            conn.keepAlive = not handler.close_connection
+        except Exception:
+            self.handle_error(request, conn.address)
+            conn.keepAlive = False
+        conn.output += request.output.getvalue()
+
+    def handle_error(self, request, clientAddress):
+        print('-' * 40)
+        print('Exception happened during processing of request from', clientAddress)
+        traceback.print_exc()
+        print('-' * 40)
+
+    def readConnection(self, conn):
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b""
+        if not data:
+            self.closeConnection(conn)
+            return
+        conn.lastActive = time.time()
+        conn.input += data
+        while conn.keepAlive:
+            length = requestLength(conn.input)
+            if length == 0:
+                break
+            request = conn.input[:length]
+            conn.input = conn.input[length:]
+            self.runHandler(conn, request)
+            if conn.takeOver is not None:
+                return self.detachConnection(conn)
+        if len(conn.input) > MAX_REQUEST_SIZE:
+            self.closeConnection(conn)
+        else:
+            self.writeConnection(conn)
+
+    def detachConnection(self, conn):
+        self.connections.pop(conn.fileno(), None)
+        try:
+            # just the response headers, this does not take long
+            conn.sock.setblocking(1)
+            conn.sock.sendall(conn.output)
+            conn.takeOver(conn.sock)
+        except Exception:
+            self.handle_error(None, conn.address)
+            conn.sock.close()
+
+    def writeConnection(self, conn):
+        if conn.output:
+            try:
+                sent = conn.sock.send(conn.output)
+                conn.output = conn.output[sent:]
+                conn.lastActive = time.time()
+            except socket.error as e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    self.closeConnection(conn)
+                    return
+        if not conn.output and not conn.keepAlive:
+            self.closeConnection(conn)
+
+    # Return (serial ports to select() on, whether some ports must be polled)
+    def getSerialPorts(self):
+        ports = {}
+        mustPoll = False
+        for m in ht.getListenedMotes():
+            if m.port is None:
+                continue
+            try:
+                ports[m.port.fileno()] = m
+            except (AttributeError, ValueError, IOError):
+                mustPoll = True
+        return (ports, mustPoll)
+
+    def doPeriodicWork(self, now):
+        if now - self.lastFlushCheck >= FLUSH_CHECK_INTERVAL:
+            self.lastFlushCheck = now
+            data_writer.writer.flushIfDue()
+            archive.archive.flushIfDue()
+            for conn in list(self.connections.values()):
+                if not conn.output and now - conn.lastActive > self.keepAliveTimeout:
+                    self.closeConnection(conn)
+
+    def serve_forever(self, poll_interval = None):
+        try:
+            while not self.stopping:
+                (ports, mustPoll) = self.getSerialPorts()
+                readers = [self, self.wakeupRead] + list(self.connections.values()) + list(ports.keys())
+                writers = [c for c in self.connections.values() if c.output]
+                timeout = SERIAL_POLL_INTERVAL if mustPoll else FLUSH_CHECK_INTERVAL
+                try:
+                    r, w, e = select.select(readers, writers, [], timeout)
+                except (select.error, OSError) as e:
+                    if e.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if self.wakeupRead in r:
+                    break
+                if self in r:
+                    self.acceptConnections()
+                for item in r:
+                    if isinstance(item, Connection) and item.fileno() in self.connections:
+                        self.readConnection(item)
+                    elif item in ports:
+                        ht.processMote(ports[item])
+                for conn in w:
+                    if conn.fileno() in self.connections:
+                        self.writeConnection(conn)
+                if mustPoll:
+                    for m in ht.getListenedMotes():
+                        ht.processMote(m)
+                self.doPeriodicWork(time.time())
+        finally:
+            self.server_close()
+
+    def server_close(self):
+        for conn in list(self.connections.values()):
+            self.closeConnection(conn)
+        self.socket.close()
+        if os.name == "posix":
+            for fd in (self.wakeupRead, self.wakeupWrite):
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+        else:
+            self.wakeupRead.close()
+            self.wakeupWrite.close()
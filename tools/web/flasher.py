@@ -0,0 +1,144 @@
+#
+# MansOS web server - parallel mote flashing
+#
+# Each mote to be flashed is a job; a pool of worker threads runs the jobs.
+# At most uploadParallel jobs run at once, and at most uploadPerHub of them
+# on the motes behind one USB hub (remote motes: behind one remote access
+# server), as a hub has neither the bandwidth nor the power to program all of
+# its ports at once. A failed job is retried on its own, up to uploadRetries
+# times, after the other jobs have had their turn.
+# Output lines are prefixed with the port name of the mote.
+#
+
+from __future__ import print_function
+import os, re, time, threading
+import configuration
+from motes import writeOutput
+
+# USB device names in sysfs: "<bus>-<port>[.<port>...]"
+usbDeviceRe = re.compile(r"^\d+-[\d.]+$")
+
+# Return the name of the USB hub the mote is connected to;
+# motes for which it is not known are on their own
+def getHub(mote):
+    if not mote.isLocal():
+        return "host:" + mote.getHostName()
+    port = os.path.realpath(mote.getPortName())
+    devicePath = os.path.join("/sys/class/tty", os.path.basename(port), "device")
+    if os.path.exists(devicePath):
+        devices = [p for p in os.path.realpath(devicePath).split("/") if usbDeviceRe.match(p)]
+        if devices:
+            # "1-1.4" is on port 4 of hub "1-1"; "1-1" is on the root hub of bus 1
+            device = devices[-1]
+            if "." in device:
+                return "usb:" + device.rsplit(".", 1)[0]
+            return "usb:" + device.split("-")[0]
+    return port
+
+# -------------------------------------
+class FlashJob(object):
+    # action(prefix) flashes the mote and returns the exit code, 0 on success
+    def __init__(self, mote, action):
+        self.mote = mote
+        self.action = action
+        self.name = mote.getPortBasename() if mote.isLocal() else mote.getFullBasename()
+        self.prefix = "[" + self.name + "] "
+        self.hub = getHub(mote)
+        self.retcode = None
+        self.attempts = 0
+        self.elapsed = 0.0
+
+    def run(self):
+        self.attempts += 1
+        start = time.time()
+        try:
+            self.retcode = self.action(self.prefix)
+        except Exception as e:
+            writeOutput(self.prefix + "exception: " + str(e) + "\n")
+            self.retcode = 1
+        self.elapsed += time.time() - start
+        return self.retcode
+
+
+# -------------------------------------
+class Flasher(object):
+    def __init__(self, maxParallel = 8, maxPerHub = 4, retries = 1):
+        self.maxParallel = max(1, maxParallel)
+        self.maxPerHub = maxPerHub   # 0: no limit
+        self.retries = retries
+        self.cond = threading.Condition()
+        self.pending = []
+        self.active = 0
+        self.hubUse = {}
+
+    # Run all jobs; return 0 if all succeeded, else the last failed exit code
+    def run(self, jobs):
+        if not jobs:
+            return 0
+        start = time.time()
+        self.pending = list(jobs)
+        self.active = 0
+        self.hubUse = {}
+        workers = []
+        for i in range(min(self.maxParallel, len(jobs))):
+            t = threading.Thread(target = self.worker, name = "flasher-" + str(i))
+            t.daemon = True
+            t.start()
+            workers.append(t)
+        for t in workers:
+            t.join()
+
+        retcode = 0
+        failed = [job for job in jobs if job.retcode]
+        for job in failed:
+            retcode = job.retcode
+        writeOutput("Flashed {} of {} motes in {:.1f} s{}\n".format(
+                len(jobs) - len(failed), len(jobs), time.time() - start,
+                "; failed: " + ", ".join([job.name for job in failed]) if failed else ""))
+        return retcode
+
+    # Take the first pending job whose hub is not busy; None if there is none
+    def nextJob(self):
+        for job in self.pending:
+            if not self.maxPerHub or self.hubUse.get(job.hub, 0) < self.maxPerHub:
+                self.pending.remove(job)
+                return job
+        return None
+
+    def worker(self):
+        while True:
+            with self.cond:
+                job = self.nextJob()
+                while job is None:
+                    if not self.pending and self.active == 0:
+                        return
+                    # wait for a hub to become free or a failed job to come back
+                    self.cond.wait()
+                    job = self.nextJob()
+                self.active += 1
+                self.hubUse[job.hub] = self.hubUse.get(job.hub, 0) + 1
+
+            if job.attempts:
+                writeOutput(job.prefix + "retrying, attempt {}\n".format(job.attempts + 1))
+            retcode = job.run()
+
+            with self.cond:
+                self.active -= 1
+                self.hubUse[job.hub] -= 1
+                if retcode == 0:
+                    writeOutput(job.prefix + "done in {:.1f} s\n".format(job.elapsed))
+                elif job.attempts <= self.retries:
+                    writeOutput(job.prefix + "failed with code {}, will retry\n".format(retcode))
+                    self.pending.append(job)
+                else:
+                    writeOutput(job.prefix + "failed with code {}\n".format(retcode))
+                self.cond.notify_all()
+
+
+# Flash the motes with the limits from the configuration
+def flashAll(jobs):
+    c = configuration.c
+    flasher = Flasher(c.getCfgValueAsInt("uploadParallel"),
+                      c.getCfgValueAsInt("uploadPerHub"),
+                      c.getCfgValueAsInt("uploadRetries"))
+    return flasher.run(jobs)
@@ -6,12 +6,17 @@ import time
 from motes import motes
 import moteconfig
 import sensor_data
+import sample_parser
 import configuration
 import data_utils
+import data_writer
+import archive
 
 isListening = False
 listenThread = None
 selectedMote = None
+# when False, serial ports are read by the event loop server instead of a thread
+useListenThread = True
 
 # Process mote data if available
 def processMote(m):
@@ -29,12 +34,14 @@ def processMote(m):
         pos = m.buffer.find('\n')
         if pos != 0:
             newString = m.buffer[:pos].strip()
+            # parsed once, for both the database and the graphs
+            sample = sample_parser.parse(newString)
             saveToDB = configuration.c.getCfgValue("saveToDB")
             sendToOpenSense = configuration.c.getCfgValue("sendToOpenSense")
             if saveToDB or sendToOpenSense:
-                data_utils.maybeAddDataToDatabase(m.port.port, newString)
+                data_utils.maybeAddDataToDatabase(m.port.port, newString, sample)
             # print "got", newString
-            sensor_data.moteData.addNewData(newString, m.port.portstr)
+            sensor_data.moteData.addNewData(newString, m.port.portstr, sample)
         m.buffer = m.buffer[pos + 1:]
 
 # Listen to all selected motes
@@ -44,7 +51,8 @@ def listenSerial():
     while isListening:
         for m in motes.getMotes():
             processMote(m)
-        sensor_data.moteData.fixSizes()
+        data_writer.writer.flushIfDue()
+        archive.archive.flushIfDue()
         # pause for a bit
         time.sleep(0.01)
    
@@ -55,7 +63,8 @@ def listenSerialSingle():
     
     while isListening:
         processMote(selectedMote)
-        sensor_data.moteData.fixSizes()
+        data_writer.writer.flushIfDue()
+        archive.archive.flushIfDue()
         # pause for a bit
         time.sleep(0.01)        
 
@@ -63,11 +72,15 @@ def listenSerialSingle():
 def openAllSerial():
     global isListening
     global listenThread
+    global selectedMote
     
     if isListening: return
     isListening = True
-    listenThread = threading.Thread(target = listenSerial)
-    listenThread.start()
+    selectedMote = None
+    if useListenThread:
+        listenThread = threading.Thread(target = listenSerial)
+        listenThread.daemon = True
+        listenThread.start()
     for m in motes.getMotes():
         m.tryToOpenSerial(False)
 
@@ -83,8 +96,18 @@ def openMoteSerial(mote):
     if mote.port != None:
         selectedMote = mote
         mote.tryToOpenSerial(False)
-    listenThread = threading.Thread(target = listenSerialSingle)
-    listenThread.start()
+    if useListenThread:
+        listenThread = threading.Thread(target = listenSerialSingle)
+        listenThread.daemon = True
+        listenThread.start()
+
+# Motes that are being listened to
+def getListenedMotes():
+    if not isListening:
+        return []
+    if selectedMote is not None:
+        return [selectedMote]
+    return motes.getMotes()
 
 # Close all serial ports
 def closeAllSerial():
@@ -96,4 +119,6 @@ def closeAllSerial():
         listenThread.join()
         listenThread = None
     for m in motes.getMotes():
-        m.ensureSerialIsClosed()
\ No newline at end of file
+        m.ensureSerialIsClosed()
+    data_writer.writer.close()
+    archive.archive.flush()
\ No newline at end of file
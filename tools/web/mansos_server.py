@@ -5,7 +5,7 @@
 #
 
 from __future__ import print_function
-import os, sys, platform, select, signal, traceback, string
+import os, sys, platform, signal, traceback, string, time
 from urllib2 import URLError
 # add library directory to the path
 sys.path.append(os.path.join(os.getcwd(), '..', "lib"))
@@ -16,7 +16,10 @@ import pages.page_user as page_user
 import pages.page_graph as page_graph
 import pages.page_config as page_config
 import pages.page_upload as page_upload
+import pages.page_data as page_data
 import data_utils
+import templates
+import asset_cache
 import utils
 import user
 import session
@@ -27,6 +30,9 @@ import daemon
 import configuration
 import mansos_version
 import helper_tools as ht
+import poolserver
+import eventloop
+import broadcast
 import urllib2
 
 DEBUG = 0
@@ -44,6 +50,8 @@ else:
     from urlparse import *
 
 isListening = False
+# longest long-poll wait, seconds
+MAX_WAIT = 30
 
 #lastUploadCode = ""
 #lastUploadConfig = ""
@@ -54,7 +62,8 @@ allSessions = None
 allUsers = None
 
 # --------------------------------------------
-class HttpServerHandler(BaseHTTPRequestHandler,
+class HttpServerHandler(poolserver.KeepAliveHandlerMixin,
+                        BaseHTTPRequestHandler,
                         page_user.PageUser,
                         page_account.PageAccount,
                         page_login.PageLogin,
@@ -62,6 +71,7 @@ class HttpServerHandler(BaseHTTPRequestHandler,
                         page_graph.PageGraph,
                         page_config.PageConfig,
                         page_upload.PageUpload,
+                        page_data.PageData,
                         session.SetAndServeSessionAndHeader):
     server_version = 'MansOS/' + mansos_version.getMansosVersion(
         configuration.c.getCfgValue("mansosDirectory")) + ' Web Server'
@@ -102,9 +112,8 @@ class HttpServerHandler(BaseHTTPRequestHandler,
 
     def serveAnyPage(self, name, qs, isGeneric = True, replaceValues = None, urlTo = "", 
             title = None, content = None, infoMsg = None, errorMsg = None, generatedContentOnly = False):
-        f = open(self.htmlDirectory + "/layout.html", "r")
-        contents = f.read()
-        t = string.Template(contents)
+        startTime = time.time()
+        layout = templates.cache.get(self.htmlDirectory + "/layout.html", templates.DOLLAR)
         
         self.headerIsServed = True
         if name == "default":
@@ -116,68 +125,46 @@ class HttpServerHandler(BaseHTTPRequestHandler,
            
         if errorMsg != None:
            qs["no"] = "no"   
-           
+
+        sma = ""
+        if "sma" in qs: 
+            sma = qs["sma"][0]
+        menuValues = {}
+        if "sma" in qs: menuValues["SMA"] = sma
+        if replaceValues:
+            menuValues.update(replaceValues)
+
         suffix = "generic" if isGeneric else "mote"
-        menuContent = ""
-        with open(self.htmlDirectory + "/menu-" + suffix + ".html", "r") as f:
-            localMenuContent = f.read()
-            if replaceValues:
-                for v in replaceValues:
-                    localMenuContent = localMenuContent.replace("%" + v + "%", replaceValues[v])
-            if "sma" in qs: localMenuContent = localMenuContent.replace("%SMA%", qs["sma"][0])
-            menuContent += localMenuContent
-            
+        menus = ["menu-" + suffix]
         if isGeneric:
             if self.getLevel() > 0:
-                with open(self.htmlDirectory + "/menu-1.html", "r") as f:
-                    localMenuContent = f.read()
-                    if replaceValues:
-                        for v in replaceValues:
-                            localMenuContent = localMenuContent.replace("%" + v + "%", replaceValues[v])
-                    if "sma" in qs: localMenuContent = localMenuContent.replace("%SMA%", qs["sma"][0])
-                    menuContent += localMenuContent
+                menus.append("menu-1")
             if self.getLevel() > 7:
-                with open(self.htmlDirectory + "/menu-8.html", "r") as f:
-                    localMenuContent = f.read()
-                    if replaceValues:
-                        for v in replaceValues:
-                            localMenuContent = localMenuContent.replace("%" + v + "%", replaceValues[v])
-                    if "sma" in qs: localMenuContent = localMenuContent.replace("%SMA%", qs["sma"][0])
-                    menuContent += localMenuContent
+                menus.append("menu-8")
             if self.getLevel() > 8:
-                with open(self.htmlDirectory + "/menu-9.html", "r") as f:
-                    localMenuContent = f.read()
-                    if replaceValues:
-                        for v in replaceValues:
-                            localMenuContent = localMenuContent.replace("%" + v + "%", replaceValues[v])
-                    if "sma" in qs: localMenuContent = localMenuContent.replace("%SMA%", qs["sma"][0])
-                    menuContent += localMenuContent            
+                menus.append("menu-9")
+        menuContent = "".join([templates.cache.render(self.htmlDirectory + "/" + m + ".html", menuValues)
+                               for m in menus])
 
-        sma = ""
-        if "sma" in qs: 
-            sma = qs["sma"][0]
         log = "Logout" if self.getLevel() > 0 else "Login"
            
         if name == "error":
             bodyContent = errorMsg
-            contents = t.substitute(
+            contents = layout.render(dict(
                 pageTitle = pageTitle, pageHead = "", sessionHead = "", 
-                sma = sma, menuContent = menuContent, bodyContent = bodyContent, log = log)
+                sma = sma, menuContent = menuContent, bodyContent = bodyContent, log = log))
             self.writeChunk(contents)
         elif name == "error:critical":
             bodyContent = "\n<h4 class='err'>Error: " + errorMsg + "</h4>\n"
-            contents = t.substitute(
+            contents = layout.render(dict(
                 pageTitle = pageTitle, pageHead = "", sessionHead = "", 
-                sma = sma, menuContent = menuContent, bodyContent = bodyContent, log = log)
+                sma = sma, menuContent = menuContent, bodyContent = bodyContent, log = log))
             self.writeChunk(contents)
         else:   
             pageHead = "" 
             try:
-                with open(self.htmlDirectory + "/" + name + ".header.html", "r") as f:
-                    pageHead = f.read()
-                    if replaceValues:
-                        for v in replaceValues:
-                            pageHead = pageHead.replace("%" + v + "%", replaceValues[v])
+                pageHead = templates.cache.render(self.htmlDirectory + "/" + name + ".header.html",
+                                                  replaceValues)
             except:
                 pass
             
@@ -190,26 +177,28 @@ class HttpServerHandler(BaseHTTPRequestHandler,
                 bodyContent = "Error: Session not served - " + str(e)
                 hasError = True            
                             
+            # the body loaded by serveBody() is already substituted
+            substituted = False
             if not hasError:
                 if content != None:
                     bodyContent = content
                 else:    
                     bodyContent = self.serveBody(name, qs, replaceValues)     
+                    substituted = True
         
-            sma = ""
-            if "sma" in qs: 
-                sma = qs["sma"][0]
             log = "Logout" if self.getLevel() > 0 else "Login"
             
             if infoMsg != None:
                 bodyContent = infoMsg + bodyContent
-            if replaceValues:
-                for v in replaceValues:
-                    bodyContent = bodyContent.replace("%" + v + "%", replaceValues[v])
-            contents = t.substitute(
+                substituted = False
+            if replaceValues and not substituted:
+                bodyContent = templates.substitute(bodyContent, replaceValues)
+            contents = layout.render(dict(
                 pageTitle = pageTitle, pageHead = pageHead, sessionHead = sessionHead, 
-                sma = sma, menuContent = menuContent, bodyContent = bodyContent, log = log)
+                sma = sma, menuContent = menuContent, bodyContent = bodyContent, log = log))
             contents = contents.replace("&#44;", ",")
+            renderTime = time.time() - startTime
+            templates.cache.addRenderTime(name, renderTime)
             if generatedContentOnly == False:
                 self.writeChunk(contents)
             else:
@@ -556,22 +545,34 @@ class HttpServerHandler(BaseHTTPRequestHandler,
         elif filename[-4:] == '.tif': mimetype = 'image/tif'
 
         try:
-            f = open(filename, "rb")
-            contents = f.read()
-            self.send_response(200)
-            self.send_header('Content-Type', mimetype)
-            self.send_header('Content-Length', str(len(contents)))
-            self.send_header('Cache-Control', 'public,max-age=1000')
-            if DEBUG:
-                # enable cache
-                self.send_header('Last-Modified', 'Wed, 15 Sep 2004 12:00:00 GMT')
-                self.send_header('Expires', 'Sun, 17 Jan 2038 19:14:07 GMT')
-            self.end_headers()
-            self.wfile.write(contents)
-            f.close()
-        except:
+            asset = asset_cache.cache.get(filename, mimetype)
+        except (IOError, OSError):
             print("problem with file " + filename + "\n")
             self.serve404Error(filename, qs)
+            return
+
+        # no "Connection: close" here, the browser can reuse the connection
+        useGzip = asset.gzipData is not None and asset_cache.acceptsGzip(self.headers)
+        etag = asset.gzipEtag if useGzip else asset.etag
+        if asset.notModified(self.headers):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', 'public,max-age=' + str(asset_cache.cache.maxAge))
+            self.end_headers()
+            return
+        contents = asset.gzipData if useGzip else asset.data
+        self.send_response(200)
+        self.send_header('Content-Type', mimetype)
+        self.send_header('Content-Length', str(len(contents)))
+        self.send_header('Cache-Control', 'public,max-age=' + str(asset_cache.cache.maxAge))
+        self.send_header('Last-Modified', asset.lastModified)
+        self.send_header('ETag', etag)
+        if asset.gzipData is not None:
+            self.send_header('Vary', 'Accept-Encoding')
+        if useGzip:
+            self.send_header('Content-Encoding', 'gzip')
+        self.end_headers()
+        self.wfile.write(contents)
 
     def do_GET(self):
         self.headerIsServed = False
@@ -597,6 +598,8 @@ class HttpServerHandler(BaseHTTPRequestHandler,
             self.serveGraphData(qs)
         elif o.path == "/graph-form":
             self.serveGraphForm(qs)
+        elif o.path == "/data":
+            self.serveData(qs)
         elif o.path == "/upload":
             self.serveUploadGet(qs) #, lastUploadCode, lastUploadConfig, lastUploadFile)
         elif o.path == "/login":
@@ -615,6 +618,10 @@ class HttpServerHandler(BaseHTTPRequestHandler,
             self.serveListenSingle(qs)
         elif o.path == "/talk-to":
             self.serveTalkTo(qs)
+        elif o.path == "/metrics":
+            self.serveMetrics(qs)
+        elif o.path == "/stream":
+            self.serveStream(qs)
         elif o.path == "/listen-data":
             self.serveListenData(qs)
         elif o.path == "/blockly":
@@ -644,16 +651,12 @@ class HttpServerHandler(BaseHTTPRequestHandler,
             self.serve404Error(o.path, qs)   
 
     def serveBody(self, name, qs = {'sma': ['0000000'],}, replaceValues = None):
-        contents = ""
         disabled = "" if self.getLevel() > 1 else 'disabled="disabled" '
-        with open(self.htmlDirectory + "/" + name + ".html", "r") as f:
-            contents = f.read()
-            if replaceValues:
-                for v in replaceValues:
-                    contents = contents.replace("%" + v + "%", replaceValues[v])
-            contents = contents.replace("%DISABLED%", disabled)
-            if "sma" in qs: contents = contents.replace("%SMA%", qs["sma"][0])
-        return contents
+        values = {"DISABLED": disabled}
+        if "sma" in qs: values["SMA"] = qs["sma"][0]
+        if replaceValues:
+            values.update(replaceValues)
+        return templates.cache.render(self.htmlDirectory + "/" + name + ".html", values)
 
     # Dummy, have to respond somehow, so javascript knows we are here
     def serveSync(self, qs):
@@ -664,6 +667,8 @@ class HttpServerHandler(BaseHTTPRequestHandler,
             self.writeChunk("writeAccess=True")
 
     def serveListenData(self, qs):
+        if "since" in qs:
+            return self.serveListenDataSince(qs)
         self.send_response(200)
         self.sendDefaultHeaders()
         self.end_headers()
@@ -673,6 +678,45 @@ class HttpServerHandler(BaseHTTPRequestHandler,
         if text:
             self.writeChunk(text)
 
+    # Incremental polling: /listen-data?since=<cursor>[&wait=<seconds>]
+    # Returns only the lines received after the cursor, as JSON:
+    # {"cursor": <new cursor>, "epoch": <server instance>, "lines": [...]}
+    # "reset" is set when the cursor is not from this server instance,
+    # see serveGraphDataSince().
+    def serveListenDataSince(self, qs):
+        moteData = sensor_data.moteData
+        since = utils.qsExtractInt(qs, "since", 0)
+        reset = moteData.isStaleCursor(qs, since, moteData.listenSeq)
+        self.waitForData(qs, lambda: reset or moteData.listenSeq != since)
+        if reset:
+            since = 0
+        (cursor, lines) = moteData.getListenLines(since)
+        result = {"cursor": cursor, "epoch": moteData.epoch, "lines": lines}
+        if reset:
+            result["reset"] = True
+        self.serveJson(result)
+
+    # Long-poll: with "wait=<seconds>" in the query, wait until there is new data
+    def waitForData(self, qs, isNewData):
+        wait = min(utils.qsExtractInt(qs, "wait", 0), MAX_WAIT)
+        if wait > 0 and getattr(self.server, "blockingAllowed", True) and not isNewData():
+            broadcast.hub.wait(isNewData, wait,
+                               configuration.c.getCfgValueAsInt("streamMaxWaiters"))
+
+    # Server-Sent Events: /stream?events=data,line
+    # "data" events carry [<sensor>@<mote>, timestamp, value] and have
+    # the graph-data cursor as id, "line" events carry a received line
+    # and have the listen-data cursor as id.
+    def serveStream(self, qs):
+        events = qs.get("events", ["data,line"])[0].split(",")
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.writeChunk("retry: 2000\n\n")
+        self.server.detach(self.request, lambda sock: broadcast.hub.addClient(sock, events))
+
     def do_POST(self):
         self.headerIsServed = False
         o = urlparse(self.path)
@@ -693,32 +737,6 @@ class HttpServerHandler(BaseHTTPRequestHandler,
 
 
 
-class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
-    # Overrides BaseServer function to get better control over interrupts
-    def serve_forever(self, poll_interval = 0.5):
-        """Handle one request at a time until shutdown.
-
-        Polls for shutdown every poll_interval seconds. Ignores
-        self.timeout. If you need to do periodic tasks, do them in
-        another thread.
-        """
-        self._BaseServer__is_shut_down.clear()
-        try:
-            while not self._BaseServer__shutdown_request:
-                # XXX: Consider using another file descriptor or
-                # connecting to the socket to wake this up instead of
-                # polling. Polling reduces our responsiveness to a
-                # shutdown request and wastes cpu at all other times.
-                r, w, e = select.select([self], [], [], poll_interval)
-                if self in r:
-                    self._handle_request_noblock()
-        finally:
-            self._BaseServer__shutdown_request = False
-            self._BaseServer__is_shut_down.set()
-            if os.name == "posix":
-                # kill the process to make sure it exits
-                os.kill(os.getpid(), signal.SIGKILL)
-
 # --------------------------------------------
 def makeDefaultUserFile(userDirectory, userFile):
     if not os.path.exists(userDirectory):
@@ -825,13 +843,29 @@ def main():
         initalizeUsers()
         # start the server
         port = configuration.c.getCfgValueAsInt("port")
-        server = ThreadingHTTPServer(('', port), HttpServerHandler)
+        if configuration.c.getCfgValue("serverMode").lower() == "eventloop":
+            server = eventloop.EventLoopServer(('', port), HttpServerHandler,
+                keepAliveTimeout = configuration.c.getCfgValueAsFloat("keepAliveTimeout"))
+        else:
+            server = poolserver.PooledHTTPServer(('', port), HttpServerHandler,
+                workerThreads = configuration.c.getCfgValueAsInt("workerThreads"),
+                requestQueueSize = configuration.c.getCfgValueAsInt("requestQueueSize"),
+                keepAliveTimeout = configuration.c.getCfgValueAsFloat("keepAliveTimeout"))
+        signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
         # load motes
         motes.addAll()
         # report ok and enter the main loop
         print("<http-server>: started, listening to TCP port {}, serial baudrate {}".format(port,
               configuration.c.getCfgValueAsInt("baudrate")))
-        server.serve_forever()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        print("<http-server>: stopping")
+        # close serial ports and save what is buffered
+        ht.closeAllSerial()
+        if allUsers:
+            allUsers.flush()
     except SystemExit:
         raise # XXX
     except Exception as e:
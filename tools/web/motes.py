@@ -8,19 +8,76 @@ from motelist import Motelist
 import configuration
 import utils
 
-def runSubprocess(args, server):
+# The output of uploads, shown on the upload page
+outputLock = threading.Lock()
+
+def writeOutput(text):
+    with outputLock:
+        try:
+            with open(os.path.join("build", "child_output.txt"), "ab") as f:
+                f.write(text)
+        except IOError:
+            pass
+
+# The BSL script, loaded from the MansOS directory
+ubsl = None
+
+def getBsl():
+    global ubsl
+    if ubsl is None:
+        path = os.path.abspath(os.path.join(configuration.c.getCfgValue("mansosDirectory"),
+                                            "mos", "make", "scripts"))
+        if path not in sys.path:
+            sys.path.append(path)
+        import ubsl as module
+        ubsl = module
+    return ubsl
+
+# Messages and progress of an in-process upload, written to the output line by line
+class UploadOutput(object):
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.buffer = ""
+        self.percent = {}
+
+    def write(self, text):
+        lines = (self.buffer + text).split("\n")
+        self.buffer = lines.pop()
+        for line in lines:
+            writeOutput(self.prefix + line + "\n")
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.buffer:
+            writeOutput(self.prefix + self.buffer + "\n")
+            self.buffer = ""
+
+    # Report every 10% of programming and verification
+    def progress(self, phase, done, total):
+        if not total or phase not in ("program", "verify"):
+            return
+        percent = done * 10 // total * 10
+        if percent > self.percent.get(phase, 0):
+            self.percent[phase] = percent
+            writeOutput("{}{} {}%\n".format(self.prefix, phase, percent))
+
+# Build directory is shared by all motes
+buildLock = threading.Lock()
+
+def runSubprocess(args, server, env = None, prefix = ""):
 #    print("runSubprocess: " + ",".join(args))
     retcode = -1
     try:
-        try:
-            outFileName = os.path.join("build", "child_output.txt")
-            outFile = open(outFileName, "ab")
-        except:
-            outFile = None
-        proc = subprocess.Popen(args, stderr = subprocess.STDOUT, stdout = outFile,
-                                shell = False)
+        env = dict(env if env is not None else os.environ)
+        # show the progress as it happens
+        env["PYTHONUNBUFFERED"] = "1"
+        proc = subprocess.Popen(args, stderr = subprocess.STDOUT, stdout = subprocess.PIPE,
+                                shell = False, env = env)
+        for line in iter(proc.stdout.readline, b""):
+            writeOutput(prefix + line)
         proc.wait()
-        if outFile: outFile.close()
 #        print("proc finished, retcode={}".format(proc.returncode))
         retcode = proc.returncode
     except OSError as e:
@@ -34,6 +91,33 @@ def runSubprocess(args, server):
         return retcode
 
 
+# Build the code in the build directory for the platform;
+# return exit code and the name of the image file
+def compileImage(server, codeType, platform, prefix = ""):
+    env = dict(os.environ)
+    if codeType == "nesc":
+        # TinyOS
+        arglist = ["make", "-C", "build", platform]
+        imageFile = "build/build/" + platform + "/main.ihex"
+    elif codeType == "contiki_c":
+        env['TARGET'] = platform
+        arglist = ["make", "-C", "build"]
+        imageFile = "build/app.ihex"
+    else:
+        # mansos build system
+        arglist = ["make", "-C", "build", platform]
+        imageFile = "build/build/" + platform + "/image.ihex"
+
+    with buildLock:
+        retcode = runSubprocess(arglist, server, env, prefix)
+        if retcode == 0 and codeType == "contiki_c":
+            # copy .elf file to .ihex
+            # (XXX: not really done as in Contiki)
+            retcode = subprocess.call(["msp430-objcopy", "-O", "ihex",
+                                       "build/app." + platform, imageFile])
+    return (retcode, imageFile)
+
+
 class Mote(object):
     def __init__(self, moteDescription):
         self.moteDescription = moteDescription
@@ -160,20 +244,23 @@ class Mote(object):
 
         return numRead
 
-    def tryToUpload(self, server, filename):
+    # Environment for the BSL scripts and make, telling which mote to program
+    def getUploadEnv(self):
+        env = dict(os.environ)
+        if self.isLocal():
+            env['BSLPORT'] = self.moteDescription.getPort()
+        else:
+            env['BSLPROXY'] = self.moteDescription.getHost()
+        return env
+
+    def tryToUpload(self, server, filename, prefix = ""):
         # print("tryToUpload for " + self.getPortName() + " filename=" + filename)
 
         if self.isLocal():
             if not self.port: return 1
-            os.environ['BSLPORT'] = self.moteDescription.getPort()
-            bslScript = "ubsl.py"
         else:
             if not self.isSelected: return 0
-            os.environ['BSLPROXY'] = self.moteDescription.getHost()
-            bslScript = "netbsl.py"
 
-        bslPath = os.path.join(configuration.c.getCfgValue("mansosDirectory"), 
-                               "mos", "make", "scripts", bslScript)
         if self.platform == "telosb":
             platformArgs = ["--telosb"]
         elif self.platform == "xm1000":
@@ -184,62 +271,29 @@ class Mote(object):
             # assume "generic" MSP430 board
             platformArgs = ["--invert-reset", "--invert-test"]
 
-        arglist = ["python", bslPath, "-c", self.getPortName(), "-r", "-e", "-I"]
-        arglist.extend(platformArgs)
+        options = ["-r", "-e", "-I"]
+        options.extend(platformArgs)
         if configuration.c.getCfgValueAsBool("slowUpload"):
-            arglist.append("--slow")
-        arglist.append("-p")
-        arglist.append(filename)
-
-        return runSubprocess(arglist, server)
-
-    def tryToCompileAndUpload(self, server, codeType):
-        # print("tryToCompileAndUpload for " + self.getPortName() + " codeType=" + codeType)
+            options.append("--slow")
+        options.append("-p")
 
         if self.isLocal():
-            if not self.port: return 1
-            os.environ['BSLPORT'] = self.moteDescription.getPort()
-        else:
-            if not self.isSelected: return 0
-            os.environ['BSLPROXY'] = self.moteDescription.getHost()
-
-        # make telosb install bsl,/dev/ttyUSB0
-
-        if codeType == "nesc":
-            arglist = ["make", "-C", "build", self.platform]
-        elif codeType == "contiki_c":
-            os.environ['TARGET'] = self.platform
-            arglist = ["make", "-C", "build"]
-        else:
-            # mansos build system
-            arglist = ["make", "-C", "build", self.platform, "upload"]
-
-        retcode = runSubprocess(arglist, server)
-        if retcode: return retcode
-
-        # In case of TinyOS and Contiki we must upload separately
-        # (using the same good old MansOS upload script)
-        if codeType == "nesc":
-            # TinyOS
+            # in this process, no need to start Python and parse the image each time
+            output = UploadOutput(prefix)
             try:
-                retcode = self.tryToUpload(server, "build/build/" + self.platform + "/main.ihex")
-            except Exception as e:
-                print("tinyos upload exception:" + str(e))
-                retcode = 1
-        elif codeType == "contiki_c":
-            try:
-                # Contiki
-                # copy .elf file to .ihex
-                subprocess.call("msp430-objcopy -O ihex build/app.xm1000 build/app.ihex", shell = True)
-                # pass the copied file to mansos BSL script (XXX: not really done as in Contiki)
-                retcode = self.tryToUpload(server, "build/app.ihex")
-            except Exception as e:
-                print("contiki upload exception:" + str(e))
-                retcode = 1
-
-        # print ("compile and upload done!")
+                getBsl().flash(self.getPortName(), filename, options,
+                               output.progress, output)
+                return 0
+            except (Exception, SystemExit) as e:
+                output.write("An error occured:\n" + str(e) + "\n")
+                return 1
+            finally:
+                output.close()
 
-        return retcode
+        bslPath = os.path.join(configuration.c.getCfgValue("mansosDirectory"), 
+                               "mos", "make", "scripts", "netbsl.py")
+        arglist = ["python", bslPath, "-c", self.getPortName()] + options + [filename]
+        return runSubprocess(arglist, server, self.getUploadEnv(), prefix)
 
     def writeData(self, data):
         self.portLock.acquire()
@@ -256,45 +310,53 @@ class Mote(object):
 
 class MoteCollection(object):
     def __init__(self):
+        # "port@host" -> Mote
         self.motes = dict()
-
-    @staticmethod
-    def motesUpdated():
-        motes.refreshMotes(Motelist.getMotelist(False))
+        self.lock = threading.Lock()
 
     def addAll(self):
         cfgMotes = configuration.c.getCfgValueAsList("motes")
         for portName in cfgMotes:
             Motelist.addMote(portName, "A statically added mote", "")
-        Motelist.initialize(self.motesUpdated, startPeriodicUpdate = True)
-        self.refreshMotes(Motelist.getMotelist(False))
+        Motelist.addChangeCallback(self.motesChanged)
+        Motelist.startPeriodicUpdate()
+        with self.lock:
+            # taken with the lock held, so that it is not older than the changes seen
+            self.refreshMotes(Motelist.getMotelist(False))
         self.retrieveSelected()
 
-    def refreshMotes(self, newMotelist):
-        toRemove = set()
+    @staticmethod
+    def getKey(description):
+        return description.getPort() + "@" + description.getHost()
+
+    # Called by the motelist with the motes plugged in and out
+    def motesChanged(self, added, removed):
+        with self.lock:
+            for d in removed:
+                self.removeMote(self.getKey(d))
+            for d in added:
+                self.addMote(d)
+
+    def addMote(self, description):
+        name = self.getKey(description)
+        if name not in self.motes:
+            print("add " + name)
+            self.motes[name] = Mote(description)
+
+    def removeMote(self, name):
+        m = self.motes.pop(name, None)
+        if m is not None:
+            print("remove " + name)
+            m.ensureSerialIsClosed()
 
-#        print("refreshMotes:" + ", ".join(newMotelist))
+    def refreshMotes(self, newMotelist):
+        newNames = set([self.getKey(d) for d in newMotelist])
 
-        for m in self.motes.values():
-            found = False
-            for d in newMotelist:
-                if d.getPort() == m.getPortName() \
-                        and d.getHost() == m.getHostName():
-                    found = True
-                    break
-            if not found:
-                toRemove.add(m)
-
-        for m in toRemove:
-            print("remove " + m.getFullName())
-            m.ensureSerialIsClosed()
-            del self.motes[m.getFullName()]
+        for name in set(self.motes) - newNames:
+            self.removeMote(name)
 
         for d in newMotelist:
-            name = d.getPort() + "@" + d.getHost()
-            if name not in self.motes:
-                print("add " + name)
-                self.motes[name] = Mote(d)
+            self.addMote(d)
 
     def storeSelected(self):
         selected = []
@@ -0,0 +1,80 @@
+from __future__ import print_function
+import json, re, time
+import configuration
+import archive
+import data_utils
+import broadcast
+import downsample
+import templates
+import utils
+
+namePattern = re.compile(r'^\w[\w.\-@]*$')
+
+class PageData():
+    def serveDataError(self, message):
+        self.send_response(400)
+        self.sendDefaultHeaders()
+        self.end_headers()
+        self.writeChunk("Error: " + message)
+
+    # Stored readings of a sensor, from the archive if it is enabled, else from the database.
+    # None if neither keeps the data.
+    def queryHistory(self, mote, sensor, fromTs, toTs):
+        if archive.archive.enabled:
+            if mote[:3].lower() == "com":
+                # as in SensorData
+                mote = "_" + mote
+            return archive.archive.query(mote, sensor, fromTs, toTs)
+        if configuration.c.getCfgValueAsBool("saveToDB"):
+            return data_utils.queryDB(mote, sensor, fromTs, toTs)
+        return None
+
+    # Range query on the archived or database data:
+    # /data?mote=<mote>&sensor=<sensor>&from=<ms>&to=<ms>&downsample=<max points>&method=<lttb|minmax|decimate>
+    def serveData(self, qs):
+        mote = qs.get("mote", [""])[0]
+        sensor = qs.get("sensor", [""])[0].lower()
+        fromTs = utils.qsExtractInt(qs, "from", 0)
+        toTs = utils.qsExtractInt(qs, "to", int(time.time() * 1000))
+        maxPoints = utils.qsExtractInt(qs, "downsample", 0)
+        method = qs.get("method", ["lttb"])[0]
+
+        useDB = configuration.c.getCfgValueAsBool("saveToDB")
+        if not archive.archive.enabled and not useDB:
+            return self.serveDataError("neither data archive nor database is enabled")
+        if not mote:
+            # list what is available
+            if archive.archive.enabled:
+                motes = archive.archive.getMotes()
+                result = {"motes": dict([(m, archive.archive.getSensors(m)) for m in motes])}
+            else:
+                result = {"motes": data_utils.getDBSeries()}
+        elif not namePattern.match(mote) or not namePattern.match(sensor):
+            return self.serveDataError("invalid mote or sensor name")
+        else:
+            data = self.queryHistory(mote, sensor, fromTs, toTs)
+            if maxPoints > 0 and len(data) > maxPoints:
+                data = downsample.downsample(data, maxPoints, method)
+            result = {"mote": mote, "sensor": sensor,
+                      "from": fromTs, "to": toTs, "data": data}
+
+        self.serveJson(result)
+
+    # Queue depths, write statistics and page render times: /metrics
+    def serveMetrics(self, qs):
+        pages = {}
+        for (name, renders, averageMs) in templates.cache.getStats():
+            pages[name] = {"renders": renders, "averageMs": round(averageMs, 2)}
+        result = {"sinks": data_utils.getMetrics(),
+                  "streamClients": broadcast.hub.numClients(),
+                  "templates": {"cached": templates.cache.size(), "pages": pages}}
+        self.serveJson(result)
+
+    def serveJson(self, result):
+        content = json.dumps(result, separators = (',', ':'))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.writeChunk(content)
@@ -2,8 +2,14 @@
 from __future__ import print_function
 import random
 import os
+import time
 import json
 import configuration
+import downsample
+import utils
+
+# readings per sensor returned by /graph-data without parameters, as before it had any
+DEFAULT_POLL_POINTS = 40
 
 class PageGraph():
     def serveGraphs(self, qs):
@@ -15,28 +21,95 @@ class PageGraph():
         changes = {}
         buttons = "<button onclick='button(\" + i + \", this)'>Pause</button>"
         changes["BUTTONS"] = buttons
+        changes["MAXKEEP"] = str(configuration.c.getCfgValueAsInt("graphMaxPoints"))
         content = self.serveBody("graph", qs, changes)
         self.serveAnyPage("graph", qs, content = content, replaceValues = changes)
      
     def serveGraphData(self, qs):
         global lastData
 
+        if "since" in qs:
+            return self.serveGraphDataSince(qs)
+
         self.send_response(200)
         self.sendDefaultHeaders()
         self.end_headers()
 
+        # optional time range (ms since 1970), target point count and downsampling method;
+        # without them, the newest DEFAULT_POLL_POINTS readings are returned as they are
+        fromTs = utils.qsExtractInt(qs, "from", None)
+        toTs = utils.qsExtractInt(qs, "to", None)
+        maxPoints = utils.qsExtractInt(qs, "points", 0)
+        method = qs.get("method", ["lttb"])[0]
+        newestOnly = fromTs is None and toTs is None and maxPoints <= 0
+        if newestOnly:
+            maxPoints = DEFAULT_POLL_POINTS
+        elif maxPoints <= 0:
+            maxPoints = configuration.c.getCfgValueAsInt("graphMaxPoints")
+
         # get the data to display in graphs
-        allData = ""
+        allData = []
         if self.moteData.hasData():
             data = self.moteData.getData()
             for mote in data:
                 for sensor in mote.keys():
-                    allData += sensor + ":"
-                    for measur in mote[sensor]:
-                        allData += str(measur[0]) + "," + str(measur[1]) + ";"
-                    allData += "|"
-        lastData = allData
-        self.writeChunk(allData)
+                    if newestOnly:
+                        points = mote[sensor].last(maxPoints)
+                    else:
+                        points = mote[sensor].timeRange(fromTs, toTs)
+                        if fromTs is not None:
+                            points = self.addOlderPoints(sensor, points, fromTs, toTs)
+                    if len(points) > maxPoints:
+                        points = downsample.downsample(list(points), maxPoints, method)
+                    allData.append(sensor + ":")
+                    allData.extend(["{},{};".format(t, v) for (t, v) in points])
+                    allData.append("|")
+        lastData = "".join(allData)
+        self.writeChunk(lastData)
+
+    # When the range starts before the oldest reading kept in memory,
+    # take the older part from the archive or database
+    def addOlderPoints(self, sensor, points, fromTs, toTs):
+        if len(points):
+            oldest = points[0][0]
+            if oldest <= fromTs:
+                return points
+            toTs = oldest - 1
+        elif toTs is None:
+            toTs = int(time.time() * 1000)
+        (dataName, sep, motename) = sensor.rpartition("@")
+        older = self.queryHistory(motename, dataName, fromTs, toTs)
+        if not older:
+            return points
+        return older + list(points)
+
+    # Incremental polling: /graph-data?since=<cursor>&epoch=<epoch>[&wait=<seconds>]
+    # Returns only the readings stored after the cursor, as JSON:
+    # {"cursor": <new cursor>, "epoch": <server instance>,
+    #  "series": {"<sensor>@<mote>": [[timestamp, value], ...]}}
+    # "reset" is set when the cursor is not from this server instance (it has
+    # been restarted since), and the client should drop what it has.
+    def serveGraphDataSince(self, qs):
+        since = utils.qsExtractInt(qs, "since", 0)
+        maxPoints = configuration.c.getCfgValueAsInt("graphMaxPoints")
+        reset = self.moteData.isStaleCursor(qs, since, self.moteData.seq)
+        self.waitForData(qs, lambda: reset or self.moteData.seq != since)
+
+        cursor = self.moteData.seq
+        result = {"cursor": cursor, "epoch": self.moteData.epoch}
+        if reset:
+            result["reset"] = True
+            since = 0
+        series = {}
+        if since < cursor:
+            for mote in self.moteData.getData():
+                for sensor in mote.keys():
+                    points = mote[sensor].since(since, cursor)
+                    if len(points):
+                        series[sensor] = list(points.last(maxPoints))
+        result["series"] = series
+
+        self.serveJson(result)
         
     def serveGraphForm(self, qs):
         self.send_response(200)
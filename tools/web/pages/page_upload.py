@@ -1,7 +1,9 @@
 import threading, time, cgi, os, re
 import configuration
 import helper_tools as ht
-from motes import motes
+import flasher
+from motes import motes, compileImage, writeOutput
+from build_cache import buildCache, makeKey, getBuildInputs
 import utils
 import sensor_data
 
@@ -132,6 +134,27 @@ def emitCodeSEAL(code, config):
         outFile.close()
 
 
+# Return the image of the code built for the platform, or None if the build failed.
+# The same code is built only once, later the image is taken from the build cache.
+def buildImage(server, code, config, codeType, platform):
+    prefix = "[" + platform + "] "
+    key = makeKey(codeType, platform, code, config, getBuildInputs(codeType))
+    imageFile = buildCache.get(key)
+    if imageFile:
+        writeOutput(prefix + "code not changed, using the image built before\n")
+        return imageFile
+
+    (retcode, imageFile) = compileImage(server, codeType, platform, prefix)
+    if retcode != 0:
+        writeOutput(prefix + "build failed with code {}\n".format(retcode))
+        return None
+    try:
+        return buildCache.put(key, imageFile)
+    except (IOError, OSError) as e:
+        print("Failed to cache the image: " + str(e))
+        return imageFile
+
+
 class PageUpload():
     def serveUploadGet(self, qs): #, lastUploadCode, lastUploadConfig, lastUploadFile):
         global isListening
@@ -341,11 +364,12 @@ class PageUpload():
                    outFile.write(fileContents)
                    outFile.close()
 
-               retcode = 0
+               jobs = []
                for m in motes.getMotes():
                    if not m.tryToOpenSerial(False): continue
-                   r = m.tryToUpload(self, filename)
-                   if r != 0: retcode = r
+                   jobs.append(flasher.FlashJob(m,
+                       lambda prefix, m = m: m.tryToUpload(self, filename, prefix)))
+               retcode = flasher.flashAll(jobs)
 
            elif code:
                lastUploadCode = code
@@ -368,12 +392,27 @@ class PageUpload():
                    print("compileAndUpload: unknow code type: " + codeType)
                    return 1
 
-               retcode = 0
+               motesByPlatform = {}
                for m in motes.getMotes():
                    if m.isLocal():
                        if not m.tryToOpenSerial(False): continue
-                   r = m.tryToCompileAndUpload(self, codeType)
-                   if r != 0: retcode = r
+                   elif not m.isSelected:
+                       continue
+                   motesByPlatform.setdefault(m.platform, []).append(m)
+
+               # build once for each platform, then flash all motes in parallel
+               retcode = 0
+               jobs = []
+               for platform in sorted(motesByPlatform.keys()):
+                   imageFile = buildImage(self, code, config, codeType, platform)
+                   if imageFile is None:
+                       retcode = 1
+                       continue
+                   for m in motesByPlatform[platform]:
+                       jobs.append(flasher.FlashJob(m,
+                           lambda prefix, m = m, f = imageFile: m.tryToUpload(self, f, prefix)))
+               r = flasher.flashAll(jobs)
+               if r != 0: retcode = r
 
         finally:
             maybeIsInSubprocess = False
@@ -0,0 +1,86 @@
+#
+# MansOS web server - parser of sensor readings received from motes
+#
+# Line format: [<address>:]<name>=<value>[,<crc>]
+# where <crc> is two hex digits of CRC-8 of the text between the address and
+# the comma. Each line is matched once by one compiled regular expression;
+# the group that matched tells how to convert the value. Integers are read
+# as int(x, 0) always did: "0x", "0o" and "0b" prefixes, and a leading zero
+# means octal. A value that is not a number (it may contain commas) still
+# makes a reading, with value None.
+#
+
+import re, collections
+
+# Parsed line. value is int or float, None if it is not a number;
+# crcOk is True when the checksum matches or the line has none.
+Sample = collections.namedtuple("Sample", ["address", "name", "value", "crcOk"])
+
+samplePattern = re.compile(r"""
+    ^(?:(?P<address>[^:=]*):)?             # the address, if ":" is before "="
+    \s*(?P<name>[\x20-\x3c\x3e-\x7e]*?)\s*=\s*
+    (?:(?P<int>[-+]?\d+)
+      |(?P<prefixed>[-+]?0[xXoObB][0-9a-fA-F]+)
+      |(?P<float>[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)
+      |.*?)
+    \s*(?:,(?P<crc>[0-9a-fA-F]{2}))?$
+    """, re.VERBOSE)
+
+# CRC-8, polynomial x^8 + x^5 + x^4 + 1 (reflected: 0x8c)
+def makeCrc8Table():
+    table = []
+    for byte in range(256):
+        acc = byte
+        for i in range(8):
+            if acc & 1:
+                acc = (acc >> 1) ^ 0x8c
+            else:
+                acc >>= 1
+        table.append(acc)
+    return table
+
+crc8Table = makeCrc8Table()
+
+def crc8(s):
+    acc = 0
+    table = crc8Table
+    for c in bytearray(s):
+        acc = table[acc ^ c]
+    return acc
+
+# Return Sample, or None if the line is not a sensor reading
+def parse(line):
+    m = samplePattern.match(line)
+    if m is None:
+        return None
+    name = m.group("name").lower()
+    if not name:
+        return None
+    address = m.group("address")
+
+    value = m.group("int")
+    if value is not None:
+        try:
+            value = int(value, 0)
+        except ValueError:
+            # "08", "09": not octal, but still a number
+            value = float(value)
+    else:
+        value = m.group("prefixed")
+        if value is not None:
+            try:
+                value = int(value, 0)
+            except ValueError:
+                # e.g. "0b12"
+                value = None
+        else:
+            value = m.group("float")
+            if value is not None:
+                value = float(value)
+
+    crcOk = True
+    crc = m.group("crc")
+    if crc is not None:
+        start = m.end("address") + 1 if address is not None else 0
+        crcOk = crc8(line[start:m.start("crc") - 1]) == int(crc, 16)
+    return Sample(address, name, value, crcOk)
@@ -3,26 +3,21 @@
 #
 
 from __future__ import print_function
-import time, os
+import time, os, collections, threading
 import configuration
-import utils
+import data_writer
+import archive
+import broadcast
+from timeseries import TimeSeries, DEFAULT_CAPACITY
 
-# Polynomial ^8 + ^5 + ^4 + 1
-def crc8Add(acc, byte):
-    acc ^= byte
-    for i in range(8):
-        if acc & 1:
-            acc = (acc >> 1) ^ 0x8c
-        else:
-            acc >>= 1
-    return acc
-
-def crc8(s):
-    acc = 0
-    for c in s:
-        acc = crc8Add(acc, ord(c))
-    return acc
+# number of lines shown in the "listen_div" of the listen page
+LISTEN_LINES = 27
 
+def getHistorySize():
+    try:
+        return configuration.c.getCfgValueAsInt("graphHistorySize")
+    except:
+        return DEFAULT_CAPACITY
 
 # -------------------------------------
 class SensorData(object):
@@ -35,44 +30,27 @@ class SensorData(object):
         baseDir = os.path.basename(motename)
         if baseDir[:3].lower() == "com":
             baseDir = "_" + baseDir
+        self.basename = baseDir
         self.dirname = os.path.join(configuration.c.getCfgValue("dataDirectory"),
                                     baseDir)
         if not os.path.exists(self.dirname):
             os.makedirs(self.dirname)
 
-    def addNewData(self, string, motename):
+    def addSample(self, dataName, value, motename, seq = None):
         if motename[:5].lower() == "/dev/":
             motename = motename[5:]
-        string = string.rstrip()
-        eqSignPos = string.find('=')
-        if eqSignPos == -1: return
-
-        if eqSignPos == 0:
-            # TODO: self.finishPacket()
-            return
 
-        dataName = string[:eqSignPos].strip().lower()
-        # sanity check of dataName
-        if not utils.isasciiString(dataName):
-            return
-        
         if not dataName in self.seenInThisPacket:
             self.seenInThisPacket.add(dataName)
-            self.data[dataName + "@" + motename] = []
-
-        valueString = string[eqSignPos + 1:].strip()
-
-        try:
-            # try to parse the value as int (in any base)
-            value = int(valueString, 0)
-        except:
-            try:
-                # try to parse the value as float
-                value = float(valueString)
-            except:
-                print("Sensor " + dataName + " value is in unknown format: " + valueString + "\n")
-                value = 0
-        self.data[dataName + "@" + motename].append([int(round(time.time()*1000)),value])#miliseconds since 1970
+            self.data[dataName + "@" + motename] = TimeSeries(getHistorySize())
+
+        now = time.time()
+        timestamp = int(round(now*1000)) #miliseconds since 1970
+        self.data[dataName + "@" + motename].append(timestamp, value, seq)
+        if broadcast.hub.active():
+            broadcast.hub.publish("data", seq, [dataName + "@" + motename, timestamp, value])
+        if archive.archive.enabled:
+            archive.archive.append(self.basename, dataName, timestamp, value)
         # save to file if required (multiple files)
         if configuration.c.getCfgValue("saveToFilename") \
                 and configuration.c.getCfgValue("saveProcessedData"):
@@ -82,23 +60,16 @@ class SensorData(object):
                 return
 
             # filename is determined by config + mote name + sensor name
-            filename = os.path.join(self.dirname,
-                                    dataName + ".csv")
-            with open(filename, "a") as f:
-                if os.path.getsize(filename) == 0:
-                    f.write("serverTimestampUnix\tserverTimestamp\t" + dataName + "\n")
-                f.write("{}\t{}\t{}\n".format(int(round(time.time())),
-                    time.strftime("%d %b %Y %H:%M:%S", time.localtime()),
-                    value))
-                f.close()
+            data_writer.writer.write(self.dirname, dataName, value, now)
 
 
     def resize(self, newMaxSize):
-        for datalist in self.data.keys():
-            self.data[datalist] = self.data[datalist][-newMaxSize:]
+        for series in self.data.itervalues():
+            series.setCapacity(newMaxSize)
 
     def reset(self):
-        self.resize(0)
+        for series in self.data.itervalues():
+            series.clear()
         self.columns = []
         self.firstPacket = True
 
@@ -124,53 +95,71 @@ class SensorData(object):
 class MoteData(object):
     def __init__(self):
         # unformatted data
-        self.listenTxt = []
+        self.listenTxt = collections.deque(maxlen = LISTEN_LINES)
         # parsed and formatted data
         self.data = {}
+        # polling cursors; never go back, not even on reset,
+        # so that a client's cursor always stays valid
+        self.seq = 0          # sequence number of the last stored sample
+        self.nextSeq = 1
+        self.listenSeq = 0    # number of lines ever added to listenTxt
+        self.listenLock = threading.Lock()
+        # sent with the cursors; a client with another epoch has cursors
+        # from before a restart of the server
+        self.epoch = "{:x}".format(int(time.time() * 1000))
 
     def reset(self):
-        self.listenTxt = []
+        with self.listenLock:
+            self.listenTxt = collections.deque(maxlen = LISTEN_LINES)
         self.data = {}
 
-    def addNewData(self, newString, motename):
-        self.listenTxt.append(newString)
-
-        # if the new string contains address of a data, use it instead of mote's name!
-        columnPos = newString.find(":")
-        eqPos = newString.find("=")
-        # if the string has both ":" and "=", and "=" is before ":"
-        if columnPos != -1 and columnPos < eqPos:
-            address = newString.split(":")[0]
-            if address:
-                # use the address instead!
-                motename = address
-                newString = newString[columnPos + 1:]
-
-        # if the new string contains checksum, check it.
-        if len(newString) > 3 and newString.find(",") == len(newString) - 3:
-            # checksum detected
-            calcCrc = crc8(newString[:-3])
-            try:
-                recvCrc = int(newString[-2:], 16) 
-            except:
-                recvCrc = 0xffff # invalid value
-            if calcCrc != recvCrc:
-                print("Received bad checksum:\n" + newString)
-                return
-
-            # remove the crc bytes from the value string
-            newString = newString[:-3]
+    # True if the cursor a client sent is not from this server instance
+    def isStaleCursor(self, qs, since, cursor):
+        epoch = qs.get("epoch", [""])[0]
+        if epoch:
+            return epoch != self.epoch
+        return since > cursor
+
+    # Return (cursor, lines added after the line number since)
+    def getListenLines(self, since):
+        with self.listenLock:
+            lines = list(self.listenTxt)
+            cursor = self.listenSeq
+        count = cursor - since
+        if count <= 0:
+            return (cursor, [])
+        return (cursor, lines[-count:])
+
+    # sample: newString parsed by sample_parser.parse()
+    def addNewData(self, newString, motename, sample):
+        with self.listenLock:
+            self.listenTxt.append(newString)
+            self.listenSeq += 1
+            listenSeq = self.listenSeq
+        if broadcast.hub.active():
+            broadcast.hub.publish("line", listenSeq, newString)
+
+        if sample is None:
+            # not a sensor reading
+            return
+        if not sample.crcOk:
+            print("Received bad checksum:\n" + newString)
+            return
+        # if the string contains address of a data, use it instead of mote's name!
+        if sample.address:
+            motename = sample.address
+        value = sample.value
+        if value is None:
+            print("Sensor " + sample.name + " value is in unknown format: " + newString + "\n")
+            value = 0
 
         if motename not in self.data:
             self.data[motename] = SensorData(motename)
-        self.data[motename].addNewData(newString, motename)
-
-    def fixSizes(self):
-        # use only last 27 lines of all motes - fits in screen ("listen_div")
-        self.listenTxt = self.listenTxt[-27:]
-        # use only last 40 readings for graphing
-        for sensorData in self.data.itervalues():
-            sensorData.resize(40)
+        seq = self.nextSeq
+        self.nextSeq += 1
+        self.data[motename].addSample(sample.name, value, motename, seq)
+        # publish the cursor only after the sample is stored
+        self.seq = seq
 
     def hasData(self):
         for sensorData in self.data.itervalues():
@@ -3,13 +3,19 @@
 #
 
 from __future__ import print_function
-import datetime, random, md5
+import datetime, random, md5, re, heapq, threading
+import configuration
+import templates
 
 alphabet = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ.,!?() '_-=+*/@$:%^#;~{}[]|`"
 #nevar but simbols:"&<>"
 lalphabet = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ@_-.,`"
 tabuList = ["admin"]
 
+# session.html has %KEY% placeholders and "/*?NAME" markers that
+# comment out optional parts of the script until they are removed
+SESSION_PATTERN = re.compile(r'%([A-Z][A-Z0-9_]*)%|(/\*\?[A-Z]+)')
+
 # --------------------------------------------
 class Session():
     def __init__(self, sma):
@@ -101,110 +107,124 @@ class Session():
         return m.hexdigest()
 
 #-----------------------------------------
+# Sessions are indexed by their current and previous sma.
+# Expiry times are kept in a heap; when a session's end time is moved,
+# a new heap entry is pushed and the old one is skipped when it comes up.
 class Sessions():
-    def __init__(self):
-        self._sessionList = []
+    def __init__(self, maxSessions = None):
+        if maxSessions is None:
+            maxSessions = configuration.c.getCfgValueAsInt("maxSessions")
+        self._maxSessions = maxSessions
+        self._bySma = {}
+        self._byOldSma = {}
+        self._expiry = []  # heap of (end time, counter, session)
+        self._counter = 0
+        self._lock = threading.RLock()
+
+    def _setEnd(self, session, minutes):
+        session._end = datetime.datetime.now() + datetime.timedelta(minutes = minutes)
+        self._counter += 1
+        heapq.heappush(self._expiry, (session._end, self._counter, session))
+        # drop stale entries if sessions are refreshed much more often than they expire
+        if len(self._expiry) > 4 * len(self._bySma) + 64:
+            self._expiry = [e for e in self._expiry
+                            if self._bySma.get(e[2]._sma) is e[2] and e[2]._end == e[0]]
+            heapq.heapify(self._expiry)
+
+    def _remove(self, session):
+        if self._bySma.get(session._sma) is session:
+            del self._bySma[session._sma]
+        if self._byOldSma.get(session._oldsma) is session:
+            del self._byOldSma[session._oldsma]
+        if hasattr(session, '_user'):
+            print("{} session ended".format(session._user["name"]))
 
     def is_session(self, sma):
-        i = self._sessionList.__len__()-1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                return True
-            i -= 1
-        return False
+        return sma in self._bySma
 
     def add_session(self, sma):
-        self.delete_old()
-        if self._sessionList.__len__() > 9999:
-            print("Session count: {}".format(self._sessionList.__len__()))
-            return
-        self._sessionList.append(Session(sma))
-        print("Session count: {}".format(self._sessionList.__len__()))
-        return True
+        with self._lock:
+            self.delete_old()
+            if len(self._bySma) >= self._maxSessions:
+                print("Session count: {}".format(len(self._bySma)))
+                return
+            old = self._bySma.get(sma)
+            if old is not None:
+                self._remove(old)
+            session = Session(sma)
+            self._bySma[sma] = session
+            self._setEnd(session, 1)
+            print("Session count: {}".format(len(self._bySma)))
+            return True
 
     def get_session(self, sma):
-        #print("get_session, sma=" + sma)
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            # print("  self._sessionList[i]._sma=" + self._sessionList[i]._sma)
-            if self._sessionList[i]._sma == sma:
-                return self._sessionList[i]
-            i -= 1
-        return False
+        return self._bySma.get(sma, False)
 
     def get_session_old(self, oldsma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._oldsma == oldsma:
-                return self._sessionList[i]
-            i -= 1
-        return False
+        return self._byOldSma.get(oldsma, False)
 
     def delete_old(self):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._end < datetime.datetime.now():
-                if hasattr(self._sessionList[i], '_user'):
-                    print("{} session ended".format(self._sessionList[i]._user["name"]))
-                self._sessionList.pop(i)
-            i -= 1
+        with self._lock:
+            now = datetime.datetime.now()
+            while self._expiry and self._expiry[0][0] < now:
+                (end, counter, session) = heapq.heappop(self._expiry)
+                if session._end == end and self._bySma.get(session._sma) is session:
+                    self._remove(session)
 
     def del_session(self, sma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                if hasattr(self._sessionList[i], '_user'):
-                    print("{} session ended".format(self._sessionList[i]._user["name"]))
-                self._sessionList.pop(i)
-            i -= 1
+        with self._lock:
+            session = self._bySma.get(sma)
+            if session is not None:
+                self._remove(session)
 
     def set_sma(self, osma, nsma):
-        temp = self.get_session(osma)
-        if temp:
-            #print("set_sma: found!")
-            if nsma[-1:] != "0":
-                temp._end = datetime.datetime.now() + datetime.timedelta(minutes = 15)
+        with self._lock:
+            temp = self.get_session(osma)
+            if temp:
+                #print("set_sma: found!")
+                if self._byOldSma.get(temp._oldsma) is temp:
+                    del self._byOldSma[temp._oldsma]
+                del self._bySma[temp._sma]
+                temp._oldsma = temp._sma
+                temp._sma = nsma
+                old = self._bySma.get(nsma)
+                if old is not None:
+                    self._remove(old)
+                self._bySma[nsma] = temp
+                self._byOldSma[temp._oldsma] = temp
+                if nsma[-1:] != "0":
+                    self._setEnd(temp, 15)
+                else:
+                    self._setEnd(temp, 1)
+                return True
             else:
-                temp._end = datetime.datetime.now() + datetime.timedelta(minutes = 1)
-            temp._oldsma = temp._sma
-            temp._sma = nsma
-            return True
-        else:
-            nsma = nsma[:-1]+"0"
-            #print("add session (set_sma)")
-            self.add_session(nsma)
-            return False
+                nsma = nsma[:-1]+"0"
+                #print("add session (set_sma)")
+                self.add_session(nsma)
+                return False
 
     def add_sid(self, sma, sid, user):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                self._sessionList[i].add_sid(sid, user)
-                return
-            i -= 1
+        session = self._bySma.get(sma)
+        if session is not None:
+            session.add_sid(sid, user)
 
     def get_sid(self, sma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                return self._sessionList[i]._sid
-            i -= 1
+        session = self._bySma.get(sma)
+        if session is not None:
+            return session._sid
         return False
 
     def del_sid(self, sma):
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            if self._sessionList[i]._sma == sma:
-                self._sessionList[i].del_sid()
-                return
-            i -= 1
+        session = self._bySma.get(sma)
+        if session is not None:
+            session.del_sid()
 
     def get_sessions(self):
+        with self._lock:
+            sessions = list(self._bySma.values())
         temp = {}
-        i = self._sessionList.__len__() - 1
-        while -1 < i:
-            temp[i] = self._sessionList[i].get_all_data()
-            i -= 1
+        for i in range(len(sessions)):
+            temp[i] = sessions[i].get_all_data()
         return temp
 
 #-----------------------------------------
@@ -351,24 +371,20 @@ class SetAndServeSessionAndHeader():
         #print(self.sessions.get_sessions()
 
     def serveSession(self, qs, urlTo):
-        contents = ""
-        with open(self.htmlDirectory + "/session.html", "r") as f:
-            contents = f.read()
-            if "sma" in qs:
-                if "log" in qs:
-                    if qs["log"] == "in" and "tsid" in qs:
-                        contents = contents.replace("%SID%", str(qs["tsid"]))
-                        contents = contents.replace("/*?LOGIN", "")
-                        
-                contents = contents.replace("%RAND%", qs["sma"][0])
-            if "del" in qs:
-                if qs["del"] == "yes":
-                    contents = contents.replace("/*?DEL", "")
-            if urlTo != "":
-                contents = contents.replace("%TO%", urlTo)
-                contents = contents.replace("/*?REDIR", "")
-                
-        return contents
+        values = {}
+        if "sma" in qs:
+            if "log" in qs:
+                if qs["log"] == "in" and "tsid" in qs:
+                    values["SID"] = str(qs["tsid"])
+                    values["/*?LOGIN"] = ""
+            values["RAND"] = qs["sma"][0]
+        if "del" in qs:
+            if qs["del"] == "yes":
+                values["/*?DEL"] = ""
+        if urlTo != "":
+            values["TO"] = urlTo
+            values["/*?REDIR"] = ""
+        return templates.cache.render(self.htmlDirectory + "/session.html", values, SESSION_PATTERN)
             
     def getLevel(self, qs = {}):
         if "sma" in qs:
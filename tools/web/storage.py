@@ -0,0 +1,159 @@
+#
+# MansOS web server - storage backends for sensor observations
+#
+# Rows: {"obs_time": <seconds since 1970>, "unit_id", "port", "type", "value"}
+# Backends:
+#   "sqlite"     - embedded SQLite file (default), no server needed
+#   "sqlalchemy" - any database SQLAlchemy can connect to, given by dbUrl
+#                  (by default MySQL built from dbHost, dbName, dbUsername, dbPassword)
+#
+# A backend has these methods:
+#   insertMany(rows)  - store many rows at once
+#   query(ports, sensorType, fromTs, toTs)
+#                     - list of (timestamp in ms, value) for the ports and sensor type,
+#                       with fromTs <= timestamp <= toTs (in ms), oldest first
+#   getSeries()       - list of (port, sensor type) pairs that have data
+#   close()           - release the connections, when no other thread uses them;
+#                       the web server keeps its backend open while it runs
+#
+
+from __future__ import print_function
+import os, datetime, threading, sqlite3
+import configuration
+
+# -------------------------------------
+# One connection per thread; WAL lets the HTTP threads read while the writer writes
+class SqliteBackend(object):
+    INSERT = "INSERT INTO observations (obs_time, unit_id, port, type, value) VALUES (?, ?, ?, ?, ?)"
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+        self.connections = []
+        self.lock = threading.Lock()
+        c = self.getConnection()
+        c.execute("CREATE TABLE IF NOT EXISTS observations ("
+                  "id INTEGER PRIMARY KEY, obs_time REAL, unit_id TEXT, "
+                  "port TEXT, type TEXT, value REAL)")
+        c.execute("CREATE INDEX IF NOT EXISTS observations_time ON observations (obs_time)")
+        c.execute("CREATE INDEX IF NOT EXISTS observations_mote ON observations (port, type, obs_time)")
+        c.commit()
+
+    def getConnection(self):
+        c = getattr(self.local, "connection", None)
+        if c is None:
+            c = sqlite3.connect(self.path, timeout = 30, check_same_thread = False)
+            c.execute("PRAGMA journal_mode=WAL")
+            c.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = c
+            with self.lock:
+                self.connections.append(c)
+        return c
+
+    def insertMany(self, rows):
+        c = self.getConnection()
+        with c:
+            c.executemany(self.INSERT, [(r["obs_time"], r["unit_id"], r["port"], r["type"],
+                                         float(r["value"])) for r in rows])
+
+    def query(self, ports, sensorType, fromTs, toTs):
+        c = self.getConnection()
+        sql = "SELECT obs_time, value FROM observations WHERE port IN ({}) " \
+            "AND type = ? AND obs_time BETWEEN ? AND ? ORDER BY obs_time".format(
+            ", ".join(["?"] * len(ports)))
+        cursor = c.execute(sql, list(ports) + [sensorType, fromTs / 1000.0, toTs / 1000.0])
+        return [(int(round(t * 1000)), v) for (t, v) in cursor]
+
+    def getSeries(self):
+        # answered from the (port, type, obs_time) index
+        return list(self.getConnection().execute("SELECT DISTINCT port, type FROM observations"))
+
+    def close(self):
+        with self.lock:
+            for c in self.connections:
+                try:
+                    c.close()
+                except sqlite3.Error:
+                    pass
+            self.connections = []
+        self.local = threading.local()
+
+
+# -------------------------------------
+class SqlAlchemyBackend(object):
+    def __init__(self, url):
+        from sqlalchemy import create_engine, Table, Column, MetaData, Index
+        from sqlalchemy.types import DateTime, Numeric, Integer, String
+        self.engine = create_engine(url)
+        metadata = MetaData()
+        self.observations = Table('observations', metadata,
+            Column('id', Integer, primary_key = True),
+            Column('obs_time', DateTime),
+            Column('unit_id', String(32)),
+            Column('port', String(128)),
+            Column('type', String(64)),
+            Column('value', Numeric(20,6)),
+            Index('observations_time', 'obs_time'),
+            Index('observations_mote', 'port', 'type', 'obs_time')
+        )
+        metadata.create_all(self.engine)
+
+    def insertMany(self, rows):
+        values = []
+        for r in rows:
+            v = dict(r)
+            v["obs_time"] = datetime.datetime.fromtimestamp(r["obs_time"])
+            values.append(v)
+        with self.engine.begin() as connection:
+            # one multi-row insert for the whole batch
+            connection.execute(self.observations.insert(), values)
+
+    def query(self, ports, sensorType, fromTs, toTs):
+        from sqlalchemy import select
+        t = self.observations
+        s = select([t.c.obs_time, t.c.value]).where(
+            t.c.port.in_(list(ports))).where(t.c.type == sensorType).where(
+            t.c.obs_time.between(datetime.datetime.fromtimestamp(fromTs / 1000.0),
+                                 datetime.datetime.fromtimestamp(toTs / 1000.0))).order_by(t.c.obs_time)
+        with self.engine.connect() as connection:
+            return [(int(round(toTimestamp(obsTime) * 1000)), float(value))
+                    for (obsTime, value) in connection.execute(s)]
+
+    def getSeries(self):
+        from sqlalchemy import select
+        t = self.observations
+        with self.engine.connect() as connection:
+            return [tuple(r) for r in connection.execute(select([t.c.port, t.c.type]).distinct())]
+
+    def close(self):
+        self.engine.dispose()
+
+def toTimestamp(dt):
+    return (dt - datetime.datetime.fromtimestamp(0)).total_seconds()
+
+
+# -------------------------------------
+# Create the backend selected in the configuration; None if it is not available
+def openBackend():
+    c = configuration.c
+    kind = c.getCfgValue("dbBackend").lower()
+    try:
+        if kind == "sqlalchemy":
+            url = c.getCfgValue("dbUrl")
+            if not url:
+                url = "mysql://{}:{}@{}/{}".format(c.getCfgValue("dbUsername"),
+                    c.getCfgValue("dbPassword"), c.getCfgValue("dbHost"), c.getCfgValue("dbName"))
+            return SqlAlchemyBackend(url)
+        path = c.getCfgValue("dbFile")
+        if not os.path.isabs(path):
+            dirname = c.getCfgValue("dataDirectory")
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            path = os.path.join(dirname, path)
+        return SqliteBackend(path)
+    except ImportError:
+        print("Warning: using a database for data storage is not possible, package dependencies are missing.")
+        print("To store to use a database, install: python-sqlalchemy python-mysqldb\n")
+    except Exception as e:
+        print("Failed to open the database: " + str(e))
+    return None
@@ -0,0 +1,98 @@
+#
+# MansOS web server - compiled and cached page templates
+#
+# A template is split once into literal text and placeholders, so rendering
+# is a single pass that joins the pieces. Placeholders without a value
+# are left in the output unchanged, as the old str.replace() code did.
+#
+
+from __future__ import print_function
+import os, re, time, threading
+
+# %KEY% placeholders in page bodies, headers and menus
+PERCENT = re.compile(r'%([A-Z][A-Z0-9_]*)%')
+# ${key} placeholders in layout.html (string.Template syntax)
+DOLLAR = re.compile(r'\$\{(\w+)\}')
+
+# -------------------------------------
+class Template(object):
+    def __init__(self, text, pattern = PERCENT):
+        self.literals = []      # len(literals) == len(keys) + 1
+        self.keys = []
+        self.placeholders = []  # original text of each placeholder
+        pos = 0
+        for m in pattern.finditer(text):
+            self.literals.append(text[pos:m.start()])
+            self.keys.append([g for g in m.groups() if g is not None][0])
+            self.placeholders.append(m.group(0))
+            pos = m.end()
+        self.literals.append(text[pos:])
+
+    def render(self, values = None):
+        if not self.keys:
+            return self.literals[0]
+        if values is None:
+            values = {}
+        result = [self.literals[0]]
+        for i in range(len(self.keys)):
+            result.append(values.get(self.keys[i], self.placeholders[i]))
+            result.append(self.literals[i + 1])
+        return "".join(result)
+
+# Substitute placeholders in a string that is not loaded from a file
+def substitute(text, values, pattern = PERCENT):
+    return pattern.sub(lambda m: values.get(m.group(1), m.group(0)), text)
+
+
+# -------------------------------------
+# Templates are read and compiled on first use, and reloaded when
+# the file's modification time changes.
+class TemplateCache(object):
+    def __init__(self):
+        self.templates = {}  # (path, pattern) -> (mtime, Template)
+        self.lock = threading.Lock()
+        # page name -> [number of renders, total render time in seconds]
+        self.stats = {}
+
+    def get(self, path, pattern = PERCENT):
+        mtime = os.stat(path).st_mtime
+        key = (path, pattern.pattern)
+        entry = self.templates.get(key)
+        if entry is None or entry[0] != mtime:
+            with open(path, "r") as f:
+                t = Template(f.read(), pattern)
+            with self.lock:
+                self.templates[key] = (mtime, t)
+            return t
+        return entry[1]
+
+    def render(self, path, values = None, pattern = PERCENT):
+        return self.get(path, pattern).render(values)
+
+    def addRenderTime(self, name, seconds):
+        with self.lock:
+            s = self.stats.get(name)
+            if s is None:
+                self.stats[name] = [1, seconds]
+            else:
+                s[0] += 1
+                s[1] += seconds
+
+    # Return list of (page name, number of renders, average render time in ms)
+    def getStats(self):
+        with self.lock:
+            return [(name, s[0], s[1] * 1000.0 / s[0])
+                    for (name, s) in sorted(self.stats.items())]
+
+    # Number of compiled templates in the cache
+    def size(self):
+        with self.lock:
+            return len(self.templates)
+
+    def clear(self):
+        with self.lock:
+            self.templates.clear()
+
+
+# -------------------------------------
+cache = TemplateCache()
@@ -0,0 +1,113 @@
+#!/usr/bin/python
+
+#
+# Sensor data parser benchmark: lines per second of sample_parser.parse()
+# and of the parsing it replaced (a regex match in data_utils, then string
+# searches and int()/float() with exceptions in sensor_data)
+#
+
+from __future__ import print_function
+import sys, time, re
+
+sys.path.append("..")
+
+import sample_parser
+
+LINES = [
+    "light=123",
+    "temperature=21.5",
+    "humidity=0x3f",
+    "12:light=456",
+    "voltage=3.3,00",
+    "acceleration=-1.25e2",
+    "Hello world",
+    "counter=abc",
+]
+
+# the checksums of the lines that have them
+LINES = [l[:-3] + ",%02x" % sample_parser.crc8(l[:-3]) if l.endswith(",00") else l
+         for l in LINES]
+
+# -------------------------------------
+# the old code, for comparison
+
+oldSampleRe = re.compile('^\w+=\d+(\.\d+)?(,[\da-fA-F]{2})?$')
+
+def oldCrc8(s):
+    acc = 0
+    for c in s:
+        acc ^= ord(c)
+        for i in range(8):
+            if acc & 1:
+                acc = (acc >> 1) ^ 0x8c
+            else:
+                acc >>= 1
+    return acc
+
+def oldParse(newString):
+    # data_utils.maybeAddDataToDatabase
+    s = newString.replace(" ", "")
+    if oldSampleRe.match(s) != None:
+        arr = s.split("=")
+    # MoteData.addNewData
+    address = None
+    columnPos = newString.find(":")
+    eqPos = newString.find("=")
+    if columnPos != -1 and columnPos < eqPos:
+        address = newString.split(":")[0]
+        if address:
+            newString = newString[columnPos + 1:]
+    if len(newString) > 3 and newString.find(",") == len(newString) - 3:
+        calcCrc = oldCrc8(newString[:-3])
+        try:
+            recvCrc = int(newString[-2:], 16)
+        except:
+            recvCrc = 0xffff
+        if calcCrc != recvCrc:
+            return None
+        newString = newString[:-3]
+    # SensorData.addNewData
+    string = newString.rstrip()
+    eqSignPos = string.find('=')
+    if eqSignPos <= 0:
+        return None
+    dataName = string[:eqSignPos].strip().lower()
+    for c in dataName:
+        if not 0x20 <= ord(c) <= 0x7e:
+            return None
+    valueString = string[eqSignPos + 1:].strip()
+    try:
+        value = int(valueString, 0)
+    except:
+        try:
+            value = float(valueString)
+        except:
+            value = 0
+    return (address, dataName, value)
+
+# -------------------------------------
+
+def bench(name, parse, count):
+    start = time.time()
+    for i in range(count):
+        for line in LINES:
+            parse(line)
+    elapsed = time.time() - start
+    print("{:>8}: {:10.0f} lines/sec".format(name, count * len(LINES) / elapsed))
+
+for line in LINES:
+    print(repr(line), "->", sample_parser.parse(line))
+print()
+
+# values are read as before
+for line in ["a=010", "a=-010", "a=08", "a=0b101", "a=0o17", "a=0x1F", "a=0b12",
+             "a=1,2", "a=1.5e3", "a=+7", "x:a=abc"]:
+    old = oldParse(line)
+    new = sample_parser.parse(line)
+    newValue = new.value if new.value is not None else 0
+    if old is None or (old[1], old[2]) != (new.name, newValue) or type(old[2]) != type(newValue):
+        print("DIFFERENT:", repr(line), old, new)
+
+count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+bench("old", oldParse, count)
+bench("new", sample_parser.parse, count)
@@ -0,0 +1,211 @@
+#
+# MansOS web server - bounded in-memory time series storage
+#
+
+from __future__ import print_function
+import array, threading
+
+DEFAULT_CAPACITY = 10000
+
+# -------------------------------------
+# A read-only window into a TimeSeries.
+# Does not copy the data; indexes directly into the ring buffer arrays.
+# The window is fixed at creation time: samples appended later are not visible,
+# but if more than (capacity - len(window)) samples are appended while the
+# window is in use, the oldest samples in it will be overwritten.
+class TimeSeriesView(object):
+    def __init__(self, series, first, count):
+        self.timestamps = series.timestamps
+        self.values = series.values
+        self.intValues = series.intValues
+        self.capacity = series.capacity
+        self.first = first   # physical index of the first element
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("time series index out of range")
+        i = (self.first + index) % self.capacity
+        if self.intValues:
+            return (int(self.timestamps[i]), int(self.values[i]))
+        return (int(self.timestamps[i]), self.values[i])
+
+    def __iter__(self):
+        capacity = self.capacity
+        timestamps = self.timestamps
+        values = self.values
+        end = self.first + self.count
+        if end <= capacity:
+            ranges = [(self.first, end)]
+        else:
+            ranges = [(self.first, capacity), (0, end - capacity)]
+        if self.intValues:
+            for (start, stop) in ranges:
+                for i in range(start, stop):
+                    yield (int(timestamps[i]), int(values[i]))
+        else:
+            for (start, stop) in ranges:
+                for i in range(start, stop):
+                    yield (int(timestamps[i]), values[i])
+
+    # Return a view of the newest n samples of this one
+    def last(self, n):
+        n = max(0, min(n, self.count))
+        return TimeSeriesView(self, (self.first + self.count - n) % self.capacity, n)
+
+    def getTimestamps(self):
+        return [t for (t, v) in self]
+
+    def getValues(self):
+        return [v for (t, v) in self]
+
+
+# -------------------------------------
+# Fixed-capacity ring buffer of (timestamp, value) pairs.
+# Timestamps are milliseconds since 1970, values are stored as floats;
+# while all values appended are integers, they are returned as integers.
+# Each sample also has an increasing sequence number, used as a polling cursor.
+# Appending is O(1) and never reallocates; when the buffer is full,
+# the oldest sample is overwritten.
+class TimeSeries(object):
+    def __init__(self, capacity = DEFAULT_CAPACITY):
+        if capacity < 1:
+            capacity = 1
+        self.capacity = capacity
+        self.timestamps = array.array('d', [0.0]) * capacity
+        self.values = array.array('d', [0.0]) * capacity
+        self.seqs = array.array('d', [0.0]) * capacity
+        self.head = 0        # physical index where the next sample goes
+        self.count = 0       # number of valid samples
+        self.lastSeq = 0
+        self.intValues = True
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, value, seq = None):
+        with self.lock:
+            if seq is None:
+                seq = self.lastSeq + 1
+            self.lastSeq = seq
+            if self.intValues and not isinstance(value, (int, long)):
+                self.intValues = False
+            self.timestamps[self.head] = timestamp
+            self.values[self.head] = value
+            self.seqs[self.head] = seq
+            self.head += 1
+            if self.head == self.capacity:
+                self.head = 0
+            if self.count < self.capacity:
+                self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.window())
+
+    def __getitem__(self, index):
+        return self.window()[index]
+
+    # Return a view of samples [start, stop) in logical order (0 is the oldest).
+    # Negative indexes count from the newest sample, as with lists.
+    def window(self, start = 0, stop = None):
+        with self.lock:
+            count = self.count
+            oldest = (self.head - count) % self.capacity
+            (start, stop, step) = slice(start, stop).indices(count)
+            if stop < start:
+                stop = start
+            return TimeSeriesView(self, (oldest + start) % self.capacity, stop - start)
+
+    # Return a view of the newest n samples
+    def last(self, n):
+        if n <= 0:
+            return self.window(0, 0)
+        return self.window(-n)
+
+    # Return a view of samples with fromTs <= timestamp <= toTs.
+    # Samples are appended in time order, so this is a binary search.
+    def timeRange(self, fromTs = None, toTs = None):
+        view = self.window()
+        start = 0
+        if fromTs is not None:
+            lo, hi = 0, len(view)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if view[mid][0] < fromTs: lo = mid + 1
+                else: hi = mid
+            start = lo
+        stop = len(view)
+        if toTs is not None:
+            lo, hi = start, len(view)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if view[mid][0] <= toTs: lo = mid + 1
+                else: hi = mid
+            stop = lo
+        return TimeSeriesView(view, (view.first + start) % view.capacity, stop - start)
+
+    # Return a view of samples with fromSeq < sequence number <= toSeq
+    def since(self, fromSeq, toSeq = None):
+        with self.lock:
+            seqs = self.seqs
+            capacity = self.capacity
+            count = self.count
+            oldest = (self.head - count) % capacity
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if seqs[(oldest + mid) % capacity] <= fromSeq: lo = mid + 1
+                else: hi = mid
+            start = lo
+            stop = count
+            if toSeq is not None:
+                lo, hi = start, count
+                while lo < hi:
+                    mid = (lo + hi) // 2
+                    if seqs[(oldest + mid) % capacity] <= toSeq: lo = mid + 1
+                    else: hi = mid
+                stop = lo
+            return TimeSeriesView(self, (oldest + start) % capacity, stop - start)
+
+    def lastTimestamp(self):
+        with self.lock:
+            if self.count == 0:
+                return None
+            return int(self.timestamps[(self.head - 1) % self.capacity])
+
+    def clear(self):
+        with self.lock:
+            self.head = 0
+            self.count = 0
+            self.intValues = True
+
+    # Change capacity, keeping the newest samples. Reallocates, so do not call often.
+    def setCapacity(self, capacity):
+        if capacity < 1:
+            capacity = 1
+        if capacity == self.capacity:
+            return
+        with self.lock:
+            oldest = (self.head - self.count) % self.capacity
+            keep = min(self.count, capacity)
+            skip = self.count - keep
+            timestamps = array.array('d', [0.0]) * capacity
+            values = array.array('d', [0.0]) * capacity
+            seqs = array.array('d', [0.0]) * capacity
+            for i in range(keep):
+                j = (oldest + skip + i) % self.capacity
+                timestamps[i] = self.timestamps[j]
+                values[i] = self.values[j]
+                seqs[i] = self.seqs[j]
+            self.timestamps = timestamps
+            self.values = values
+            self.seqs = seqs
+            self.capacity = capacity
+            self.count = keep
+            self.head = keep % capacity
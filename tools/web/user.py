@@ -1,5 +1,5 @@
 from __future__ import print_function
-import threading, datetime, os, random, md5
+import threading, datetime, os, random, md5, atexit
 
 class User():
     def __init__(self, userAttributes, data):
@@ -15,53 +15,72 @@ class User():
     def get_all_data(self):
         return self._attributes
     
+# Users are indexed by name; position of each attribute is precomputed.
+# write_in_file() only marks the store as changed; the file is written
+# WRITE_DELAY seconds later (several changes are written at once)
+# to a temporary file that is then renamed over the user file.
+WRITE_DELAY = 1.0
+
 class Users():
     def __init__(self, userAttr, userDirectory, userFile):
         self._userDirectory = userDirectory
         self._userFile = userFile
         self._userAttributes = userAttr
+        self._attrIndex = dict([(a, i) for (i, a) in enumerate(userAttr)])
         self._userList = []
-        threading.Timer(86400, self.make_copy_24h).start() #1d = 86400s
+        self._byName = {}
+        self._lock = threading.RLock()
+        self._writeTimer = None
+        self._isDirty = False
         self._isChange = False
+        self._startTimer(86400, self.make_copy_24h) #1d = 86400s
+        atexit.register(self.flush)
+    def _startTimer(self, delay, function):
+        t = threading.Timer(delay, function)
+        t.daemon = True
+        t.start()
+        return t
     def make_copy_24h(self):
+        self.flush()
         if self._isChange:
             print("User file copy made in " + self.make_copy())
         self._isChange = False
-        threading.Timer(86400, self.make_copy_24h).start() #1d = 86400s
+        self._startTimer(86400, self.make_copy_24h) #1d = 86400s
+    def _reindex(self):
+        self._byName = {}
+        for u in self._userList:
+            self._byName[u.get_data("name")] = u
     def is_attribute(self, attrName):
-        i=0
-        while self._userAttributes.__len__() > i:
-            if self._userAttributes[i] == attrName:
-                return True
-            i +=1
-        return False
+        return attrName in self._attrIndex
     def get_user(self, key, value):
         if not self.is_attribute(key):
             return False
-        i=0
-        while self._userList.__len__() > i:
-            if self._userList[i].get_data(key) == value:
-                return self._userList[i].get_all_data()
-            i +=1
+        if key == "name":
+            u = self._byName.get(value)
+            if u is not None and u.get_data("name") == value:
+                return u.get_all_data()
+            return False
+        for u in self._userList:
+            if u.get_data(key) == value:
+                return u.get_all_data()
         return False
     def del_user(self, name):
-        i=0
-        while self._userList.__len__() > i:
-            if self._userList[i].get_data("name") == name:
-                del self._userList[i]
-                return  True
-            i +=1
-        return False
+        with self._lock:
+            u = self._byName.get(name)
+            if u is None:
+                return False
+            self._userList.remove(u)
+            del self._byName[name]
+            return True
         
     def add_user(self, userData):
-        i=self._userAttributes.__len__()-1
-        while i > -1:
-            if self._userAttributes[i] == "name":
-                break
-            i-=1
-        if not self.get_user("name",userData[i]):
-            self._userList.append(User(self._userAttributes, userData))
-            return True
+        i = self._attrIndex.get("name", -1)
+        with self._lock:
+            if not self.get_user("name",userData[i]):
+                u = User(self._userAttributes, userData)
+                self._userList.append(u)
+                self._byName[u.get_data("name")] = u
+                return True
         print("Did not add user {}".format(userData[i]))
         return False
     def get_users(self):
@@ -75,6 +94,7 @@ class Users():
         if self.is_attribute(attrName):
             return False
         self._userAttributes.append(attrName)
+        self._attrIndex[attrName] = len(self._userAttributes) - 1
         i=0
         while self._userList.__len__() > i:
             self._userList[i].set_attributes(attrName, defaultVal)
@@ -124,23 +144,35 @@ class Users():
         fileto.close()
         return str(self._userDirectory + "/archives" + tstr)
     def write_in_file(self):
-        self._isChange = True
-        f = open(self._userDirectory + "/" + self._userFile, "w")
-        tstr = ""
-        i=0
-        while self._userAttributes.__len__() > i:
-            tstr += self._userAttributes[i] + " "
-            i+=1
-        tstr +="\n"
-        f.write(tstr)
-        i=0
-        while self._userList.__len__() > i:
-            j=0
-            tstr = ""
-            while self._userAttributes.__len__() > j:
-                tstr += str(self._userList[i].get_data(self._userAttributes[j])) + " "
-                j += 1
-            tstr += "\n"
-            f.write(tstr)
-            i += 1
-        f.close()
+        with self._lock:
+            self._isChange = True
+            self._isDirty = True
+            if self._writeTimer is None:
+                self._writeTimer = self._startTimer(WRITE_DELAY, self.flush)
+    def flush(self):
+        with self._lock:
+            if self._writeTimer is not None:
+                self._writeTimer.cancel()
+                self._writeTimer = None
+            if not self._isDirty:
+                return
+            self._isDirty = False
+            # user dicts are changed in place, names may have changed too
+            self._reindex()
+            lines = ["".join([a + " " for a in self._userAttributes]) + "\n"]
+            for u in self._userList:
+                lines.append("".join([str(u.get_data(a)) + " " for a in self._userAttributes]) + "\n")
+            filename = self._userDirectory + "/" + self._userFile
+            tmpFilename = filename + ".tmp"
+            try:
+                with open(tmpFilename, "w") as f:
+                    f.write("".join(lines))
+                    f.flush()
+                    os.fsync(f.fileno())
+                if os.name == "nt" and os.path.exists(filename):
+                    # rename does not replace existing files on Windows
+                    os.remove(filename)
+                os.rename(tmpFilename, filename)
+            except (IOError, OSError) as e:
+                print("Failed to save users in " + filename + ": " + str(e))
+                self._isDirty = True
@@ -58,6 +58,13 @@ def fileIsOver(f):
     return currentPos == newPos
 
 
+# extract an integer query string parameter
+def qsExtractInt(qs, name, default):
+    try:
+        return int(qs[name][0], 0)
+    except:
+        return default
+
 def urlEscape(name):
     return name.replace("@", "_at_").replace(":", "_port_").replace(".", "_dot_").replace("/", "_slash_")
 